@@ -1,6 +1,6 @@
-from .dicom2nifti import *
-from .orientation import *
-from .logger import *
+import sys as _sys
+import types as _types
+import importlib as _importlib
 
 import logging
 try:  # Python 2.7+
@@ -11,3 +11,68 @@ except ImportError:
             pass
 
 logging.getLogger().addHandler(NullHandler())
+
+# The submodules pull in dcmstack, nibabel, dicom, numpy and pandas. They are imported on first access
+# to one of their names instead of being star-imported here, so that the command line scripts only
+# load what their code path needs (nothing for --help).
+_SUBMODULES = ['dicom2nifti', 'dcm2nii', 'orientation', 'logger', 'header_index', 'header_cache',
+               'stat_cache', 'parallel_gzip']
+# modules of the command line scripts, importable as names but not searched for other names
+_SCRIPTS = ['command_line', 'rename_nifti', 'merge_nifti_logs']
+
+_ATTRIBUTES = {}
+for _name in ['HEADER_FIELDS', 'ENHANCED_MR_IMAGE_STORAGE', 'MR_IMAGE_STORAGE', 'read_header', 'is_dicom',
+              'is_enhanced', 'read_sop_class', 'get_sop_classes', 'get_header_fields', 'read_partial_header',
+              'read_header_fields', 'is_dicom_file', 'discover_dicoms', 'discover_files',
+              'can_parse_and_group', 'DicomRecord', 'get_all_dicom_groups', 'get_all_dicoms_from_sequences',
+              'filter_dicoms_by_sequence', 'get_dataset_id', 'get_dataset_date', 'get_sequence_info',
+              'get_subject_id', 'organize_one_sequence', 'convert_one_sequence', 'convert_enhance_to_classic',
+              'split_enhanced_dicom', 'get_series_fingerprint', 'convert_one_directory']:
+    _ATTRIBUTES[_name] = 'dicom2nifti'
+for _name in ['ConversionResult', 'build_dcm2nii_cmdline', 'write_dcm2nii_config', 'run_dcm2nii']:
+    _ATTRIBUTES[_name] = 'dcm2nii'
+for _name in ['reorient_nifti_and_bvec', 'reorient_nifti_file', 'get_orientation_transform']:
+    _ATTRIBUTES[_name] = 'orientation'
+for _name in ['LOG_BACKENDS', 'ConversionState', 'LogBuffer', 'is_converted', 'log_tofile', 'read_log',
+              'materialize_log', 'merge_logs', 'log_conversion', 'create_log', 'merge_log_by_modality',
+              'count_files', 'count_files_frame']:
+    _ATTRIBUTES[_name] = 'logger'
+_ATTRIBUTES['HeaderIndex'] = 'header_index'
+_ATTRIBUTES['HeaderCache'] = 'header_cache'
+_ATTRIBUTES['StatCache'] = 'stat_cache'
+for _name in ['ParallelGzipWriter', 'save_nifti']:
+    _ATTRIBUTES[_name] = 'parallel_gzip'
+
+__all__ = sorted(_ATTRIBUTES)
+
+class _LazyModule(_types.ModuleType):
+    ''' The dicom2nifti package, importing a submodule when one of its names is first accessed. '''
+
+    def __getattr__(self, name):
+        # only called for the names not imported yet
+        if name in _SUBMODULES or name in _SCRIPTS:
+            return _importlib.import_module('.' + name, self.__name__)
+        if name in _ATTRIBUTES:
+            value = getattr(_importlib.import_module('.' + _ATTRIBUTES[name], self.__name__), name)
+        elif name.startswith('_'):
+            raise AttributeError(name)
+        else:
+            # any other name the submodules used to be star-imported with, the last one first
+            for submodule in reversed(_SUBMODULES):
+                module = _importlib.import_module('.' + submodule, self.__name__)
+                if hasattr(module, name):
+                    value = getattr(module, name)
+                    break
+            else:
+                raise AttributeError("'module' object has no attribute '%s'" % name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_ATTRIBUTES) | set(_SUBMODULES) | set(_SCRIPTS))
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(dict((k, v) for k, v in globals().iteritems() if k != '_module'))
+# keep this module alive: python 2 clears the globals of a module when it is garbage collected
+_module._original_module = _sys.modules[__name__]
+_sys.modules[__name__] = _module
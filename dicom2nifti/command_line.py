@@ -19,16 +19,16 @@ except ImportError:
 _log.getLogger().addHandler(NullHandler())
 
 def main(argv = None):
-    # check dcm2nii executable  
-    cmd = find_executable('dcm2nii')
-    if not cmd:
-        raise OSError('dcm2nii command cannot be found in system path.')
-        
     if argv is None:
         argv = sys.argv[1:]
-        
+
     # parse input from command line
     args = create_parser().parse_args(argv)
+
+    # check dcm2nii executable
+    cmd = find_executable('dcm2nii')
+    if not cmd and args.engine == 'dcm2nii':
+        raise OSError('dcm2nii command cannot be found in system path.')
      
     import socket, time
 
@@ -57,7 +57,14 @@ def main(argv = None):
         dcmnii.convert_one_directory(args.input_dir, args.output_dir, tmp_dir = args.tmpdir,
                                      log = args.log, keyword = args.keyword, exclude = args.exclude,
                                      recursive = True, orientation = args.orientation, mode = args.mode,
-                                     group_by = args.group_by, force = args.force)
+                                     group_by = args.group_by, force = args.force, sniff = args.sniff,
+                                     header_index = args.header_index, jobs = args.jobs,
+                                     partial = args.partial, compact = args.compact,
+                                     prefilter = args.prefilter, engine = args.engine,
+                                     gzip_level = args.gzip_level, gzip_index = args.gzip_index,
+                                     stream = args.stream, atomic = args.atomic,
+                                     fingerprint = args.fingerprint, log_backend = args.log_backend,
+                                     log_batch = args.log_batch)
     except:
         print 'Failed at converting ', args.input_dir
         tb.print_exception(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2])
@@ -124,9 +131,9 @@ def create_parser():
                         dest = 'mode',
                         action = 'store',
                         default = 'symbolic',
-                        choices = ['symbolic', 'move', 'copy', 'skip'],
+                        choices = ['symbolic', 'hardlink', 'reflink', 'move', 'copy', 'skip'],
                         type = str,
-                        help = 'There are four ways to deal with sorted dicoms. "symbolic": create soft/symbolic links at output_dir. (overwrite existing links); "copy": create a new copy of files in output_dir; "move": rename the original dicoms and move to output_dir. Creating symbolic link is highly recommended to reduce filesystem IO during runtime and also to preserve the linkage between unsorted files to sorted files; alternatively, "skip" allows user to skip the creation of sorted dicoms which is useful when one just wants to get the converted Nifti images.')
+                        help = 'There are six ways to deal with sorted dicoms. "symbolic": create soft/symbolic links at output_dir. (overwrite existing links); "hardlink": create hard links at output_dir, which survive a remount of the source (files on another filesystem are copied); "reflink": create copy-on-write clones where the filesystem supports it, copies otherwise; "copy": create a new copy of files in output_dir; "move": rename the original dicoms and move to output_dir. Creating symbolic link is highly recommended to reduce filesystem IO during runtime and also to preserve the linkage between unsorted files to sorted files; alternatively, "skip" allows user to skip the creation of sorted dicoms which is useful when one just wants to get the converted Nifti images.')
     parser.add_argument('-v', '--verbose',
                         dest = 'verbosity',
                         action = 'count',
@@ -141,6 +148,85 @@ def create_parser():
                         action = 'store_true',
                         default = False,
                         help = 'Force sorting and converting even if the sequence exists in the log file and overwrite.')
+    parser.add_argument('-j', '--jobs',
+                        dest = 'jobs',
+                        action = 'store',
+                        default = 1,
+                        type = int,
+                        help = 'Number of parallel workers used to read the dicom headers and to sort and convert the series. Default: 1.')
+    parser.add_argument('--nosniff',
+                        dest = 'sniff',
+                        action = 'store_false',
+                        default = True,
+                        help = 'Do not check the DICM magic bytes before parsing. By default, files that do not look like dicoms are skipped without parsing their headers.')
+    parser.add_argument('--index',
+                        dest = 'header_index',
+                        action = 'store',
+                        default = None,
+                        type = str,
+                        help = 'A SQLite file to keep the dicom headers between runs. Only new or changed dicoms will be parsed when the same directory is processed again.')
+    parser.add_argument('--partial',
+                        dest = 'partial',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Read only the dicom tags needed for grouping and naming instead of the whole headers. Much faster on networked storage.')
+    parser.add_argument('--compact',
+                        dest = 'compact',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Keep only the few dicom tags needed in memory while grouping. Use it for directories with a very large number of dicoms.')
+    parser.add_argument('--prefilter',
+                        dest = 'prefilter',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Apply the -e/-E filters on a cheap read of the grouping tags first, so that only the dicoms of the selected series are fully parsed.')
+    parser.add_argument('--engine',
+                        dest = 'engine',
+                        action = 'store',
+                        default = 'dcm2nii',
+                        choices = ['dcm2nii', 'dcmstack'],
+                        type = str,
+                        help = 'Conversion engine. "dcmstack" converts classic dicoms in memory without running dcm2nii and writes each Nifti once; enhanced and diffusion series fall back to dcm2nii. Default: dcm2nii.')
+    parser.add_argument('--gzip_level',
+                        dest = 'gzip_level',
+                        action = 'store',
+                        default = 6,
+                        choices = range(1, 10),
+                        type = int,
+                        help = 'Compression level (1-9) of the reoriented Nifti outputs, which are compressed in parallel blocks. Default: 6.')
+    parser.add_argument('--gzip_index',
+                        dest = 'gzip_index',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Write a block index (<output>.nii.gz.gzi) next to each reoriented Nifti output, so that a volume can be read without decompressing the whole file.')
+    parser.add_argument('--stream',
+                        dest = 'stream',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Reorient the converted Nifti one volume at a time, so that long 4D series (fMRI, DWI) do not need to fit in memory.')
+    parser.add_argument('--atomic',
+                        dest = 'atomic',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Build each sorted dicom series in a hidden staging directory and swap a symbolic link to it into place when complete, so that a series directory is never partially sorted.')
+    parser.add_argument('--fingerprint',
+                        dest = 'fingerprint',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Store a fingerprint of the dicoms of each series (SOPInstanceUIDs and file sizes) next to its Nifti, and reconvert exactly the series whose dicoms changed since, instead of relying on the log.')
+    parser.add_argument('--log_backend',
+                        dest = 'log_backend',
+                        action = 'store',
+                        default = 'csv',
+                        choices = ['csv', 'journal', 'shard'],
+                        type = str,
+                        help = 'How the log is updated. "csv": rewrite the whole CSV for each series; "journal": append each update to <log>.journal, which is applied when the log is read (e.g. by rename_nifti); "shard": append each update to <log>.shard-<host>-<pid> without locking the log, for many concurrent jobs. Use merge_nifti_logs to consolidate them into the CSV. Default: csv.')
+    parser.add_argument('--log_batch',
+                        dest = 'log_batch',
+                        action = 'store',
+                        default = 0,
+                        type = int,
+                        help = 'Write the log every LOG_BATCH series and at the end, under a single lock, instead of once per series. Pending entries are kept in <log>.wal-<host>-<pid> and recovered by the next run on the same host if the job is killed. Default: 0 (no batching).')
 #    parser.add_argument('-R', '--recursive',
 #                        dest = 'recursive',
 #                        action = 'store_true',
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+
+import os as _os
+import re as _re
+import logging as _log
+import subprocess as _subp
+import tempfile as _tempfile
+from distutils.spawn import find_executable as _find_executable
+
+_module_logger = _log.getLogger(__name__)
+_ch = _log.StreamHandler()
+_formatter = _log.Formatter(fmt = '%(asctime)s %(name)s %(levelname)s: %(message)s',
+                            datefmt = '%Y%m%d-%H:%M:%S')
+_ch.setFormatter(_formatter)
+_module_logger.addHandler(_ch)
+
+# the config written when none is given, as nipype does: dcm2nii must never wait for user input
+_NONINTERACTIVE_CONFIG = '[BOOL]\nManualNIfTIConv=0\n'
+# a converted dicom is reported as <dicom>--><nifti> (the pattern of nipype's Dcm2nii parser)
+_CONVERTED_LINE = _re.compile(r'.*-->(.*)')
+
+class ConversionResult(object):
+    ''' The outputs of a conversion. It has the same output_files, bvals and bvecs attributes as a
+        :class:`nipype.interfaces.dcm2nii.Dcm2nii` converter that has been run.
+
+        :param output_files: A list of converted nifti filepaths.
+        :type output_files: list
+        :param bvals: A list of bval filepaths.
+        :type bvals: list
+        :param bvecs: A list of bvec filepaths.
+        :type bvecs: list
+        :param cmdline: The command line that produced the outputs, if any.
+        :type cmdline: str
+    '''
+    def __init__(self, output_files = None, bvals = None, bvecs = None, cmdline = None):
+        self.output_files = output_files if output_files is not None else []
+        self.bvals = bvals if bvals is not None else []
+        self.bvecs = bvecs if bvecs is not None else []
+        self.cmdline = cmdline
+
+def build_dcm2nii_cmdline( source_names, output_dir, gzip_output = False, convert_all_pars = True,
+                           config_file = None, cmd = 'dcm2nii' ):
+    ''' Return the dcm2nii command line (a list of arguments) to convert dicoms to nifti. The other
+        options are those of :class:`nipype.interfaces.dcm2nii.Dcm2nii` as used by this package: no
+        anonymization, date or reorientation, protocol and events in filenames.
+
+        :param source_names: A list of dicom filepaths. Like nipype, only the first one is given to dcm2nii,
+                             which converts the other dicoms of its directory if convert_all_pars is True.
+        :type source_names: list
+        :param output_dir: Output directory.
+        :type output_dir: str
+        :param gzip_output: If True, dcm2nii compresses the nifti outputs.
+        :type gzip_output: boolean
+        :param convert_all_pars: If True, convert every image in the directory of the first source name.
+        :type convert_all_pars: boolean
+        :param config_file: A dcm2nii.ini filepath. Options given on the command line take precedence.
+                            It is required: without one, dcm2nii reads the preferences of the user, which
+                            may turn on its interactive mode. See :func:`write_dcm2nii_config`.
+        :type config_file: str
+        :param cmd: The dcm2nii executable.
+        :type cmd: str
+        :returns: A list of strings.
+    '''
+    def yn(value):
+        return 'y' if value else 'n'
+
+    if not config_file:
+        raise ValueError('A dcm2nii config file is required, see write_dcm2nii_config.')
+    cmdline = [cmd,
+               '-b', config_file,
+               '-a', 'n',                   # anonymize
+                '-c', 'y',                   # collapse folders
+                '-d', 'n',                   # date in filename
+                '-e', 'y',                   # events (series/acquisition) in filename
+                '-f', 'n',                   # source in filename
+                '-g', yn(gzip_output),
+                '-i', 'n',                   # ID in filename
+                '-n', 'y',                   # .nii output
+                '-p', 'y',                   # protocol in filename
+                '-r', 'n',                   # reorient
+                '-v', yn(convert_all_pars),
+                '-x', 'n',                   # reorient and crop
+                '-o', output_dir,
+                _os.path.abspath(source_names[0])]
+    return cmdline
+
+def write_dcm2nii_config( filename ):
+    ''' Write a dcm2nii.ini that turns off the interactive mode of dcm2nii, like the config.ini
+        :class:`nipype.interfaces.dcm2nii.Dcm2nii` writes when it is given none.
+
+        :param filename: The config filepath.
+        :type filename: str
+        :returns: filename.
+    '''
+    with open(filename, 'w') as fp:
+        fp.write(_NONINTERACTIVE_CONFIG)
+    return filename
+
+def run_dcm2nii( source_names, output_dir, gzip_output = False, convert_all_pars = True,
+                 config_file = None, cmd = None ):
+    ''' Run dcm2nii and return the files it created, parsed from its output like
+        :class:`nipype.interfaces.dcm2nii.Dcm2nii` does. See :func:`build_dcm2nii_cmdline` for the
+        parameters. If config_file is None, a temporary one is written with :func:`write_dcm2nii_config`.
+        dcm2nii messages are logged at DEBUG level. A failure of dcm2nii is logged and the
+        outputs found, if any, are returned.
+
+        :returns: A :class:`ConversionResult`.
+    '''
+    _module_logger.debug('received a call to run_dcm2nii')
+    if cmd is None:
+        cmd = _find_executable('dcm2nii')
+        if not cmd:
+            raise OSError('dcm2nii command cannot be found in system path.')
+    tmp_config = None
+    if config_file is None:
+        fd, tmp_config = _tempfile.mkstemp(prefix = 'dcm2nii_', suffix = '.ini')
+        _os.close(fd)
+        config_file = write_dcm2nii_config(tmp_config)
+    try:
+        cmdline = build_dcm2nii_cmdline(source_names, output_dir, gzip_output = gzip_output,
+                                        convert_all_pars = convert_all_pars, config_file = config_file,
+                                        cmd = cmd)
+        _module_logger.debug('dcm2nii command:\n' + _subp.list2cmdline(cmdline))
+
+        proc = _subp.Popen(cmdline, stdout = _subp.PIPE, stderr = _subp.STDOUT)
+        stdout = proc.communicate()[0]
+    finally:
+        if tmp_config is not None:
+            _os.remove(tmp_config)
+    _module_logger.debug(stdout)
+    if proc.returncode != 0:
+        _module_logger.warning('dcm2nii exited with code %d' % proc.returncode)
+
+    output_files, bvals, bvecs = _parse_stdout(stdout, output_dir)
+    return ConversionResult(output_files = output_files, bvals = bvals, bvecs = bvecs,
+                            cmdline = _subp.list2cmdline(cmdline))
+
+def _parse_stdout( stdout, output_dir ):
+    ''' Return the (output_files, bvals, bvecs) reported in the stdout of dcm2nii, parsed like
+        :class:`nipype.interfaces.dcm2nii.Dcm2nii` does: outputs are reported by 'Saving <file>',
+        'GZip...<file>' (relative to output_dir) and '<dicom>--><file>' lines, and the line after a
+        'Reorienting as' or 'Cropping NIfTI/Analyze image' line is not a conversion. Only the output
+        files that exist are returned: a nifti saved and then compressed is reported twice. The bval and
+        bvec filenames are derived from the last output file and may not exist if dcm2nii removed the
+        extra direction of a diffusion series (it then saves x<filename>.bval/bvec instead).
+    '''
+    output_files = []
+    bvals = []
+    bvecs = []
+    last_file = None
+    skip = False
+    for line in stdout.splitlines():
+        if skip:
+            skip = False
+            continue
+        filename = None
+        converted = _CONVERTED_LINE.match(line)
+        if line.startswith('Saving '):
+            filename = line[len('Saving '):]
+        elif line.startswith('GZip...'):
+            # compressed outputs are reported relative to the output directory
+            filename = _os.path.abspath(_os.path.join(output_dir, line[len('GZip...'):]))
+        elif line.startswith('Number of diffusion directions '):
+            if last_file:
+                base = _split_nifti_ext(last_file)
+                bvecs.append(base + '.bvec')
+                bvals.append(base + '.bval')
+        elif converted:
+            filename = _os.path.join(output_dir, converted.group(1))
+        elif line.startswith('Reorienting as ') or line.startswith('Cropping NIfTI/Analyze image '):
+            skip = True
+        if filename:
+            filename = filename.strip()
+            if filename not in output_files:
+                output_files.append(filename)
+            last_file = filename
+    output_files = [f for f in output_files if _os.path.exists(f)]
+    return (output_files, bvals, bvecs)
+
+def _split_nifti_ext( filename ):
+    ''' Return filename without its .nii, .nii.gz, .hdr or .img extension. '''
+    if filename.endswith('.gz'):
+        filename = filename[:-len('.gz')]
+    return _os.path.splitext(filename)[0]
@@ -8,7 +8,18 @@ import traceback as _tb
 import logging as _log
 import tempfile as _tmp
 import uuid as _uuid
+import errno as _errno
+import hashlib as _hashlib
+import struct as _struct
+import threading as _threading
 from distutils.spawn import find_executable as _find_executable
+try:  # Python 3.5+
+    from os import scandir as _scandir
+except ImportError:
+    try:  # backport from PyPI
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
 
 #from memory_profiler import profile
 
@@ -17,6 +28,8 @@ from distutils.spawn import find_executable as _find_executable
 import dcmstack
 import nibabel as nib
 import dicom
+from header_cache import HeaderCache
+from dcm2nii import ConversionResult, run_dcm2nii
 
 # create system logger
 _module_logger = _log.getLogger(__name__)
@@ -24,7 +37,36 @@ _ch = _log.StreamHandler()
 _formatter = _log.Formatter(fmt = '%(asctime)s %(name)s %(levelname)s: %(message)s',
                             datefmt = '%Y%m%d-%H:%M:%S')
 _ch.setFormatter(_formatter)
-_module_logger.addHandler(_ch)    
+_module_logger.addHandler(_ch)
+
+# dicom fields needed to group, sort and name a sequence
+HEADER_FIELDS = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'InstanceNumber',
+                 'PatientID', 'StudyID', 'AccessionNumber', 'AcquisitionDate', 'StudyDate',
+                 'ProtocolName', 'SequenceName', 'SOPClassUID', 'SOPInstanceUID']
+
+ENHANCED_MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4.1'
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+
+# bytes read to find the SOP class in the file meta information. See :func:`read_sop_class`.
+_FILE_META_READ_SIZE = 1024
+# VRs with a 4 bytes length (after 2 reserved bytes) in explicit VR encoding
+_LONG_LENGTH_VRS = ('OB', 'OW', 'OF', 'SQ', 'UT', 'UN')
+
+# headers shared by all the functions of a run. See :func:`read_header`.
+_header_cache = HeaderCache()
+# serializes the log updates of the sequences converted concurrently
+_log_lock = _threading.Lock()
+
+def read_header( dcmpath ):
+    ''' Return the header (without pixel data) of a dicom file. Headers are kept in a shared
+        :class:`dicom2nifti.header_cache.HeaderCache`, so a file is read from disk only once
+        unless it changes. The returned dataset must not be modified.
+
+        :param dcmpath:  A dicom filepath.
+        :type dcmpath: str
+        :returns:  A :class:`dicom.dataset.FileDataset`.
+    '''
+    return _header_cache.read(dcmpath)
 
 def is_dicom( dcmpath ):
     ''' Return True if the input file is a valid dicom that can be read by :func:`dicom.read_file`.
@@ -55,24 +97,264 @@ def is_enhanced( dcm_ds ):
     '''
     _module_logger.debug('received a call to is_enhanced')
     if dcm_ds.file_meta.has_key(dicom.tag.Tag((0x0002,0x0002))):
-        if dcm_ds.file_meta[0002,0002].value == '1.2.840.10008.5.1.4.1.1.4.1':
+        if dcm_ds.file_meta[0002,0002].value == ENHANCED_MR_IMAGE_STORAGE:
             return True
 
     return False
 
+def read_sop_class( filepath ):
+    ''' Return the MediaStorageSOPClassUID (0002,0002) of a dicom file. Only the first kilobyte of the
+        file is read and the file meta information (group 0002, always explicit VR little endian) is
+        walked element by element, so this is much cheaper than reading the header.
+
+        :param filepath:  A dicom filepath.
+        :type filepath: str
+        :returns:  The SOP class UID string, or None if the file has no file meta information.
+    '''
+    with open(filepath, 'rb') as fp:
+        data = fp.read(_FILE_META_READ_SIZE)
+    if data[128:132] != b'DICM':
+        return None
+
+    offset = 132
+    while offset + 8 <= len(data):
+        group, element = _struct.unpack('<HH', data[offset:offset + 4])
+        if group != 0x0002:
+            break
+        if data[offset + 4:offset + 6] in _LONG_LENGTH_VRS:
+            if offset + 12 > len(data):
+                break
+            length = _struct.unpack('<I', data[offset + 8:offset + 12])[0]
+            offset += 12
+        else:
+            length = _struct.unpack('<H', data[offset + 6:offset + 8])[0]
+            offset += 8
+        if element == 0x0002:
+            return data[offset:offset + length].rstrip(b'\x00 ')
+        offset += length
+    return None
+
+def get_sop_classes( dcm_items ):
+    ''' Return the set of SOP classes of the dicoms of a sequence in one pass. The SOP class captured
+        when grouping is used when available, otherwise it is read with :func:`read_sop_class`.
+
+        :param dcm_items:  A list of dicom filepaths, or a group from :func:`get_all_dicom_groups`.
+        :type dcm_items: list
+        :returns:  A set of SOP class UID strings.
+    '''
+    sop_classes = set()
+    for dcm_item in dcm_items:
+        sop_class = None
+        if isinstance(dcm_item, basestring):
+            filename = dcm_item
+        else:
+            filename = _get_filename(dcm_item)
+            if not isinstance(dcm_item, DicomRecord) and hasattr(dcm_item[0], 'file_meta'):
+                sop_class = dcm_item[0].file_meta.get('MediaStorageSOPClassUID')
+            if sop_class is None:
+                sop_class = _get_meta(dcm_item).get('SOPClassUID')
+            if sop_class is not None and not _is_uid(sop_class):
+                sop_class = None # e.g. the name of the UID in a header index of an older version
+        if sop_class is None:
+            sop_class = read_sop_class(filename)
+        if sop_class is not None:
+            sop_classes.add(str.__str__(sop_class))
+    return sop_classes
+
+def _is_uid( value ):
+    ''' Check if a value is a UID in its dotted form. '''
+    return isinstance(value, str) and bool(value) and not value.strip('0123456789.')
+
+def get_header_fields( dcm_ds, fields = HEADER_FIELDS ):
+    ''' Return a dict of the values of the given dicom fields in a dataset. Numeric strings (IS, DS)
+        are converted to numbers and multi-valued fields to tuples, the same way dcmstack converts
+        the meta data. Fields not present in dcm_ds map to None.
+
+        :param dcm_ds:  Input dicom header.
+        :type dcm_ds: dicom.dataset.Dataset
+        :param fields:  A list of dicom tag names.
+        :type fields: list
+        :returns:  A dict mapping the tag names to values.
+    '''
+    header_fields = {}
+    for name in fields:
+        tag = dicom.datadict.tag_for_name(name)
+        if tag is not None and tag in dcm_ds:
+            header_fields[name] = _get_element_value(dcm_ds[tag])
+        else:
+            header_fields[name] = None
+    return header_fields
+
+def _get_element_value( elem ):
+    ''' Return the python value of a :class:`dicom.dataelem.DataElement`. Sequences are not supported
+        and return None.
+    '''
+    if elem.VR == 'SQ':
+        return None
+    if isinstance(elem.value, list):
+        return tuple(_convert_value(elem.VR, v) for v in elem.value)
+    return _convert_value(elem.VR, elem.value)
+
+def _convert_value( VR, value ):
+    if value == '' or value is None:
+        return None
+    elif VR == 'IS':
+        return int(value)
+    elif VR == 'DS':
+        return float(value)
+    elif VR == 'UI' and isinstance(value, str):
+        # str() of a dicom.UID.UID is its name, e.g. 'Enhanced MR Image Storage'
+        return str.__str__(value)
+    elif isinstance(value, (int, long, float, unicode)):
+        return value
+    else:
+        return str(value)
+
+def read_partial_header( filepath, fields = HEADER_FIELDS, defer_size = 1024 ):
+    ''' Read a dicom header only up to the given fields. Data elements are stored in ascending tag
+        order, so decoding stops at the first tag past the highest tag needed: private groups, CSA
+        headers and pixel data after it are never read. Values larger than defer_size bytes before
+        it are skipped and only read from disk if accessed.
+
+        :param filepath:  A dicom filepath.
+        :type filepath: str
+        :param fields:  A list of dicom tag names.
+        :type fields: list
+        :param defer_size:  Values larger than this number of bytes are not read.
+        :type defer_size: int
+        :returns:  A partial :class:`dicom.dataset.FileDataset`.
+    '''
+    tags = [dicom.datadict.tag_for_name(name) for name in fields]
+    stop_tag = max(tag for tag in tags if tag is not None)
+
+    def _past_stop_tag(tag, VR, length):
+        return tag > stop_tag
+
+    with open(filepath, 'rb') as fp:
+        return dicom.filereader.read_partial(fp, stop_when = _past_stop_tag, defer_size = defer_size)
+
+def read_header_fields( filepath, fields = HEADER_FIELDS ):
+    ''' Return a dict of the given dicom fields read from a file with :func:`read_partial_header`,
+        or None if the file cannot be read as a dicom.
+
+        :param filepath:  A dicom filepath.
+        :type filepath: str
+        :param fields:  A list of dicom tag names.
+        :type fields: list
+        :returns:  A dict mapping the tag names to values or None.
+    '''
+    try:
+        dcm_ds = read_partial_header(filepath, fields)
+    except Exception, e:
+        _module_logger.warning('Cannot read %s: %s' % (filepath, str(e)))
+        return None
+    return get_header_fields(dcm_ds, fields)
+
+def is_dicom_file( filepath ):
+    ''' Return True if the input file looks like a dicom by sniffing its first bytes only.
+        A Part 10 file has a 128-byte preamble followed by 'DICM'. Files written without
+        the preamble (raw implicit VR little endian datasets) are accepted if they start
+        with a plausible group 0x0002 or 0x0008 element. No header is parsed, so this is
+        much cheaper than :func:`is_dicom` and suitable for sorting out non-dicom files.
+
+        :param filepath:  A filepath.
+        :type filepath: str
+        :returns:  True if filepath is a candidate dicom.
+    '''
+    try:
+        with open(filepath, 'rb') as fp:
+            head = fp.read(132)
+    except (IOError, OSError):
+        return False
+
+    if len(head) == 132 and head[128:132] == b'DICM':
+        return True
+
+    # preamble-less file: the first element should be a low group tag
+    # followed by either an explicit VR or a sane implicit VR length.
+    if len(head) < 8:
+        return False
+    group, element = _struct.unpack('<HH', head[:4])
+    if group not in (0x0002, 0x0008) or element > 0x00ff:
+        return False
+    if head[4:6].isalpha() and head[4:6].isupper():
+        return True
+    length = _struct.unpack('<I', head[4:8])[0]
+    return length < 0x10000
+
+def discover_dicoms( input_dir, recursive = True ):
+    ''' Return a list of candidate dicom files found in a given directory and the counts of
+        files that were rejected. Directories are walked with scandir (when available) and
+        each file is checked with :func:`is_dicom_file`, so non-dicom files (PDFs, zips,
+        reports...) never reach the header parser. Hidden files and directories are ignored.
+
+        :param input_dir: An input directory to discover dicom files.
+        :type input_dir: str
+        :param recursive: A switch to perform the operation recursively.
+        :type recursive: boolean
+        :returns: A tuple of (list of dicom filepaths, dict of rejected file counts keyed by
+                  'hidden' and 'not_dicom').
+    '''
+    _module_logger.debug('received a call to discover_dicoms')
+    input_dir = _os.path.abspath( input_dir )
+    src_dcms = []
+    rejected = {'hidden': 0, 'not_dicom': 0}
+    dirs = [input_dir]
+    while dirs:
+        current_dir = dirs.pop()
+        try:
+            entries = sorted(_iter_directory(current_dir))
+        except OSError:
+            _module_logger.warning('Cannot list directory ' + current_dir)
+            continue
+        subdirs = []
+        for name, path, is_dir, is_link in entries:
+            if name[0] == '.':
+                rejected['hidden'] += 1
+            elif is_dir:
+                # same as os.walk: symlinked directories are not followed
+                if recursive and not is_link:
+                    subdirs.append(path)
+            elif is_dicom_file(path):
+                src_dcms.append(path)
+            else:
+                rejected['not_dicom'] += 1
+        # keep a depth-first, sorted order
+        dirs.extend(reversed(subdirs))
+
+    return src_dcms, rejected
+
+def _iter_directory( input_dir ):
+    ''' Yield (name, path, is_dir, is_link) for each entry of input_dir. Uses scandir (the
+        scandir package on python 2) so that the file type comes from the directory listing
+        without extra stat calls, and falls back to listdir and stat calls without it.
+    '''
+    if _scandir is not None:
+        for entry in _scandir(input_dir):
+            yield (entry.name, entry.path, entry.is_dir(), entry.is_symlink())
+    else:
+        for name in _os.listdir(input_dir):
+            path = _os.path.join(input_dir, name)
+            yield (name, path, _os.path.isdir(path), _os.path.islink(path))
+
 # commented part are very expensive operations
-def discover_files( input_dir, recursive = False ):
+def discover_files( input_dir, recursive = False, sniff = False ):
     ''' Return a list of files found in a given directory.
-    
+
         :param input_dir: An input directory to discover dicom files.
         :type input_dir: str
         :param recursive: A switch to perform the operation recursively. It might be time-consuming.
         :type recursive: boolean
+        :param sniff: If True, only return files that look like dicoms. See :func:`dicom2nifti.discover_dicoms`.
+        :type sniff: boolean
         :returns: A list of files found in input_dir.
     '''
-    _module_logger.debug('received a call to discover_files')    
+    _module_logger.debug('received a call to discover_files')
     input_dir = _os.path.abspath( input_dir )
-    if recursive:
+    if sniff:
+        src_files, rejected = discover_dicoms( input_dir, recursive = recursive )
+        _module_logger.info('%d non-dicom and %d hidden files skipped.' % (rejected['not_dicom'], rejected['hidden']))
+    elif recursive:
         src_files = []
         for dirpath, dirnames, filenames in _os.walk(input_dir):
             # ignore hidden files and directories
@@ -108,27 +390,227 @@ def can_parse_and_group( src_dcms ):
         _module_logger.error("Unexpected error:" + _sys.exc_info()[0] + str(e))
     return False
 
-def get_all_dicom_groups( src_dcms, group_by = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription']):
-    ''' Return a dict that the keys being sequence information and values being list of dicoms of 
+class DicomRecord(object):
+    ''' A compact record of one dicom file holding only its filename, its group key and the
+        :data:`HEADER_FIELDS`. It is used in place of the (dicom object, meta data, filename) tuples
+        of :func:`dcmstack.parse_and_group` to keep large directories in memory. A record behaves
+        like a read-only mapping of its header fields, so it can be given directly to
+        :func:`get_sequence_info` and :func:`get_subject_id`.
+
+        :param filename: A dicom filepath.
+        :type filename: str
+        :param key: The group key of the file.
+        :type key: tuple
+        :param header_fields: A dict of header fields. See :func:`get_header_fields`.
+        :type header_fields: dict
+    '''
+    __slots__ = ['filename', 'key'] + HEADER_FIELDS
+
+    def __init__(self, filename, key, header_fields):
+        self.filename = filename
+        self.key = key
+        for name in HEADER_FIELDS:
+            setattr(self, name, header_fields.get(name))
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default = None):
+        if name in HEADER_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                return value
+        return default
+
+    def __repr__(self):
+        return 'DicomRecord(%r, %r)' % (self.filename, self.key)
+
+def _get_filename( dcm_item ):
+    ''' Return the filename of an element of a group, either a :class:`DicomRecord` or a
+        (dicom object, meta data, filename) tuple.
+    '''
+    if isinstance(dcm_item, DicomRecord):
+        return dcm_item.filename
+    return dcm_item[2]
+
+def _get_meta( dcm_item ):
+    ''' Return the meta data of an element of a group, either a :class:`DicomRecord` or a
+        (dicom object, meta data, filename) tuple.
+    '''
+    if isinstance(dcm_item, DicomRecord):
+        return dcm_item
+    return dcm_item[1]
+
+def get_series_fingerprint( dcm_items ):
+    ''' Return a fingerprint of the inputs of a sequence: a SHA-1 of the sorted SOPInstanceUIDs (the real
+        paths of the files without one) and file sizes. It changes when slices are added, removed or
+        replaced, and is computed from the fields captured when grouping and a stat of each file, without
+        reading any pixel data.
+
+        :param dcm_items:  A group from :func:`get_all_dicom_groups`, or a list of dicom filepaths.
+        :type dcm_items: list
+        :returns:  A hexadecimal string.
+    '''
+    entries = []
+    for dcm_item in dcm_items:
+        if isinstance(dcm_item, basestring):
+            filename = dcm_item
+            uid = read_header(filename).get('SOPInstanceUID')
+        else:
+            filename = _get_filename(dcm_item)
+            uid = _get_meta(dcm_item).get('SOPInstanceUID')
+            if uid is None and not isinstance(dcm_item, DicomRecord) and dcm_item[0] is not None:
+                uid = dcm_item[0].get('SOPInstanceUID')
+        if uid is None:
+            uid = _os.path.realpath(filename)
+        entries.append('%s\t%d\n' % (uid, _os.stat(filename).st_size))
+    sha1 = _hashlib.sha1()
+    for entry in sorted(entries):
+        sha1.update(entry)
+    return sha1.hexdigest()
+
+def get_all_dicom_groups( src_dcms, group_by = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription'],
+                          header_index = None, jobs = 1, partial = False, compact = False ):
+    ''' Return a dict that the keys being sequence information and values being list of dicoms of
         that sequence from a list of dicoms. The output dicoms will be sorted by dicom tag InstanceNumber.
 
         :param src_dcms:  A list of dicom filenames.
         :type src_dcms: list
+        :param header_index:  A :class:`dicom2nifti.header_index.HeaderIndex`. If given, only the
+                              :data:`HEADER_FIELDS` and group_by fields are read, from the index when
+                              the file is unchanged since the last run, and the dicom object in the
+                              output tuples is None.
+        :type header_index: dicom2nifti.header_index.HeaderIndex
+        :param jobs:  Number of processes to parse the headers with. The files are split into chunks
+                      in input order and the partial groups are concatenated back in the same order,
+                      so the output does not depend on the number of processes.
+        :type jobs: int
+        :param partial:  If True, only read the :data:`HEADER_FIELDS` and group_by fields of each file
+                         with :func:`read_partial_header` instead of parsing the whole header with
+                         dcmstack. The dicom object in the output tuples is None.
+        :type partial: boolean
+        :param compact:  If True, implies partial and each element of the groups is a :class:`DicomRecord`
+                         instead of a tuple. Repeated values (IDs, dates, descriptions) are shared
+                         between records.
+        :type compact: boolean
         :returns:  A dict mapping tuples of values (corresponding to 'group_by') to groups of data sets parsed by :func:`dcmstack.parse_and_group`. Each element in the list is a tuple
         containing the dicom object, the parsed meta data, and the filename.
     '''
-    _module_logger.debug('received a call to get_all_dicom_groups')     
-    dcm_groups = dcmstack.parse_and_group(src_dcms, warn_on_except = True, force = False,
-                                          group_by = group_by)
+    _module_logger.debug('received a call to get_all_dicom_groups')
+    fields = HEADER_FIELDS + [tag for tag in group_by if tag not in HEADER_FIELDS]
+    if header_index is not None:
+        headers, stale = header_index.lookup(src_dcms, fields)
+        _module_logger.info('%d of %d headers found in the index.' % (len(headers), len(src_dcms)))
+        stale_dcms = [path for path in src_dcms if path in stale]
+        new_headers = dict(zip(stale_dcms, _map_chunks(_read_header_fields_chunk, stale_dcms, fields, jobs)))
+        header_index.update(new_headers, stale)
+        headers.update(new_headers)
+        dcm_groups = _group_header_fields([(headers[path], path) for path in src_dcms
+                                          if headers.get(path) is not None], group_by, compact = compact)
+    elif partial or compact:
+        headers = _map_chunks(_read_header_fields_chunk, src_dcms, fields, jobs)
+        dcm_groups = _group_header_fields([(header_fields, path) for header_fields, path in zip(headers, src_dcms)
+                                          if header_fields is not None], group_by, compact = compact)
+    elif jobs > 1:
+        from collections import OrderedDict as _OrderedDict
+        dcm_groups = _OrderedDict()
+        for partial_groups in _map_chunks(_parse_and_group_chunk, src_dcms, group_by, jobs, merge = False):
+            for key, dcm_dataset in partial_groups.iteritems():
+                dcm_groups.setdefault(key, []).extend(dcm_dataset)
+    else:
+        dcm_groups = dcmstack.parse_and_group(src_dcms, warn_on_except = True, force = False,
+                                              group_by = group_by)
 
+    # sorted() is stable, so files sharing an InstanceNumber keep their input order
     for key, dcm_dataset in dcm_groups.iteritems():
         has_instance_number = all([ True for i in xrange(len(dcm_dataset))
-                                         if 'InstanceNumber' in dcm_dataset[i][1] ])
+                                         if 'InstanceNumber' in _get_meta(dcm_dataset[i]) ])
         if has_instance_number:
-            dcm_groups[key] = sorted(dcm_dataset, key=lambda x:x[1].get('InstanceNumber'))
+            dcm_groups[key] = sorted(dcm_dataset, key=lambda x:_get_meta(x).get('InstanceNumber'))
 
     return dcm_groups
 
+def _strip_pixel_data( dcm_ds ):
+    ''' Return dcm_ds, or a shallow copy of it without the pixel data if it has some. '''
+    if not hasattr(dcm_ds, 'PixelData'):
+        return dcm_ds
+    import copy as _copy
+    header = _copy.copy(dcm_ds)
+    del header.PixelData
+    return header
+
+def _map_chunks( func, items, arg, jobs, merge = True ):
+    ''' Apply func to (chunk, arg) for consecutive chunks of items in a process pool and return
+        the results in input order, concatenated if merge is True.
+    '''
+    if jobs <= 1 or len(items) < 2:
+        results = [func((items, arg))]
+    else:
+        import multiprocessing as _mp
+        nchunks = min(len(items), jobs * 4)
+        chunk_size = (len(items) + nchunks - 1) // nchunks
+        chunks = [(items[i:i + chunk_size], arg) for i in xrange(0, len(items), chunk_size)]
+        pool = _mp.Pool(jobs)
+        try:
+            results = pool.map(func, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    if merge:
+        return [item for result in results for item in result]
+    return results
+
+def _parse_and_group_chunk( args ):
+    ''' Group a chunk of dicoms by the values of group_by as :func:`dcmstack.parse_and_group` does,
+        in a worker process. The groups are pickled back to the parent, so the files are read
+        without pixel data and only the meta data is returned, with None in place of the dicom
+        object (datasets cannot be pickled).
+    '''
+    src_dcms, group_by = args
+    from collections import OrderedDict as _OrderedDict
+    from dcmstack.extract import default_extractor
+    dcm_groups = _OrderedDict()
+    for path in src_dcms:
+        try:
+            dcm_ds = dicom.read_file(path, stop_before_pixels=True)
+        except Exception, e:
+            _module_logger.warning('Error reading file %s: %s' % (path, str(e)))
+            continue
+        meta = default_extractor(dcm_ds)
+        key = tuple(tuple(meta[tag]) if isinstance(meta.get(tag), list) else meta.get(tag)
+                    for tag in group_by)
+        dcm_groups.setdefault(key, []).append((None, meta, path))
+    return dcm_groups
+
+def _read_header_fields_chunk( args ):
+    src_dcms, fields = args
+    return [read_header_fields(path, fields) for path in src_dcms]
+
+def _group_header_fields( headers, group_by, compact = False ):
+    ''' Group a list of (header_fields, filename) pairs by the values of group_by into the same
+        structure as :func:`dcmstack.parse_and_group`, with None in place of the dicom object,
+        or into lists of :class:`DicomRecord` if compact is True.
+    '''
+    from collections import OrderedDict as _OrderedDict
+    dcm_groups = _OrderedDict()
+    shared_values = {}
+    for header_fields, filename in headers:
+        key = tuple(header_fields.get(tag) for tag in group_by)
+        if compact:
+            key = shared_values.setdefault(key, key)
+            header_fields = dict((name, shared_values.setdefault(value, value)
+                                        if isinstance(value, basestring) else value)
+                                 for name, value in header_fields.iteritems())
+            dcm_groups.setdefault(key, []).append(DicomRecord(filename, key, header_fields))
+        else:
+            dcm_groups.setdefault(key, []).append((None, header_fields, filename))
+    return dcm_groups
+
 
 ## TODO 20180411 It would not distinguish sequence from different date with identical Series descriptions and series numbers
 def get_all_dicoms_from_sequences( dcm_groups, keyword = None, exclude = None):
@@ -139,7 +621,7 @@ def get_all_dicoms_from_sequences( dcm_groups, keyword = None, exclude = None):
         :param dcm_groups:  A dict mapping tuples of values (corresponding to 'group_by') to
                             groups of data sets parsed by :func:`dcmstack.parse_and_group`. Each element
                             in the list is a tuple containing the dicom object, the parsed meta
-                            data, and the filename.
+                            data, and the filename, or a :class:`DicomRecord`.
         :type dcm_groups: dict
         :param keyword:  A list of search string for specific sequence in a dcm_groups. Ex. ['T1', 'DWI'].
         :type keyword: str or list of strings
@@ -147,39 +629,63 @@ def get_all_dicoms_from_sequences( dcm_groups, keyword = None, exclude = None):
         :type exclude: str or list of strings
         :returns:  A dict of sequence information as keys and list of selected dicom filenames as values.
     '''
-    _module_logger.debug('received a call to get_all_dicoms_from_sequences')   
+    _module_logger.debug('received a call to get_all_dicoms_from_sequences')
+    # TODO 20160816 Michael Hsieh: same sequence from multiple studies would be overwritten cos UID (key[0]) is omitted.
+    out_dcm_groups = { key: [_get_filename(i) for i in dcm_groups[key]]
+                       for key in dcm_groups.keys() if _is_selected_sequence(key[-1], keyword, exclude) }
+
+    return out_dcm_groups
+
+def _is_selected_sequence( sequence, keyword = None, exclude = None ):
+    ''' Return True if a sequence description contains none of the exclude strings and, if
+        keyword is given, at least one of the keyword strings (case insensitive). Descriptions
+        that are not strings are never selected.
+    '''
+    if not isinstance(sequence, (str, unicode)):
+        return False
     if isinstance(keyword, str):
         keyword = [keyword]
     if isinstance(exclude, str):
         exclude = [exclude]
+    if exclude and any(ex.upper() in sequence.upper() for ex in exclude):
+        return False
+    if keyword:
+        return any(kw.upper() in sequence.upper() for kw in keyword)
+    return True
+
+def filter_dicoms_by_sequence( src_dcms, group_by = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription'],
+                               keyword = None, exclude = None, jobs = 1 ):
+    ''' Return the dicoms of the sequences selected by keyword/exclude, reading only the group_by
+        fields of each header with :func:`read_partial_header`. This is the cheap first phase of a
+        selective conversion: the full grouping of :func:`get_all_dicom_groups` then only has to
+        parse the files of the sequences of interest. As in :func:`get_all_dicoms_from_sequences`,
+        keyword/exclude are matched against the last group_by value.
 
-    # TODO 20160816 Michael Hsieh: same sequence from multiple studies would be overwritten cos UID (key[0]) is omitted.
-    # keyword provided while exclude is empty
-    if keyword and keyword is not None and exclude is None:
-        out_dcm_groups = { key: [i[2] for i in dcm_groups[key]]
-                           for key in dcm_groups.keys() if isinstance(key[-1], (str, unicode))
-                           for kw in keyword if kw.upper() in key[-1].upper() }
-                           
-    elif exclude and exclude is not None:
-        dummy_dcm_groups = dcm_groups.copy()
-        for key in dummy_dcm_groups.keys():
-            if isinstance(key[-1], (str, unicode)):
-                for ex in exclude:
-                    if ex.upper() in key[-1].upper():
-                        dummy_dcm_groups.pop(key)
-        if keyword is None:
-            out_dcm_groups = { key: [i[2] for i in dummy_dcm_groups[key]]
-                               for key in dummy_dcm_groups.keys() if isinstance(key[-1], (str, unicode))  }
-        else:
-            out_dcm_groups = { key: [i[2] for i in dummy_dcm_groups[key]]
-                           for key in dummy_dcm_groups.keys() if isinstance(key[-1], (str, unicode))
-                           for kw in keyword if kw.upper() in key[-1].upper() }
-        dummy_dcm_groups = None
-    else:
-        out_dcm_groups = { key: [i[2] for i in dcm_groups[key]]
-                           for key in dcm_groups.keys() if isinstance(key[-1], (str, unicode)) }
-        
-    return out_dcm_groups
+        :param src_dcms:  A list of dicom filenames.
+        :type src_dcms: list
+        :param group_by:  A list of case sensitive dicom tag names to group dicoms.
+        :type group_by: list
+        :param keyword:  A list of search string for specific sequence. Ex. ['T1', 'DWI'].
+        :type keyword: str or list of strings
+        :param exclude:  A list of search string for excluding specific sequence. Ex. ['localizer', 'MoCoSeries'].
+        :type exclude: str or list of strings
+        :param jobs:  Number of processes to read the headers with.
+        :type jobs: int
+        :returns:  A list of dicom filenames, in input order.
+    '''
+    _module_logger.debug('received a call to filter_dicoms_by_sequence')
+    headers = _map_chunks(_read_header_fields_chunk, src_dcms, list(group_by), jobs)
+    selected = {}
+    selected_dcms = []
+    for header_fields, path in zip(headers, src_dcms):
+        if header_fields is None:
+            continue
+        sequence = header_fields.get(group_by[-1])
+        if sequence not in selected:
+            selected[sequence] = _is_selected_sequence(sequence, keyword, exclude)
+        if selected[sequence]:
+            selected_dcms.append(path)
+    return selected_dcms
 
 def get_dataset_id( dcm_meta ):
     ''' Return an subject identifier from the dicom header in an input meta file.
@@ -270,38 +776,62 @@ def get_subject_id( dcm_meta ):
     DATE = get_dataset_date(dcm_meta)
     return '%s-%s' % (ID, DATE)
 
-def organize_one_sequence( dicom_files, output_dir, prefix = None, mode = 'symbolic' ):
+def organize_one_sequence( dicom_files, output_dir, prefix = None, mode = 'symbolic', threads = 8,
+                           atomic = False ):
     ''' Organize the input dicom_files to standardized and readable filenames. Return a list 
         of sorted filenames.
          
-        There are three ways to create sorted filenames:
+        There are five ways to create sorted filenames:
         
         - symbolic: create soft/symbolic links at output_dir. (overwrite existing links)
+        - hardlink: create hard links at output_dir, which survive a remount of the source. Files on
+          another filesystem are copied.
+        - reflink: create copy-on-write clones at output_dir where the filesystem supports it (btrfs,
+          xfs...), copies otherwise.
         - copy: create a new copy of files in output_dir.
         - move: rename the original dicoms and move to output_dir
         
         Creating symbolic link is highly recommended to reduce filesystem IO during runtime 
         and also to preserve the linkage between unsorted files to sorted files.
+        Hard links, clones and copies are created by a pool of threads.
+
+        If atomic is True, the sorted series is built in a hidden sibling directory of output_dir, without
+        checking for existing files, and output_dir is made a symbolic link to it once complete, replacing
+        the previous series in a single rename. Readers see either the previous or the new series in full,
+        and a failure leaves output_dir untouched. See :func:`_replace_directory`.
 
         :param dicom_files:  A list of unsorted dicom filepaths.
         :type dicom_files: list
         :param output_dir:  Output directory
         :type output_dir: str
-        :param mode: {'symbolic', 'copy', 'move'}. 
+        :param mode: {'symbolic', 'hardlink', 'reflink', 'copy', 'move'}. 
         :type mode: str
+        :param threads:  Number of threads creating hard links, clones or copies. Default is 8.
+        :type threads: int
+        :param atomic:  If True, build the sorted series in a staging directory and link output_dir to it.
+        :type atomic: boolean
         :returns:  A list of filenames to the sorted and renamed dicoms.
     '''
     _module_logger.debug('received a call to organize_one_sequence')    
-    try:
-        _os.makedirs(output_dir)
-    except OSError:
-        _module_logger.warning('Directory exists.')
+    if atomic:
+        output_dir = _os.path.abspath(output_dir)
+        parent_dir = _os.path.dirname(output_dir)
+        if not _os.path.isdir(parent_dir):
+            _os.makedirs(parent_dir)
+        build_dir = _os.path.join(parent_dir, '.%s.%s' % (_os.path.basename(output_dir), _uuid.uuid4().hex))
+        _os.mkdir(build_dir)
+    else:
+        try:
+            _os.makedirs(output_dir)
+        except OSError:
+            _module_logger.warning('Directory exists.')
+        build_dir = output_dir
 
     if prefix is None:
         if isinstance( dicom_files, list):
-            ds = dicom.read_file(dicom_files[0], stop_before_pixels=True)
+            ds = read_header(dicom_files[0])
         elif isinstance( dicom_files, str):
-            ds = dicom.read_file(dicom_files, stop_before_pixels=True)
+            ds = read_header(dicom_files)
         sequence_info = get_sequence_info( ds )
         subject_id = get_subject_id( ds )
         prefix = '%s_%s' % (subject_id, sequence_info)
@@ -311,21 +841,172 @@ def organize_one_sequence( dicom_files, output_dir, prefix = None, mode = 'symbo
     new_dicom_files = []
     for count, dcm in enumerate(dicom_files):
         # need to check the slice location and/or time points
-        dcm_abspath = _os.path.abspath(dcm)
         new_dicom_files.append( _os.path.join(output_dir, '%s_%06d.dcm' % (prefix, count+1)))
+
+    if not atomic:
+        _organize_files( dicom_files, new_dicom_files, mode = mode, threads = threads )
+        return new_dicom_files
+
+    # the staging directory is new and empty: there are no existing files to replace
+    build_files = [_os.path.join(build_dir, _os.path.basename(f)) for f in new_dicom_files]
+    try:
+        _organize_files( dicom_files, build_files, mode = mode, threads = threads, replace = False )
+    except:
+        if mode == 'move':
+            _module_logger.error('Moved dicoms are left in ' + build_dir)
+        else:
+            _shutil.rmtree(build_dir, ignore_errors = True)
+        raise
+    _replace_directory( build_dir, output_dir )
+    return new_dicom_files
+
+def _organize_files( dicom_files, new_dicom_files, mode = 'symbolic', threads = 8, replace = True ):
+    ''' Create new_dicom_files from dicom_files for :func:`organize_one_sequence`. Existing new files are
+        only looked for (and replaced) if replace is True.
+    '''
+    if mode in ('hardlink', 'reflink', 'copy'):
+        transfer_file = {'hardlink': _link_file, 'reflink': _reflink_file, 'copy': _copy_file}[mode]
+        from multiprocessing.pool import ThreadPool as _ThreadPool
+        pool = _ThreadPool(max(1, min(threads, len(dicom_files))))
+        try:
+            pool.map(lambda (dcm, new_dcm): transfer_file(_os.path.abspath(dcm), new_dcm, replace = replace),
+                     zip(dicom_files, new_dicom_files))
+        finally:
+            pool.close()
+            pool.join()
+        return
+
+    for count, dcm in enumerate(dicom_files):
+        dcm_abspath = _os.path.abspath(dcm)
         if mode == 'symbolic':
             # if link exists, force to overwrite (by removing first)
-            if _os.path.islink(new_dicom_files[count]):
+            if replace and _os.path.islink(new_dicom_files[count]):
                 _os.unlink(new_dicom_files[count])
             _os.symlink(dcm_abspath, new_dicom_files[count])
         elif mode == 'move':
             _shutil.move(dcm_abspath, new_dicom_files[count])
-        elif mode == 'copy':
-            _shutil.copyfile(dcm_abspath, new_dicom_files[count])
-    return new_dicom_files
+
+def _replace_directory( build_dir, output_dir ):
+    ''' Make output_dir a symbolic link to build_dir, a hidden sibling directory named
+        .<basename of output_dir>.<uuid>. The link is created aside and renamed over output_dir, which
+        replaces a previous link in a single step, and the previous build it pointed to is then removed.
+        An output_dir that is a directory (e.g. sorted without atomic) cannot be replaced in one rename: it
+        is renamed aside first, so it is missing between the two renames this one time.
+    '''
+    parent_dir, name = _os.path.split(output_dir)
+    link = build_dir + '.link'
+    _os.symlink(_os.path.basename(build_dir), link)
+    previous_dir = None
+    if _os.path.islink(output_dir):
+        previous_build = _os.readlink(output_dir)
+        # only remove the builds of this function, not the target of a link made by someone else
+        if previous_build.startswith('.%s.' % name) and _os.sep not in previous_build:
+            previous_dir = _os.path.join(parent_dir, previous_build)
+    elif _os.path.isdir(output_dir):
+        previous_dir = build_dir + '.old'
+        _os.rename(output_dir, previous_dir)
+    _os.rename(link, output_dir)
+    if previous_dir is not None:
+        _shutil.rmtree(previous_dir, ignore_errors = True)
+
+# FICLONE ioctl request (linux/fs.h: _IOW(0x94, 9, int)) to share the extents of a file with another
+_FICLONE = 0x40049409
+
+def _link_file( src, dst, replace = True ):
+    ''' Hard link dst to src (to the file itself if src is a symbolic link), or copy it if they are on
+        different filesystems. An existing dst is replaced if replace is True.
+    '''
+    if replace and _os.path.lexists(dst):
+        _os.unlink(dst)
+    try:
+        _os.link(_os.path.realpath(src), dst)
+    except OSError, e:
+        if e.errno not in (_errno.EXDEV, _errno.EPERM, _errno.EMLINK):
+            raise
+        _copy_file(src, dst, replace = replace)
+
+def _reflink_file( src, dst, replace = True ):
+    ''' Clone src to dst with the FICLONE ioctl (copy-on-write, no data is copied), or copy it if the
+        filesystem does not support it.
+    '''
+    _copy_file(src, dst, reflink = True, replace = replace)
+
+def _copy_file( src, dst, reflink = False, replace = True ):
+    ''' Copy src to dst with a buffered copy. If reflink is True, try to clone the file first. '''
+    # an existing dst may be a link to src from a previous run: never write through it
+    if replace and _os.path.lexists(dst):
+        _os.unlink(dst)
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            if reflink:
+                try:
+                    import fcntl as _fcntl
+                    _fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                    return
+                except (ImportError, IOError, OSError):
+                    pass
+            _shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+def _is_diffusion( dcm_ds, sequence_info ):
+    ''' Return True if a dicom looks like part of a diffusion series that needs bval/bvec files. '''
+    if 'DiffusionBValue' in dcm_ds or (0x0019, 0x100c) in dcm_ds:  # standard or Siemens CSA b-value
+        return True
+    return 'DTI' in sequence_info.upper() or 'DWI' in sequence_info.upper()
+
+def _convert_one_sequence_dcmstack( dicom_files, output_dir, prefix = None, orientation = 'LPS',
+                                    gzip_level = 6, gzip_threads = None, gzip_index = False, sop_classes = None ):
+    ''' Convert dicoms of one sequence to a nifti image in memory with :class:`dcmstack.DicomStack`,
+        reorient it and write <prefix>.nii.gz to output_dir once. Enhanced dicoms are split into frames in
+        memory with :func:`split_enhanced_dicom`. Diffusion dicoms, which need bval/bvec files, are
+        converted by dcm2nii instead, see :func:`convert_one_sequence`.
+    '''
+    _module_logger.debug('received a call to _convert_one_sequence_dcmstack')
+    from orientation import reorient_nifti_and_bvec
+    from parallel_gzip import save_nifti
+
+    if isinstance( dicom_files, str):
+        dicom_files = [dicom_files]
+    ds = read_header(dicom_files[0])
+    sequence_info = get_sequence_info( ds )
+    if sop_classes is None:
+        sop_classes = get_sop_classes( dicom_files )
+    is_enhanced_dcm = ENHANCED_MR_IMAGE_STORAGE in sop_classes
+
+    if prefix is None:
+        prefix = '%s_%s' % (get_subject_id( ds ), sequence_info)
+    if not _os.path.isdir(output_dir):
+        _os.makedirs(output_dir)
+
+    if is_enhanced_dcm:
+        frames = []
+        for dcm in dicom_files:
+            dcm_ds = dicom.read_file(dcm)
+            frames.extend(split_enhanced_dicom(dcm_ds) if is_enhanced(dcm_ds) else [dcm_ds])
+            dcm_ds = None
+        # frames of an enhanced series share their acquisition time, order them by temporal position
+        if 'TemporalPositionIndex' in frames[0]:
+            stack = dcmstack.DicomStack(time_order = 'TemporalPositionIndex')
+        else:
+            stack = dcmstack.DicomStack()
+        for frame in frames:
+            stack.add_dcm(frame)
+        frames = None
+    else:
+        stack = dcmstack.DicomStack()
+        for dcm in dicom_files:
+            stack.add_dcm(dicom.read_file(dcm))
+    nii = stack.to_nifti(embed_meta = False)
+    stack = None
+
+    output_renamed = _os.path.join(output_dir, prefix + '.nii.gz')
+    nii_reoriented = reorient_nifti_and_bvec(nii, orientation = orientation)
+    save_nifti(nii_reoriented, output_renamed, level = gzip_level, threads = gzip_threads, index = gzip_index)
+    return ConversionResult(output_files = [output_renamed])
 
 # how to do Dcm2nii args*?
-def convert_one_sequence( dicom_files, output_dir, tmp_dir = None, prefix = None, orientation = 'LPS', **kwargs):
+def convert_one_sequence( dicom_files, output_dir, tmp_dir = None, prefix = None, orientation = 'LPS',
+                          engine = 'dcm2nii', gzip_level = 6, gzip_threads = None, gzip_index = False, stream = False,
+                          sop_classes = None, **kwargs):
     ''' Convert given dicoms of *ONE* sequence in dicom_files into NIfTI compressed format with specified orientation to output_dir using dcm2nii program. Output filename will be <prefix>.<ext>.
 
         :param dicom_files: A list of dicom filepaths.
@@ -338,19 +1019,51 @@ def convert_one_sequence( dicom_files, output_dir, tmp_dir = None, prefix = None
         :type prefix: str
         :param orientation: A string of orientation. Default is 'LPS' (CBICA convention.)
         :type orientation: str
-        :returns: A :class:`nipype.interfaces.dcm2nii.Dcm2nii` converter object.
+        :param engine: {'dcm2nii', 'dcmstack'}. 'dcmstack' converts classic dicoms in memory with dcmstack
+                       and writes the reoriented image once, without running dcm2nii. Enhanced dicoms are split
+                       in memory. Diffusion dicoms are converted by dcm2nii, and any sequence dcmstack cannot stack
+                       falls back to dcm2nii.
+        :type engine: str
+        :param gzip_level: zlib compression level (1-9) of reoriented .nii.gz outputs. Default is 6.
+        :type gzip_level: int
+        :param gzip_threads: Number of threads compressing reoriented outputs. Default is the number of CPUs.
+        :type gzip_threads: int
+        :param gzip_index: If True, write a block index <output>.nii.gz.gzi next to reoriented outputs.
+        :type gzip_index: boolean
+        :param stream: If True, reorient dcm2nii outputs one 3D volume at a time with
+                       :func:`dicom2nifti.orientation.reorient_nifti_file` to bound the memory used by long 4D series.
+        :type stream: boolean
+        :param sop_classes: The set of SOP classes of dicom_files, e.g. from :func:`get_sop_classes` on the groups
+                            of :func:`get_all_dicom_groups`. They are read from the file meta information if None.
+        :type sop_classes: set
+        :returns: A :class:`dicom2nifti.dcm2nii.ConversionResult` with the output_files, bvals and bvecs.
     '''
-    _module_logger.debug('received a call to convert_one_sequence')      
+    _module_logger.debug('received a call to convert_one_sequence')
+    if isinstance( dicom_files, str):
+        dicom_files = [dicom_files]
+    if engine == 'dcmstack':
+        # diffusion dicoms need the bval/bvec files of dcm2nii
+        ds = read_header(dicom_files[0])
+        if _is_diffusion( ds, get_sequence_info( ds ) ):
+            _module_logger.info('Diffusion dicoms, converting with dcm2nii.')
+            engine = 'dcm2nii'
+        ds = None
+    if engine == 'dcmstack':
+        try:
+            return _convert_one_sequence_dcmstack( dicom_files, output_dir, prefix = prefix,
+                                                   orientation = orientation, gzip_level = gzip_level,
+                                                   gzip_threads = gzip_threads, gzip_index = gzip_index,
+                                                   sop_classes = sop_classes )
+        except Exception, e:
+            _module_logger.warning('Cannot convert with dcmstack, falling back to dcm2nii: ' + str(e))
+    elif engine != 'dcm2nii':
+        raise ValueError('Unknown conversion engine ' + str(engine))
+
     # check dcm2nii executable 
     cmd = _find_executable('dcm2nii')
     if not cmd:
         raise OSError('dcm2nii command cannot be found in system path.')
         
-    # from nipype import config
-    # cfg = dict(logging=dict(workflow_level = 'NOTSET'))
-    # config.update_config(cfg)
-    from nipype.interfaces.dcm2nii import Dcm2nii # this might create another logging handler. 
-
     if not _os.path.isdir(output_dir):
         try:
             _os.makedirs(output_dir)
@@ -370,76 +1083,70 @@ def convert_one_sequence( dicom_files, output_dir, tmp_dir = None, prefix = None
     
     _module_logger.info('%d dicoms in this sequence' % (len(dicom_files)))
     
-    # Instantiate a new Dcm2nii converter
-    converter = Dcm2nii()
-
     # Check if input dicom is of enhance format and is PCASL.
     # Need special care for Philips Enhance PCASL
-    if isinstance( dicom_files, list):
-        # TODO 20161011: should check all dicom files
-        is_enhanced_dcm = [is_enhanced(dicom.read_file(f, stop_before_pixels=True)) for f in dicom_files]
-        is_enhanced_dcm = any(is_enhanced_dcm)
-        ds = dicom.read_file(dicom_files[0], stop_before_pixels=True)
-    elif isinstance( dicom_files, str):
-        ds = dicom.read_file(dicom_files, stop_before_pixels=True)
+    if isinstance( dicom_files, str):
         dicom_files = [dicom_files]
-        is_enhanced_dcm = is_enhanced( ds )
+    ds = read_header(dicom_files[0])
+    if sop_classes is None:
+        sop_classes = get_sop_classes( dicom_files )
+    is_enhanced_dcm = ENHANCED_MR_IMAGE_STORAGE in sop_classes
 
     sequence_info = get_sequence_info( ds )
 
     # If Enhanced, unenhance it first
     if is_enhanced_dcm:        
         _module_logger.warning('The input dicom is of enhanced type and needs special care.')
-        dicom_files_classic = []
-        for count, enhanced_dcm in enumerate(dicom_files):
-            prefix_classic = '%s_%s_' % (sequence_info, count)
-            classic_output_dir = _os.path.join(tmp_dir, sequence_info)
+        classic_output_dir = _os.path.join(tmp_dir, sequence_info)
+        if not _os.path.isdir(classic_output_dir):
+            _os.makedirs(classic_output_dir)
+
+        def _unenhance( (count, enhanced_dcm) ):
+            # the prefix of each file is unique, so that the splits can run concurrently
             try:
-                dcm_classic = convert_enhance_to_classic( enhanced_dcm, output_dir = classic_output_dir, 
-                                                          prefix = prefix_classic )
+                return convert_enhance_to_classic( enhanced_dcm, output_dir = classic_output_dir,
+                                                   prefix = '%s_%s_' % (sequence_info, count) )
             except:
                 _tb.print_exception(_sys.exc_info()[0],
                                     _sys.exc_info()[1],
                                     _sys.exc_info()[2])
-                continue
-            dicom_files_classic = dicom_files_classic + dcm_classic
+                return []
+
+        if len(dicom_files) > 1:
+            import multiprocessing as _mp
+            from multiprocessing.pool import ThreadPool as _ThreadPool
+            pool = _ThreadPool(min(_mp.cpu_count(), len(dicom_files)))
+            try:
+                dcms_classic = pool.map(_unenhance, enumerate(dicom_files))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            dcms_classic = map(_unenhance, enumerate(dicom_files))
+        dicom_files_classic = [dcm for dcm_classic in dcms_classic for dcm in dcm_classic]
             
         dicom_files = dicom_files_classic
-        converter.inputs.convert_all_pars = True
 
     _module_logger.debug(str(len(dicom_files)) + ' dicoms in this sequence')
 
-    if len(dicom_files) == 1:
-        # convert only the given file, not every files in the directory
-        # this is a work-around to address the issue that Dcm2nii will only
-        # take the first file in the dicom_files
-        converter.inputs.convert_all_pars = False
-
-    converter.inputs.source_names = dicom_files
-    converter.inputs.output_dir = tmp_dir
-    converter.inputs.gzip_output= True
-    converter.inputs.ignore_exception = True
-    converter.inputs.date_in_filename = False
-    converter.inputs.anonymize = False
-    converter.inputs.reorient = False
+    # convert only the given file, not every files in the directory
+    # this is a work-around to address the issue that Dcm2nii will only
+    # take the first file in the dicom_files
+    convert_all_pars = len(dicom_files) != 1
+
+    # dcm2nii output is already LAS: it is moved as is and can be compressed by dcm2nii.
+    # Otherwise it is reoriented and compressed once when saved, so keep the intermediate
+    # image uncompressed (nibabel also memory-maps it instead of decompressing it).
+    gzip_output = (orientation == 'LAS')
     # check if default user dcm2nii config file exists
     default_config_file = _os.path.join( _os.path.expanduser('~'), '.dcm2nii', 'dcm2nii.ini' )
-    if _os.path.exists(default_config_file):
-        converter.inputs.config_file = default_config_file
-    
-    if kwargs.has_key('terminal_output'):
-        converter.inputs.terminal_output = kwargs.get('terminal_output')
-    elif _log.getLogger().getEffectiveLevel() > 10:
-        converter.inputs.terminal_output = 'allatonce'
-    elif _log.getLogger().getEffectiveLevel() == 10: # DEBUG mode
-        converter.inputs.terminal_output = 'stream'
-        
-
-    # DEBUG/VERBOSE
-    _module_logger.debug('dcm2nii command:\n' + converter.cmdline)
+    if not _os.path.exists(default_config_file):
+        default_config_file = None
 
     try:
-        converter.run()
+        converter = run_dcm2nii( dicom_files, tmp_dir, gzip_output = gzip_output,
+                                 convert_all_pars = convert_all_pars, config_file = default_config_file,
+                                 cmd = cmd )
     except Exception, e:
         _tb.print_exception(_sys.exc_info()[0], _sys.exc_info()[1], _sys.exc_info()[2])
         if to_remove_tmpdir:
@@ -455,9 +1162,9 @@ def convert_one_sequence( dicom_files, output_dir, tmp_dir = None, prefix = None
     # Extract a prefix if not supplied
     if prefix is None:
         if isinstance( dicom_files, list):
-            ds = dicom.read_file(dicom_files[0], stop_before_pixels=True)
+            ds = read_header(dicom_files[0])
         elif isinstance( dicom_files, str):
-            ds = dicom.read_file(dicom_files, stop_before_pixels=True)
+            ds = read_header(dicom_files)
         sequence_info = get_sequence_info( ds )
         subject_id = get_subject_id( ds )
         prefix = '%s_%s' % (subject_id, sequence_info)
@@ -555,7 +1262,7 @@ def convert_one_sequence( dicom_files, output_dir, tmp_dir = None, prefix = None
                 # if there are bval and bvec and files don't exist, try another file with prefix "x"
                 # this would be the case when converted DWI image contains extra direction/4th dimension image
                 # dcm2nii would cut the extra direction in the text files and in the converted DWI Nifti image
-                # However, the nipype.interfaces.dcm2nii converter would still place the original bval/bvec in
+                # However, the dcm2nii output still reports the original bval/bvec, which are placed in
                 # the converter.bvals and bvecs.
                 head, tail = _os.path.split(bval_filename[0][1])
                 alt_bval_filename = _os.path.join(head, 'x' + tail)
@@ -586,22 +1293,32 @@ def convert_one_sequence( dicom_files, output_dir, tmp_dir = None, prefix = None
         else:
             # reorient the image and bvec if any is associated
             import numpy as _np
-            from orientation import reorient_nifti_and_bvec
+            from orientation import reorient_nifti_and_bvec, reorient_nifti_file
+            from parallel_gzip import save_nifti
             
-            nii_orig = nib.load(converter.output_files[i])
+            bvec_orig = _np.loadtxt(bvec_filename[0][1]) if bvec_filename else None
+            if stream:
+                bvec_reoriented = reorient_nifti_file(converter.output_files[i], output_renamed,
+                                                      orientation = orientation, bvec = bvec_orig,
+                                                      gzip_level = gzip_level, gzip_threads = gzip_threads,
+                                                      gzip_index = gzip_index)
+            else:
+                nii_orig = nib.load(converter.output_files[i])
+                if bvec_filename:
+                    nii_reoriented, bvec_reoriented = reorient_nifti_and_bvec(nii_orig,
+                                                                              orientation = orientation,
+                                                                              bvec = bvec_orig)
+                else:
+                    nii_reoriented = reorient_nifti_and_bvec(nii_orig,
+                                                             orientation = orientation)
+                # the image data may still be read lazily from the intermediate file
+                save_nifti(nii_reoriented, output_renamed, level = gzip_level, threads = gzip_threads,
+                           index = gzip_index)
+            _os.remove(converter.output_files[i])
             if bvec_filename:
-                bvec_orig = _np.loadtxt(bvec_filename[0][1])
-                nii_reoriented, bvec_reoriented = reorient_nifti_and_bvec(nii_orig,
-                                                                          orientation = orientation,
-                                                                          bvec = bvec_orig)
                 _np.savetxt(bvec_renamed, bvec_reoriented, delimiter = ' ')
                 _os.remove(bvec_filename[0][1])
                 converter.bvecs[ bvec_filename[0][0] ] = bvec_renamed
-            else:
-                nii_reoriented = reorient_nifti_and_bvec(nii_orig,
-                                                         orientation = orientation)
-            _os.remove(converter.output_files[i])
-            nii_reoriented.to_filename(output_renamed)
             
         converter.output_files[i] = output_renamed
 
@@ -625,7 +1342,7 @@ def convert_enhance_to_classic(src_dcm, output_dir = None, prefix = None):
         :type output_dir: str
         :param prefix: A string as a prefix for output unenhanced files.
         :type prefix: str
-        :returns: A list of unenhanced dicoms.
+        :returns: A list of unenhanced dicoms, the files in output_dir starting with prefix.
     '''
     _module_logger.debug('received a call to convert_enhance_to_classic')    
     # check dcuncat executable
@@ -651,13 +1368,227 @@ def convert_enhance_to_classic(src_dcm, output_dir = None, prefix = None):
 
     cmd = [cmd, '-unenhance', '-of', _os.path.join(output_dir, prefix), src_dcm]
     stdout, stderr = _subp.Popen(cmd, stdout = _subp.PIPE, stderr = _subp.PIPE).communicate()
-    src_dcms_classic = discover_files(output_dir)
+    src_dcms_classic = [f for f in discover_files(output_dir) if _os.path.basename(f).startswith(prefix)]
 
     return src_dcms_classic
 
+# Uncompressed transfer syntaxes: implicit VR little endian, explicit VR little/big endian
+_UNCOMPRESSED_TRANSFER_SYNTAXES = ('1.2.840.10008.1.2', '1.2.840.10008.1.2.1', '1.2.840.10008.1.2.2')
+
+def split_enhanced_dicom( dcm_ds ):
+    ''' Split an enhanced (multi-frame) dicom into classic single-frame datasets in memory, without
+        dcuncat. The shared and per-frame functional groups are flattened into each frame, so that every
+        frame has its own ImagePositionPatient, ImageOrientationPatient, PixelSpacing, rescaling,
+        TemporalPositionIndex... Only uncompressed pixel data can be split.
+
+        :param dcm_ds: An enhanced dicom read with its pixel data.
+        :type dcm_ds: dicom.dataset.FileDataset
+        :returns: A list of :class:`dicom.dataset.Dataset`, one per frame.
+    '''
+    _module_logger.debug('received a call to split_enhanced_dicom')
+    import copy as _copy
+
+    if hasattr(dcm_ds, 'file_meta'):
+        file_meta = dcm_ds.file_meta
+    else:
+        file_meta = dicom.dataset.Dataset()
+    transfer_syntax = file_meta.get('TransferSyntaxUID', _UNCOMPRESSED_TRANSFER_SYNTAXES[0])
+    if transfer_syntax not in _UNCOMPRESSED_TRANSFER_SYNTAXES:
+        raise NotImplementedError('Cannot split compressed pixel data (transfer syntax %s).' % transfer_syntax)
+
+    multiframe_tags = [dicom.datadict.tag_for_name(name) for name in ('PerFrameFunctionalGroupsSequence',
+                                                                      'SharedFunctionalGroupsSequence',
+                                                                      'NumberOfFrames',
+                                                                      'PixelData')]
+    nframes = int(dcm_ds.NumberOfFrames)
+    frame_bytes = (int(dcm_ds.Rows) * int(dcm_ds.Columns) * int(dcm_ds.get('SamplesPerPixel', 1)) *
+                   int(dcm_ds.BitsAllocated) // 8)
+    pixel_data = dcm_ds.PixelData
+    if len(pixel_data) < nframes * frame_bytes:
+        raise ValueError('Pixel data is shorter than %d frames.' % nframes)
+    if 'SharedFunctionalGroupsSequence' in dcm_ds:
+        shared_groups = dcm_ds.SharedFunctionalGroupsSequence[0]
+    else:
+        shared_groups = None
+    per_frame_groups = dcm_ds.PerFrameFunctionalGroupsSequence
+
+    frames = []
+    for i in xrange(nframes):
+        # elements are copied so that frames can be modified independently
+        frame_ds = dicom.dataset.Dataset()
+        for elem in dcm_ds:
+            if elem.tag not in multiframe_tags:
+                frame_ds.add(_copy.copy(elem))
+        for groups in (shared_groups, per_frame_groups[i]):
+            if groups is None:
+                continue
+            for macro in groups:
+                if macro.VR == 'SQ':
+                    if len(macro.value) > 0:
+                        for elem in macro.value[0]:
+                            frame_ds.add(_copy.copy(elem))
+                else:
+                    frame_ds.add(_copy.copy(macro))
+        if 'SOPClassUID' in frame_ds and frame_ds.SOPClassUID == ENHANCED_MR_IMAGE_STORAGE:
+            frame_ds.SOPClassUID = MR_IMAGE_STORAGE
+        if 'EchoTime' not in frame_ds and 'EffectiveEchoTime' in frame_ds:
+            frame_ds.EchoTime = frame_ds.EffectiveEchoTime
+        frame_ds.InstanceNumber = i + 1
+        frame_ds.add_new(multiframe_tags[3], dcm_ds.data_element('PixelData').VR,
+                         pixel_data[i * frame_bytes:(i + 1) * frame_bytes])
+        # pixel_array needs the transfer syntax of the file meta
+        frame_ds.file_meta = _copy.deepcopy(file_meta)
+        frame_ds.file_meta.TransferSyntaxUID = transfer_syntax
+        if 'MediaStorageSOPClassUID' in frame_ds.file_meta and 'SOPClassUID' in frame_ds:
+            frame_ds.file_meta.MediaStorageSOPClassUID = frame_ds.SOPClassUID
+        frame_ds.is_little_endian = transfer_syntax != '1.2.840.10008.1.2.2'
+        frame_ds.is_implicit_VR = transfer_syntax == '1.2.840.10008.1.2'
+        frames.append(frame_ds)
+    return frames
+
+def _convert_one_group( src_dcms, output_dir, log = None, tmp_dir = None, orientation = 'LPS', mode = 'symbolic',
+                        force = False, engine = 'dcm2nii', own_tmp_dir = False, atomic = False,
+                        series_fingerprint = None, log_backend = 'csv', conversion_state = None,
+                        log_buffer = None, **kwargs ):
+    ''' Sort, convert and log the dicoms of one sequence for :func:`convert_one_directory`. If own_tmp_dir
+        is True, the conversion runs in a new sub-directory of tmp_dir so that it can run concurrently
+        with other sequences. Log updates are serialized between threads. If series_fingerprint is given
+        (see :func:`get_series_fingerprint`), it decides whether the sequence is converted instead of the
+        log, and it is stored as <prefix>.fingerprint next to the nifti output. conversion_state is a
+        :class:`dicom2nifti.logger.ConversionState` of log shared by the sequences of a run. If log_buffer (a
+        :class:`dicom2nifti.logger.LogBuffer` of log) is given, the outcome is logged to it instead.
+    '''
+    dicom_output_dir = _os.path.join(output_dir, 'dicoms')
+    nifti_output_dir = _os.path.join(output_dir, 'Nifti')
+
+    #sequence = sequence.replace(' ', '_').replace('/','_').replace('(','').replace(')','').replace('*', '').replace('&', '').replace('$', '').replace(':', '.')
+    tmp_ds = read_header(src_dcms[0])
+    sequence = get_sequence_info(tmp_ds)
+    subject_id = get_subject_id(tmp_ds)
+
+    _module_logger.info('Working on %s %s' % (subject_id, sequence))
+    subject_sequence_dicom_dir = _os.path.join(dicom_output_dir, subject_id, sequence)
+    subject_nifti_dir = _os.path.join(nifti_output_dir, subject_id)
+    prefix = '%s_%s' % (subject_id, sequence)
+
+    ## query if the inputs of the sequence changed since its last conversion
+    if series_fingerprint is not None:
+        fingerprint_file = _os.path.join(subject_nifti_dir, prefix + '.fingerprint')
+        if not force and _os.path.exists(_os.path.join(subject_nifti_dir, prefix + '.nii.gz')):
+            try:
+                with open(fingerprint_file, 'r') as fp:
+                    if fp.read().strip() == series_fingerprint:
+                        _module_logger.warning('%s %s already converted and unchanged' % (subject_id, sequence))
+                        return
+            except IOError:
+                pass
+        # the outputs are about to change: a stale fingerprint must not survive a failure
+        if _os.path.exists(fingerprint_file):
+            _os.remove(fingerprint_file)
+
+    def log_outcome(**kwargs):
+        with _log_lock:
+            if log_buffer is not None:
+                log_buffer.log(subject_id, sequence, **kwargs)
+            else:
+                logger.log_tofile(log, subject_id, sequence, backend = log_backend, state = conversion_state,
+                                  **kwargs)
+
+    ## query if nifti files of the given sequence and subect_id exists
+    ## in the log and in the filesystem
+    if log:
+        import logger
+        import lockfile # This is the API in 0.8.0, in 0.9.1, it's LockFile, in 2.0.5 it's filelock
+        if not force and series_fingerprint is None:
+            if conversion_state is None:
+                conversion_state = logger.ConversionState(log, backend = log_backend)
+            try:
+                ## only reads what other writers changed since the previous sequence
+                with _log_lock:
+                    conversion_state.refresh()
+                    isconverted = conversion_state.is_converted(subject_id, sequence)
+                if isconverted:
+                    _module_logger.warning('%s %s already converted' % (subject_id, sequence))
+                    return
+            except lockfile.LockTimeout:
+                # another writer holds the log: check the log as last loaded, and log this sequence to
+                # the shard of this process, which merge_logs consolidates
+                _module_logger.warning('Lock timeout. Log the entry to the shard of this process.')
+                log_backend = 'shard'
+                with _log_lock:
+                    isconverted = conversion_state.is_converted(subject_id, sequence)
+                if isconverted:
+                    _module_logger.warning('%s %s already converted' % (subject_id, sequence))
+                    return
+
+    if mode != 'skip':
+        _module_logger.info('Sorting %s %s' % (subject_id, sequence))
+        try:
+            new_dicom_files = organize_one_sequence( src_dcms, subject_sequence_dicom_dir,
+                                                     prefix = prefix, mode = mode, atomic = atomic )
+        except:
+            _module_logger.error('Error occurred when sorting %s %s:' % (subject_id, sequence))
+            _tb.print_exception(_sys.exc_info()[0], _sys.exc_info()[1], _sys.exc_info()[2])
+            new_dicom_files = src_dcms # this will definitely be unused
+            if log:
+                log_outcome(msg = 'SORT_FAILED')
+            return
+    else:
+        new_dicom_files = src_dcms
+
+    if own_tmp_dir:
+        series_tmp_dir = _tmp.mkdtemp(prefix = '%s_' % prefix, dir = tmp_dir)
+    else:
+        series_tmp_dir = tmp_dir
+
+    # Check if the filename is longer than 255, the limit dcm2nii has.
+    if len(new_dicom_files[0]) >= 255 and len(src_dcms[0]) < 255:
+        new_dicom_files = src_dcms
+    elif len(new_dicom_files[0]) >= 255 and len(src_dcms[0]) >= 255:
+        tmp_sequence_dir = _os.path.join(series_tmp_dir, subject_id, sequence)
+        _os.makedirs(tmp_sequence_dir)
+        [_os.symlink(src_dcms[i], _os.path.join(tmp_sequence_dir, '%s.dcm' % (i))) for i in xrange(len(src_dcms))]
+        new_dicom_files = discover_files(tmp_sequence_dir)
+
+    _module_logger.info('Converting %s %s' % (subject_id, sequence))
+    try:
+        converter = convert_one_sequence( new_dicom_files, subject_nifti_dir,
+                                          prefix = prefix,
+                                          orientation = orientation,
+                                          tmp_dir = series_tmp_dir,
+                                          engine = engine,
+                                          **kwargs)
+    except:
+        _module_logger.error('Error occurred when converting %s %s:' % (subject_id, sequence))
+        _tb.print_exception(_sys.exc_info()[0], _sys.exc_info()[1], _sys.exc_info()[2])
+        if log:
+            log_outcome(msg = 'CONVERT_FAILED')
+        return
+    finally:
+        if own_tmp_dir:
+            _shutil.rmtree(series_tmp_dir, ignore_errors = True)
+
+    if series_fingerprint is not None and converter.output_files:
+        with open(fingerprint_file + '.tmp', 'w') as fp:
+            fp.write(series_fingerprint + '\n')
+        _os.rename(fingerprint_file + '.tmp', fingerprint_file)
+
+    # log it!
+    # TODO: what about multiple outputs?
+    if log:
+        if len(converter.output_files) == 1:
+            log_outcome(nifti_path = converter.output_files[0])
+        elif len(converter.output_files) > 1:
+            log_outcome(msg = ' '.join(converter.output_files))
+        else:
+            log_outcome(msg = 'NA')
+
 def convert_one_directory( input_dir, output_dir, log = None, tmp_dir = None, keyword = None, exclude = None,
                            recursive = True, orientation = 'LPS', mode = 'symbolic', force = False,
-                           group_by = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription'], **kwargs):
+                           group_by = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription'],
+                           sniff = True, header_index = None, jobs = 1, partial = False, compact = False,
+                           prefilter = False, engine = 'dcm2nii', atomic = False, fingerprint = False,
+                           log_backend = 'csv', log_batch = 0, **kwargs):
     ''' Finds all dicoms recursively in a given directory, parse_and_group them, filter the sequences
         with include and exclude keywords, get grouped dicoms for each sequence, call 
         :func:`dicom2nifti.convert_one_sequence` in a loop to convert dicoms to nifti images (as nii.gz format). This 
@@ -677,23 +1608,56 @@ def convert_one_directory( input_dir, output_dir, log = None, tmp_dir = None, ke
         :type recursive: boolean
         :param orientation:  A string of orientation. Default is 'LPS' (CBICA convention.)
         :type orientation: str
-        :param mode: {'symbolic', 'copy', 'move', 'skip'}.
+        :param mode: {'symbolic', 'hardlink', 'reflink', 'copy', 'move', 'skip'}. See :func:`organize_one_sequence`.
         :type mode: str
         :param force: Force sorting and converting even if the sequence exists in the log file and overwrite.
         :type mode: boolean
         :param group_by:  A list of case sensitive search dicom tag names to group dicoms.
         :type group_by: str or list of strings
-        :param kwargs: Additional keyword arguments for :class:`nipype.interfaces.dcm2nii.Dcm2nii` object.
+        :param sniff:  If True, skip files that do not look like dicoms before grouping. Default is True.
+        :type sniff: boolean
+        :param header_index:  A SQLite filepath to keep dicom header fields between runs, so that only new or
+                              changed files are parsed when grouping. See :class:`dicom2nifti.header_index.HeaderIndex`.
+        :type header_index: str
+        :param jobs:  Number of parallel workers, used to read the dicom headers and to sort and convert
+                      the sequences concurrently. Default is 1.
+        :type jobs: int
+        :param partial:  If True, group dicoms by reading only the few fields needed from each header.
+                         See :func:`dicom2nifti.get_all_dicom_groups`.
+        :type partial: boolean
+        :param compact:  If True, keep only a :class:`dicom2nifti.DicomRecord` per file while grouping
+                         instead of the whole headers. Use it for very large directories.
+        :type compact: boolean
+        :param prefilter:  If True, select the sequences with keyword/exclude from a cheap read of the group_by tags
+                           before grouping, so that only the dicoms of the selected sequences are fully parsed.
+                           See :func:`dicom2nifti.filter_dicoms_by_sequence`.
+        :type prefilter: boolean
+        :param engine:  {'dcm2nii', 'dcmstack'}. See :func:`dicom2nifti.convert_one_sequence`. Default is 'dcm2nii'.
+        :type engine: str
+        :param atomic:  If True, build each sorted series in a staging directory and link it into place.
+                        See :func:`dicom2nifti.organize_one_sequence`.
+        :type atomic: boolean
+        :param fingerprint:  If True, reconvert exactly the sequences whose inputs changed since their last conversion,
+                             whatever the log says, by comparing their fingerprints (see
+                             :func:`dicom2nifti.get_series_fingerprint`) with the ones stored next to the outputs.
+        :type fingerprint: boolean
+        :param log_backend:  {'csv', 'journal', 'shard'}. 'journal' appends each log update to <log>.journal instead of
+                             rewriting the whole CSV, 'shard' appends it to a file of this process without locking the
+                             log. See :func:`dicom2nifti.logger.log_tofile`. Default is 'csv'.
+        :type log_backend: str
+        :param log_batch:  If greater than 0, write the log in batches of log_batch sequences and at the end, under a single
+                           lock, instead of once per sequence. See :class:`dicom2nifti.logger.LogBuffer`. Default is 0.
+        :type log_batch: int
+        :param kwargs: Additional keyword arguments for :func:`dicom2nifti.convert_one_sequence`, e.g. gzip_level,
+                       gzip_threads, gzip_index and stream.
     '''
-    _module_logger.debug('received a call to convert_one_directory')      
+    _module_logger.debug('received a call to convert_one_directory')
     # check dcm2nii executable
-    from distutils.spawn import find_executable   
     cmd = _find_executable('dcm2nii')
-    if not cmd:
+    if not cmd and engine == 'dcm2nii':
         raise OSError('dcm2nii command cannot be found in system path.')
-        
-    dicom_output_dir = _os.path.join(output_dir, 'dicoms')
-    nifti_output_dir = _os.path.join(output_dir, 'Nifti')
+    elif not cmd:
+        _module_logger.warning('dcm2nii command cannot be found in system path. Sequences that dcmstack cannot convert will fail.')
     
     ## Create a tmpdir
     if not tmp_dir:       
@@ -705,11 +1669,24 @@ def convert_one_directory( input_dir, output_dir, log = None, tmp_dir = None, ke
         to_remove_tmpdir = False
 
     _module_logger.info('Crawling the input directory to find dicoms')
-    src_dcms = discover_files( input_dir, recursive = recursive )
+    src_dcms = discover_files( input_dir, recursive = recursive, sniff = sniff )
     _module_logger.info('%d dicoms found.' % (len(src_dcms)))
     
+    if prefilter and (keyword or exclude):
+        _module_logger.info('Selecting dicoms of sequences with search keyword = %s and exclude keyword = %s' % (str(keyword), str(exclude)))
+        src_dcms = filter_dicoms_by_sequence( src_dcms, group_by = group_by, keyword = keyword,
+                                              exclude = exclude, jobs = jobs )
+        _module_logger.info('%d dicoms selected.' % (len(src_dcms)))
+
     _module_logger.info('Grouping dicoms. It might take a while...')
-    dcm_groups = get_all_dicom_groups( src_dcms, group_by = group_by )
+    if header_index:
+        from header_index import HeaderIndex
+        with HeaderIndex(header_index) as index:
+            dcm_groups = get_all_dicom_groups( src_dcms, group_by = group_by, header_index = index,
+                                               jobs = jobs, compact = compact )
+    else:
+        dcm_groups = get_all_dicom_groups( src_dcms, group_by = group_by, jobs = jobs, partial = partial,
+                                           compact = compact )
 
     _module_logger.info('Sequences found %s:' % (group_by))
     for k in dcm_groups.iterkeys():
@@ -717,97 +1694,59 @@ def convert_one_directory( input_dir, output_dir, log = None, tmp_dir = None, ke
     _module_logger.info('Filtering dicoms based on:\nSearch keyword = %s\nExclude keyword = %s' % (str(keyword), str(exclude)))
     dcm_selected_groups = get_all_dicoms_from_sequences( dcm_groups,
                                 keyword = keyword, exclude = exclude)
-    ## recycle the memory
-    dcm_groups = None
-    del dcm_groups
-    
-    for key, src_dcms in dcm_selected_groups.iteritems():
-        #sequence = sequence.replace(' ', '_').replace('/','_').replace('(','').replace(')','').replace('*', '').replace('&', '').replace('$', '').replace(':', '.')
-        tmp_ds = dicom.read_file(src_dcms[0], stop_before_pixels=True)
-        sequence = get_sequence_info(tmp_ds)
-        subject_id = get_subject_id(tmp_ds)
-
-        _module_logger.info('Working on %s %s' % (subject_id, sequence))
-        ## query if nifti files of the given sequence and subect_id exists
-        ## in the log and in the filesystem
-        if log:
-            import pandas as _pd
-            import logger
-            import lockfile # This is the API in 0.8.0, in 0.9.1, it's LockFile, in 2.0.5 it's filelock
-            lock = lockfile.FileLock(log)
-            lock.timeout = 3600
-            if not force:
-                try:
-                    with lock: ## argument poll_intervall not available in this version of lockfile
-                        if _os.path.exists(log):
-                            df_nifti_log = _pd.read_csv(log, index_col = 0)
-                            isconverted = logger.is_converted(df_nifti_log, subject_id, sequence)
-                            if isconverted:
-                                _module_logger.warning('%s %s already converted' % (subject_id, sequence))
-                                continue
-                except lockfile.LockTimeout:
-                    # Create an new, unique CSV for this routine
-                    # If a lock cannot be acquired, log it in Nifti subject directory instead
-                    log = _os.path.join(nifti_output_dir, subject_id, subject_id + '.csv')
-                    _module_logger.warning('Lock timeout. Log the entry to ' + log)
-                    if _os.path.exists(log):
-                        df_nifti_log = _pd.read_csv(log, index_col = 0)
-                        isconverted = logger.is_converted(df_nifti_log, subject_id, sequence)
-                        if isconverted:
-                            _module_logger.warning('%s %s already converted' % (subject_id, sequence))
-                            continue
-        
-        subject_sequence_dicom_dir = _os.path.join(dicom_output_dir, subject_id, sequence)
-        subject_nifti_dir = _os.path.join(nifti_output_dir, subject_id)
-        prefix = '%s_%s' % (subject_id, sequence)
 
-        if mode != 'skip':
-            _module_logger.info('Sorting %s %s' % (subject_id, sequence))
+    ## load the log once for the already converted checks of all the sequences
+    conversion_state = None
+    log_buffer = None
+    if log:
+        import logger
+        if not force and not fingerprint:
+            conversion_state = logger.ConversionState(log, backend = log_backend)
+        if log_batch > 0:
+            log_buffer = logger.LogBuffer(log, batch_size = log_batch, backend = log_backend)
+    
+    try:
+        ## keep the SOP classes captured when grouping, and the headers already parsed for naming the sequences
+        sop_classes = {}
+        fingerprints = {}
+        for key in dcm_selected_groups.iterkeys():
+            sop_classes[key] = get_sop_classes(dcm_groups[key])
+            fingerprints[key] = get_series_fingerprint(dcm_groups[key]) if fingerprint else None
+            dcm_item = dcm_groups[key][0]
+            if not isinstance(dcm_item, DicomRecord) and dcm_item[0] is not None:
+                _header_cache.add(dcm_item[2], _strip_pixel_data(dcm_item[0]))
+        ## recycle the memory
+        dcm_groups = None
+        del dcm_groups
+
+        if jobs > 1 and len(dcm_selected_groups) > 1:
+            # series are independent: sort and convert them in a pool of threads. The work is mostly
+            # done by dcm2nii processes and file IO, which do not hold the GIL.
+            from multiprocessing.pool import ThreadPool as _ThreadPool
+            pool = _ThreadPool(min(jobs, len(dcm_selected_groups)))
             try:
-                new_dicom_files = organize_one_sequence( src_dcms, subject_sequence_dicom_dir,
-                                                         prefix = prefix, mode = mode )
-            except:
-                _module_logger.error('Error occurred when sorting %s %s:' % (subject_id, sequence))
-                _tb.print_exception(_sys.exc_info()[0], _sys.exc_info()[1], _sys.exc_info()[2])
-                new_dicom_files = src_dcms # this will definitely be unused
-                if log:
-                    logger.log_tofile(log, subject_id, sequence, msg = 'SORT_FAILED')
-                continue                
+                pool.map(lambda key: _convert_one_group( dcm_selected_groups[key], output_dir, log = log,
+                                                         tmp_dir = tmp_dir, orientation = orientation, mode = mode,
+                                                         force = force, engine = engine, own_tmp_dir = True,
+                                                         atomic = atomic, series_fingerprint = fingerprints[key],
+                                                         log_backend = log_backend, conversion_state = conversion_state,
+                                                         log_buffer = log_buffer, sop_classes = sop_classes[key], **kwargs),
+                         dcm_selected_groups.keys())
+            finally:
+                pool.close()
+                pool.join()
         else:
-            new_dicom_files = src_dcms
-
-        # Check if the filename is longer than 255, the limit dcm2nii has.
-        if len(new_dicom_files[0]) >= 255 and len(src_dcms[0]) < 255:
-            new_dicom_files = src_dcms
-        elif len(new_dicom_files[0]) >= 255 and len(src_dcms[0]) >= 255:
-            tmp_sequence_dir = _os.path.join(tmp_dir, subject_id, sequence)
-            _os.makedirs(tmp_sequence_dir)
-            [_os.symlink(src_dcms[i], _os.path.join(tmp_sequence_dir, '%s.dcm' % (i))) for i in len(src_dcms)]
-            new_dicom_files = discover_files(tmp_sequence_dir)
-
-        _module_logger.info('Converting %s %s' % (subject_id, sequence))
-        try:
-            converter = convert_one_sequence( new_dicom_files, subject_nifti_dir,
-                                              prefix = prefix,
-                                              orientation = orientation,
-                                              tmp_dir = tmp_dir,
-                                              **kwargs)
-        except:
-            _module_logger.error('Error occurred when converting %s %s:' % (subject_id, sequence))
-            _tb.print_exception(_sys.exc_info()[0], _sys.exc_info()[1], _sys.exc_info()[2])
-            if log:
-                logger.log_tofile(log, subject_id, sequence, msg = 'CONVERT_FAILED')
-            continue
-
-        # log it!
-        # TODO: what about multiple outputs?
-        if log:
-            if len(converter.output_files) == 1:
-                logger.log_tofile(log, subject_id, sequence, nifti_path = converter.output_files[0])
-            elif len(converter.output_files) > 1:
-                logger.log_tofile(log, subject_id, sequence, msg = ' '.join(converter.output_files))
-            else:
-                logger.log_tofile(log, subject_id, sequence, msg = 'NA')
+            for key, src_dcms in dcm_selected_groups.iteritems():
+                _convert_one_group( src_dcms, output_dir, log = log, tmp_dir = tmp_dir,
+                                    orientation = orientation, mode = mode, force = force,
+                                    engine = engine, atomic = atomic, series_fingerprint = fingerprints[key],
+                                    log_backend = log_backend, conversion_state = conversion_state,
+                                    log_buffer = log_buffer, sop_classes = sop_classes[key], **kwargs )
+    finally:
+        # commit the log entries still buffered, whatever happened
+        if log_buffer is not None:
+            log_buffer.close()
+        _header_cache.clear()
 
     if to_remove_tmpdir:
         _shutil.rmtree(tmp_dir)
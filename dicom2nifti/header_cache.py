@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+
+import os as _os
+import logging as _log
+import threading as _threading
+from collections import OrderedDict as _OrderedDict
+
+import dicom
+
+_module_logger = _log.getLogger(__name__)
+_ch = _log.StreamHandler()
+_formatter = _log.Formatter(fmt = '%(asctime)s %(name)s %(levelname)s: %(message)s',
+                            datefmt = '%Y%m%d-%H:%M:%S')
+_ch.setFormatter(_formatter)
+_module_logger.addHandler(_ch)
+
+class HeaderCache(object):
+    ''' A bounded cache of dicom headers read with :func:`dicom.read_file` (without pixel data).
+        Headers are keyed by the real path of the file, so a sorted symbolic link and its source
+        share one entry, and an entry is discarded when the mtime of the file changes. The least
+        recently used header is evicted when the cache is full. The cache can be shared between
+        threads. Cached datasets are shared and must not be modified.
+
+        :param maxsize: Maximum number of headers kept in memory.
+        :type maxsize: int
+    '''
+
+    def __init__(self, maxsize = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._headers = _OrderedDict()
+        self._lock = _threading.Lock()
+
+    def __len__(self):
+        return len(self._headers)
+
+    def read(self, filepath):
+        ''' Return the header of a dicom file, reading it from disk only if it is not cached or
+            has changed.
+
+            :param filepath: A dicom filepath.
+            :type filepath: str
+            :returns: A :class:`dicom.dataset.FileDataset` without pixel data.
+        '''
+        path = _os.path.realpath(filepath)
+        mtime = _os.stat(path).st_mtime
+        with self._lock:
+            entry = self._headers.pop(path, None)
+            if entry is not None and entry[0] == mtime:
+                self._headers[path] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        dcm_ds = dicom.read_file(path, stop_before_pixels=True)
+        self._insert(path, mtime, dcm_ds)
+        return dcm_ds
+
+    def add(self, filepath, dcm_ds):
+        ''' Put a header that was already read elsewhere (e.g. while grouping) into the cache.
+
+            :param filepath: A dicom filepath.
+            :type filepath: str
+            :param dcm_ds: The header of filepath.
+            :type dcm_ds: dicom.dataset.FileDataset
+        '''
+        path = _os.path.realpath(filepath)
+        self._insert(path, _os.stat(path).st_mtime, dcm_ds)
+
+    def clear(self):
+        ''' Remove all the headers from the cache. '''
+        with self._lock:
+            _module_logger.debug('header cache: %d hits, %d misses' % (self.hits, self.misses))
+            self._headers.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _insert(self, path, mtime, dcm_ds):
+        with self._lock:
+            self._headers.pop(path, None)
+            self._headers[path] = (mtime, dcm_ds)
+            while len(self._headers) > self.maxsize:
+                self._headers.popitem(last = False)
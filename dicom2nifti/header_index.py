@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+
+import os as _os
+import json as _json
+import sqlite3 as _sqlite3
+import logging as _log
+
+_module_logger = _log.getLogger(__name__)
+_ch = _log.StreamHandler()
+_formatter = _log.Formatter(fmt = '%(asctime)s %(name)s %(levelname)s: %(message)s',
+                            datefmt = '%Y%m%d-%H:%M:%S')
+_ch.setFormatter(_formatter)
+_module_logger.addHandler(_ch)
+
+class HeaderIndex(object):
+    ''' A persistent index of dicom header fields stored in a SQLite database. Each file is
+        keyed by its absolute path and validated against its size, mtime and inode, so that
+        a rescan of a directory only needs to parse the files that are new or have changed.
+        Files that could not be parsed are remembered as well and skipped until they change.
+
+        :param filename: The SQLite database filepath. It will be created if it does not exist.
+        :type filename: str
+    '''
+
+    def __init__(self, filename):
+        _module_logger.debug('received a call to HeaderIndex')
+        self.filename = filename
+        self._conn = _sqlite3.connect(filename, timeout = 600)
+        self._conn.text_factory = str
+        with self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS headers (
+                                      path TEXT PRIMARY KEY,
+                                      size INTEGER,
+                                      mtime REAL,
+                                      inode INTEGER,
+                                      fields TEXT)''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        ''' Close the database connection. '''
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def lookup(self, src_dcms, fields):
+        ''' Return the indexed header fields of the given files. A file is stale if it is not in
+            the index, if its size, mtime or inode changed, or if it was indexed without some of
+            the requested fields.
+
+            :param src_dcms: A list of dicom filepaths.
+            :type src_dcms: list
+            :param fields: A list of dicom tag names.
+            :type fields: list
+            :returns: A tuple of (dict mapping filepaths to dicts of header fields or None if the
+                      file is not a dicom, dict mapping stale filepaths to their signatures to be
+                      passed back to :meth:`update`).
+        '''
+        _module_logger.debug('received a call to HeaderIndex.lookup')
+        headers = {}
+        stale = {}
+        cursor = self._conn.cursor()
+        for path in src_dcms:
+            try:
+                st = _os.stat(path)
+            except OSError:
+                continue
+            signature = (st.st_size, st.st_mtime, st.st_ino)
+            row = cursor.execute('SELECT size, mtime, inode, fields FROM headers WHERE path = ?',
+                                 (_os.path.abspath(path),)).fetchone()
+            if row is not None and tuple(row[:3]) == signature:
+                header_fields = _json.loads(row[3])
+                if header_fields is None:
+                    headers[path] = None
+                    continue
+                if all(name in header_fields for name in fields):
+                    headers[path] = _decode_fields(header_fields)
+                    continue
+            stale[path] = signature
+        return headers, stale
+
+    def update(self, headers, signatures):
+        ''' Store the header fields of files in the index.
+
+            :param headers: A dict mapping filepaths to dicts of header fields (or None for files
+                            that are not dicoms).
+            :type headers: dict
+            :param signatures: A dict mapping filepaths to signatures returned by :meth:`lookup`.
+            :type signatures: dict
+        '''
+        _module_logger.debug('received a call to HeaderIndex.update')
+        rows = [(_os.path.abspath(path), signatures[path][0], signatures[path][1],
+                 signatures[path][2], _json.dumps(header_fields))
+                for path, header_fields in headers.iteritems() if path in signatures]
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)', rows)
+
+def _decode_fields(header_fields):
+    ''' Restore the values of header fields after a JSON round trip: lists become tuples again
+        (they are used in hashable group keys) and unicode strings become str when possible.
+    '''
+    decoded = {}
+    for name, value in header_fields.iteritems():
+        if isinstance(value, list):
+            value = tuple(_decode_value(v) for v in value)
+        else:
+            value = _decode_value(value)
+        decoded[str(name)] = value
+    return decoded
+
+def _decode_value(value):
+    if isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            return value
+    return value
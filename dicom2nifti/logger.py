@@ -2,9 +2,16 @@ import logging as _log
 import os as _os
 import sys as _sys
 import traceback as _tb
+import csv as _csv
+import errno as _errno
+import re as _re
+import socket as _socket
+import threading as _threading
+from cStringIO import StringIO as _StringIO
 from datetime import datetime as _dt
 import pandas as pd
 import numpy as _np
+from stat_cache import StatCache as _StatCache
 
 _module_logger = _log.getLogger(__name__)
 _ch = _log.StreamHandler()
@@ -13,6 +20,14 @@ _formatter = _log.Formatter(fmt = '%(asctime)s %(name)s %(levelname)s: %(message
 _ch.setFormatter(_formatter)
 _module_logger.addHandler(_ch) 
 
+LOG_BACKENDS = ['csv', 'journal', 'shard']
+_TIME_FORMAT = '%Y/%m/%d-%H:%M:%S'
+_SHARD_INFIX = '.shard-'
+_WAL_INFIX = '.wal-'
+# <log>_<unique name> CSV written on lock timeouts by earlier versions, where the unique name is that of the
+# lockfile lock: <host>[-<thread id in hex>].<pid><hash of the log path, possibly negative>
+_SIDE_LOG_SUFFIX = r'_[A-Za-z0-9][A-Za-z0-9.-]*\.\d+-?\d+(\.merging)?$'
+
 def is_converted(df, subject_id, sequence):
     ''' Check if a given subject_id and sequence pair has been converted into a nifti image.
         
@@ -39,10 +54,152 @@ def is_converted(df, subject_id, sequence):
     else:
         return False
 
-def log_tofile(filename, subject_id, sequence, **kwargs):
+class ConversionState(object):
+    ''' An in-memory index of a conversion log answering :func:`is_converted` queries without reading the
+        log again. The CSV is loaded once (under the log lock) and only reloaded when other writers change
+        it, and only the entries appended to the journal and the shards since the last :meth:`refresh` are
+        read, so checking many sequences of a run costs a few stats instead of a CSV parse each. Pass the
+        state to :func:`log_tofile` so that the entries of the run update it instead of invalidating it.
+
+        :param filename: A log filepath. Neither the CSV nor the journal has to exist.
+        :type filename: str
+        :param backend: {'csv', 'journal', 'shard'}. If 'csv', the journal and the shards are ignored.
+                        Default is None, which applies them if there are any, like :func:`read_log`.
+        :type backend: str
+    '''
+
+    def __init__(self, filename, backend = None):
+        self.filename = filename
+        self.backend = backend
+        self._entries = {}
+        self._csv_signature = None
+        self._tails = {}
+        self._loaded = False
+        self._lock = _threading.Lock()
+
+    def refresh(self):
+        ''' Bring the index up to date with the log written by other processes. Raise
+            :class:`lockfile.LockTimeout` if the CSV changed and its lock cannot be acquired.
+        '''
+        with self._lock:
+            csv_signature = _signature(self.filename)
+            journals = self._journals()
+            if (not self._loaded or csv_signature != self._csv_signature or
+                    _journals_replaced(journals, self._tails)):
+                self._reload()
+            else:
+                for journal, signature in journals.iteritems():
+                    self._read_tail(journal, signature)
+
+    def is_converted(self, subject_id, sequence):
+        ''' Check if a given subject_id and sequence pair has been converted into a nifti image, like
+            :func:`is_converted` on the log as of the last :meth:`refresh`.
+
+            :param subject_id: A subject identifier.
+            :type subject_id: str
+            :param sequence: A sequence.
+            :type sequence: str
+            :returns: True if a valid nifti file is logged for the pair.
+        '''
+        entry = self._entries.get((subject_id, sequence))
+        if entry is None:
+            return False
+        return _os.path.exists(entry[1])
+
+    def record(self, subject_id, sequence, entry, timestamp, signatures = None):
+        ''' Add an entry logged by this run, see :func:`log_tofile`.
+
+            :param signatures: The (before, after) signatures (see :func:`_signature`) of the CSV around the write
+                               of the entry to it, under the log lock. If the CSV was as last loaded before the
+                               write, the signature after it is taken, so that the next :meth:`refresh` does not
+                               reload the CSV. Default is None, for entries written elsewhere.
+            :type signatures: tuple
+        '''
+        with self._lock:
+            current = self._entries.get((subject_id, sequence))
+            if current is None or timestamp >= current[0]:
+                self._entries[(subject_id, sequence)] = (timestamp, entry)
+            if signatures is not None and self._loaded and signatures[0] == self._csv_signature:
+                self._csv_signature = signatures[1]
+
+    def _journals(self):
+        ''' Return {filepath: signature} of the journal and the shards of the log. '''
+        if self.backend == 'csv':
+            return {}
+        journals = {}
+        for journal in [self.filename + '.journal'] + _log_files(self.filename, _SHARD_INFIX):
+            signature = _signature(journal)
+            if signature is not None:
+                journals[journal] = signature
+        return journals
+
+    def _reload(self):
+        self._entries = {}
+        if self.backend == 'shard':
+            # the CSV is only replaced (renamed) by merge_logs: it can be read without the lock
+            self._read_csv()
+        else:
+            import lockfile
+            lock = lockfile.FileLock(self.filename)
+            lock.timeout = 3600
+            with lock:
+                self._read_csv()
+        self._tails = {}
+        self._loaded = True
+        for journal, signature in self._journals().iteritems():
+            self._read_tail(journal, signature)
+
+    def _read_csv(self):
+        self._csv_signature = _signature(self.filename)
+        if self._csv_signature is not None:
+            for subject_id, sequence, entry, timestamp in _read_table_rows(self.filename):
+                self._entries[(subject_id, sequence)] = (timestamp, entry)
+
+    def _read_tail(self, journal, signature):
+        offset = self._tails.get(journal, (None, 0))[1]
+        if signature[1] > offset:
+            with open(journal, 'rb') as fp:
+                fp.seek(offset)
+                data = fp.read(signature[1] - offset)
+            # only read complete rows, the last one may still be being written
+            end = data.rfind('\n') + 1
+            for subject_id, sequence, entry, timestamp in _parse_rows(data[:end]):
+                current = self._entries.get((subject_id, sequence))
+                if current is None or timestamp >= current[0]:
+                    self._entries[(subject_id, sequence)] = (timestamp, entry)
+            offset += end
+        self._tails[journal] = (signature[2], offset)
+
+def _signature(filename):
+    ''' Return (mtime, size, inode) of a file, or None if it does not exist. '''
+    try:
+        st = _os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+def _journals_replaced(journals, tails):
+    ''' Check if one of the journals read up to (inode, offset) tails was removed, replaced or truncated
+        (e.g. by :func:`materialize_log` or :func:`merge_logs`) since.
+    '''
+    for journal, (inode, offset) in tails.iteritems():
+        signature = journals.get(journal)
+        if signature is None or signature[2] != inode or signature[1] < offset:
+            return True
+    return False
+
+def log_tofile(filename, subject_id, sequence, backend = 'csv', state = None, **kwargs):
     ''' Log a custome string to subject_id row and sequence column and update the 
         timestamp in Time_Last_Update column in a dataframe and in the end save the 
         dataframe to file. The timestamp format:'%Y/%m/%d-%H:%M:%S'.
+
+        With the 'journal' backend, the entry is appended to <filename>.journal instead of rewriting the
+        whole CSV, which takes a constant time whatever the size of the log. Use :func:`read_log` to read
+        the current log and :func:`materialize_log` to write it back to the CSV.
+
+        With the 'shard' backend, the entry is appended to <filename>.shard-<host>-<pid>, a file of the
+        calling process only, without taking the lock of the log. :func:`read_log` applies the shards and
+        :func:`merge_logs` consolidates them into the CSV.
         
         :param filename: A dataframe created by :func:`dicom2nifti.logger.create_log` that
                    has 'ID' as index name and Time_Last_Update and sequences as column names.
@@ -53,41 +210,392 @@ def log_tofile(filename, subject_id, sequence, **kwargs):
         :type subject_id: str
         :param sequence: A sequence to be added to columns.
         :type sequence: str
+        :param backend: {'csv', 'journal', 'shard'}. Default is 'csv'.
+        :type backend: str
+        :param state: A :class:`ConversionState` of filename to update with the entry. Default is None.
+        :type state: ConversionState
 
     '''
     
     _module_logger.debug('received a call to log_tofile')
+    if backend not in LOG_BACKENDS:
+        raise ValueError('Unknown log backend ' + str(backend))
+    if backend == 'shard':
+        _append_journal(_shard_name(filename), subject_id, sequence, _log_entry(**kwargs), state)
+        return 0
     
     import lockfile
     lock = lockfile.FileLock(filename)
     lock.timeout = 3600
     try:
         with lock:  ## argument poll_intervall for acquire() not available in this version of lockfile
-            if _os.path.exists(filename):
+            if backend == 'journal':
+                _append_journal(filename + '.journal', subject_id, sequence, _log_entry(**kwargs), state)
+                return 0
+
+            before = _signature(filename)
+            if before is not None:
                 df_nifti_log = pd.read_csv(filename, index_col = 0, dtype = str)
             else:
                 df_nifti_log = create_log()
                 
             log_conversion(df_nifti_log, subject_id, sequence, inplace = True, **kwargs)
             df_nifti_log.to_csv(filename, index = True)
+            if state is not None:
+                state.record(subject_id, sequence, df_nifti_log.at[subject_id, sequence],
+                             df_nifti_log.at[subject_id, 'Time_Last_Update'], (before, _signature(filename)))
 
     except lockfile.LockTimeout:
-        # lock.unique_name: hostname-tname.pid-somedigits
-        unique_name = _os.path.split(lock.unique_name)[1]
-        filename_tmp = filename + '_' + unique_name
-        _module_logger.warning('Lock timeout. Log the entry to ' + filename_tmp)
-        
-        if _os.path.exists(filename_tmp):
-            df_nifti_log = pd.read_csv(filename_tmp, index_col = 0, dtype = str)
-        else:
-            df_nifti_log = create_log()
-            
-        log_conversion(df_nifti_log, subject_id, sequence, inplace = True, **kwargs)
-        df_nifti_log.to_csv(filename_tmp, index = True)
+        # the shard of this process needs no lock, and read_log and merge_logs pick it up
+        shard = _shard_name(filename)
+        _module_logger.warning('Lock timeout. Log the entry to ' + shard)
+        _append_journal(shard, subject_id, sequence, _log_entry(**kwargs), state)
 #    except:
 #        _tb.print_exception(_sys.exc_info()[0], _sys.exc_info()[1], _sys.exc_info()[2])
         
     return 0
+
+def _append_journal(journal, subject_id, sequence, entry, state = None):
+    ''' Append an (ID, sequence, entry, time) row to a journal with a single write, and record it in a
+        :class:`ConversionState`.
+    '''
+    timestamp = _dt.now().strftime(_TIME_FORMAT)
+    _append_rows(journal, [[subject_id, sequence, entry, timestamp]])
+    if state is not None:
+        state.record(subject_id, sequence, entry, timestamp)
+
+class LogBuffer(object):
+    ''' Log conversions like :func:`log_tofile`, but commit them in batches: the entries are kept in
+        memory and written to the log under a single lock every batch_size entries and on :meth:`close`.
+
+        Until they are committed, the entries are also appended to a write-ahead file,
+        <filename>.wal-<host>-<pid>, so that they are not lost if the process is killed. The
+        write-ahead files of the processes of this host that are not running anymore are committed
+        along with the next batch.
+
+        :param filename: A log filepath.
+        :type filename: str
+        :param batch_size: Number of entries per commit. Default is 50.
+        :type batch_size: int
+        :param backend: {'csv', 'journal', 'shard'}. See :func:`log_tofile`. Default is 'csv'.
+        :type backend: str
+    '''
+
+    def __init__(self, filename, batch_size = 50, backend = 'csv'):
+        if backend not in LOG_BACKENDS:
+            raise ValueError('Unknown log backend ' + str(backend))
+        self.filename = filename
+        self.batch_size = batch_size
+        self.backend = backend
+        self.wal = '%s%s%s-%d' % (filename, _WAL_INFIX, _socket.gethostname(), _os.getpid())
+        self._rows = []
+        self._lock = _threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def log(self, subject_id, sequence, **kwargs):
+        ''' Log a nifti_path or a msg to subject_id row and sequence column, see :func:`log_conversion`.
+
+            :param subject_id: A subject identifier.
+            :type subject_id: str
+            :param sequence: A sequence.
+            :type sequence: str
+        '''
+        row = [subject_id, sequence, _log_entry(**kwargs), _dt.now().strftime(_TIME_FORMAT)]
+        with self._lock:
+            _append_rows(self.wal, [row])
+            self._rows.append(row)
+            if len(self._rows) >= self.batch_size:
+                self._commit()
+
+    def flush(self):
+        ''' Commit the entries logged so far. '''
+        with self._lock:
+            if self._rows:
+                self._commit()
+
+    def close(self):
+        ''' Commit the entries logged so far and remove the write-ahead file. '''
+        self.flush()
+
+    def _commit(self):
+        if self.backend == 'shard':
+            # the shard is written by this process only: no lock, :func:`merge_logs` recovers the orphans
+            _write_rows(self.filename, self._rows, self.backend)
+            self._rows = []
+            _os.remove(self.wal)
+            return
+        import lockfile
+        lock = lockfile.FileLock(self.filename)
+        lock.timeout = 3600
+        try:
+            with lock:
+                # the write-ahead files of dead processes are claimed under the lock, so only once
+                orphans = _orphan_wals(self.filename)
+                rows = []
+                for wal in orphans:
+                    _module_logger.warning('Recovering the log entries of ' + wal)
+                    rows += _read_rows(wal)
+                _write_rows(self.filename, rows + self._rows, self.backend)
+                for wal in orphans:
+                    _os.remove(wal)
+        except lockfile.LockTimeout:
+            _module_logger.warning('Lock timeout. Log the entries to ' + _shard_name(self.filename))
+            _write_rows(self.filename, self._rows, 'shard')
+        self._rows = []
+        if _os.path.exists(self.wal):
+            _os.remove(self.wal)
+
+def _append_rows(filename, rows):
+    ''' Append (ID, sequence, entry, time) rows to a journal or a write-ahead file with a single write. '''
+    buf = _StringIO()
+    _csv.writer(buf).writerows(rows)
+    fd = _os.open(filename, _os.O_WRONLY | _os.O_APPEND | _os.O_CREAT, 0666)
+    try:
+        _os.write(fd, buf.getvalue())
+    finally:
+        _os.close(fd)
+
+def _read_rows(filename):
+    ''' Return the complete (ID, sequence, entry, time) rows of a journal or a write-ahead file. '''
+    with open(filename, 'rb') as fp:
+        return [row for row in _csv.reader(fp) if len(row) == 4]
+
+def _read_table_rows(filename):
+    ''' Return the (ID, sequence, entry, time) rows of the entries of a log CSV. The entries of a row are
+        as old as its Time_Last_Update.
+    '''
+    rows = []
+    with open(filename, 'rb') as fp:
+        reader = _csv.reader(fp)
+        columns = next(reader, [])[1:]
+        for row in reader:
+            cells = dict(zip(columns, row[1:]))
+            timestamp = cells.pop('Time_Last_Update', '')
+            rows += [[row[0], sequence, entry, timestamp] for sequence, entry in cells.iteritems() if entry]
+    return rows
+
+def _write_rows(filename, rows, backend):
+    ''' Write (ID, sequence, entry, time) rows to a log with a backend, the caller holds the lock. The last
+        writer of a cell wins, see :func:`_apply_rows`.
+    '''
+    if not rows:
+        return
+    if backend == 'journal':
+        _append_rows(filename + '.journal', rows)
+        return
+    if backend == 'shard':
+        _append_rows(_shard_name(filename), rows)
+        return
+    if _os.path.exists(filename):
+        df = pd.read_csv(filename, index_col = 0, dtype = str)
+    else:
+        df = create_log()
+    # rows recovered from an old run must not overwrite newer entries
+    df = _apply_rows(df, rows)
+    df.to_csv(filename + '.tmp', index = True)
+    _os.rename(filename + '.tmp', filename)
+
+def _orphan_wals(filename):
+    ''' Return the write-ahead files of a log left by the processes of this host that are not running. '''
+    log_dir, log_name = _os.path.split(_os.path.abspath(filename))
+    prefix = '%s%s%s-' % (log_name, _WAL_INFIX, _socket.gethostname())
+    orphans = []
+    for name in _os.listdir(log_dir):
+        pid = name[len(prefix):]
+        if not name.startswith(prefix) or not pid.isdigit() or int(pid) == _os.getpid():
+            continue
+        try:
+            _os.kill(int(pid), 0)
+        except OSError, e:
+            if e.errno == _errno.ESRCH:
+                orphans.append(_os.path.join(log_dir, name))
+    return orphans
+
+def _shard_name(filename):
+    ''' Return the shard of a log written by this process. '''
+    return '%s%s%s-%d' % (filename, _SHARD_INFIX, _socket.gethostname(), _os.getpid())
+
+def _log_files(filename, infix):
+    ''' Return the files <filename><infix>* next to a log, e.g. its shards. '''
+    log_dir, log_name = _os.path.split(_os.path.abspath(filename))
+    if not _os.path.isdir(log_dir):
+        return []
+    return sorted(_os.path.join(_os.path.dirname(filename), name) for name in _os.listdir(log_dir)
+                  if name.startswith(log_name + infix))
+
+def _side_logs(filename):
+    ''' Return the <filename>_<unique name> logs written on lock timeouts by earlier versions, see
+        _SIDE_LOG_SUFFIX. Other files named <filename>_* are not side logs.
+    '''
+    log_dir, log_name = _os.path.split(_os.path.abspath(filename))
+    if not _os.path.isdir(log_dir):
+        return []
+    pattern = _re.compile(_re.escape(log_name) + _SIDE_LOG_SUFFIX)
+    return sorted(_os.path.join(_os.path.dirname(filename), name) for name in _os.listdir(log_dir)
+                  if pattern.match(name))
+
+def _parse_rows(data):
+    ''' Return the complete (ID, sequence, entry, time) rows of the content of a journal. '''
+    return [row for row in _csv.reader(_StringIO(data)) if len(row) == 4]
+
+def _apply_rows(df, rows):
+    ''' Apply (ID, sequence, entry, time) rows to a log dataframe cell by cell, the last writer of a cell
+        wins: an entry replaces the entry of its cell if it is not older, and empty entries are ignored.
+        The entries of the dataframe are as old as the Time_Last_Update of their row, and rows with equal
+        times are applied in order.
+    '''
+    cells = {}
+    times = {}
+    for subject_id, sequence, entry, timestamp in sorted(rows, key = lambda row: row[3]):
+        if not entry:
+            continue
+        if (subject_id, sequence) not in times:
+            times[subject_id, sequence] = _cell_time(df, subject_id, sequence)
+        if timestamp < times[subject_id, sequence]:
+            continue # older than the entry of the dataframe
+        times[subject_id, sequence] = timestamp
+        cells.setdefault(subject_id, {})[sequence] = entry
+    if not cells:
+        return df
+
+    for subject_id, entries in cells.iteritems():
+        last_update = _cell_time(df, subject_id, 'Time_Last_Update')
+        entries['Time_Last_Update'] = max([last_update] + [times[subject_id, sequence] for sequence in entries])
+    df_rows = pd.DataFrame.from_dict(cells, orient = 'index')
+    columns = df.columns.tolist() + [c for c in df_rows.columns if c not in df.columns]
+    # the cells of df_rows are not null where they replace the entries of df
+    df = df_rows.combine_first(df)[columns]
+    df.index.name = 'ID'
+    return df
+
+def _cell_time(df, subject_id, sequence):
+    ''' Return the Time_Last_Update of an entry of a log dataframe, '' if the cell is empty. '''
+    if subject_id not in df.index or sequence not in df.columns or not isinstance(df.at[subject_id, sequence], str):
+        return ''
+    if 'Time_Last_Update' not in df.columns or not isinstance(df.at[subject_id, 'Time_Last_Update'], str):
+        return ''
+    return df.at[subject_id, 'Time_Last_Update']
+
+def read_log(filename, backend = None):
+    ''' Read a conversion log as a dataframe in the layout of :func:`create_log`. The entries of the
+        journal (<filename>.journal) and of the shards (<filename>.shard-*) written by the 'journal' and
+        'shard' backends of :func:`log_tofile` are applied on top of the CSV, the last entry of a cell
+        wins according to Time_Last_Update.
+
+        :param filename: A log filepath. Neither the CSV nor the journal has to exist.
+        :type filename: str
+        :param backend: {'csv', 'journal', 'shard'}. If 'csv', the journal and the shards are ignored.
+                        Default is None, which applies them if there are any.
+        :type backend: str
+        :rtype: pandas.DataFrame
+    '''
+    _module_logger.debug('received a call to read_log')
+    if _os.path.exists(filename):
+        df = pd.read_csv(filename, index_col = 0, dtype = str)
+    else:
+        df = create_log()
+    if backend == 'csv':
+        return df
+
+    rows = []
+    for journal in [filename + '.journal'] + _log_files(filename, _SHARD_INFIX):
+        if _os.path.exists(journal):
+            rows += _read_rows(journal)
+    return _apply_rows(df, rows)
+
+def materialize_log(filename):
+    ''' Write the current log (see :func:`read_log`) to the CSV filename and empty its journal.
+
+        :param filename: A log filepath.
+        :type filename: str
+        :rtype: pandas.DataFrame
+    '''
+    _module_logger.debug('received a call to materialize_log')
+    import lockfile
+    lock = lockfile.FileLock(filename)
+    lock.timeout = 3600
+    with lock:
+        df = read_log(filename)
+        df.to_csv(filename + '.tmp', index = True)
+        _os.rename(filename + '.tmp', filename)
+        # replaying the journal on the new CSV would not change it, so a crash here is harmless
+        if _os.path.exists(filename + '.journal'):
+            _os.remove(filename + '.journal')
+    return df
+
+def merge_logs(filename, remove = True, side_logs = None):
+    ''' Consolidate into the CSV filename all the entries logged next to it: its journal, its shards (also
+        written on lock timeouts), the <filename>_<unique name> CSV written on lock timeouts by earlier
+        versions and the write-ahead files of the dead processes of this host (see :class:`LogBuffer`).
+        The last entry of a cell wins according to Time_Last_Update.
+
+        :param filename: A log filepath.
+        :type filename: str
+        :param remove: If True (default), remove the merged files. They are renamed to <file>.merging before
+                       they are read, so that entries appended meanwhile go to a new file for the next merge.
+        :type remove: boolean
+        :param side_logs: Other CSV or journal logs to merge, e.g. side logs that were renamed. They are removed
+                          as well if remove is True.
+        :type side_logs: list
+        :rtype: pandas.DataFrame
+    '''
+    _module_logger.debug('received a call to merge_logs')
+    import lockfile
+    lock = lockfile.FileLock(filename)
+    lock.timeout = 3600
+    with lock:
+        # <file>.merging are the leftovers of an interrupted merge
+        sources = ([filename + '.journal', filename + '.journal.merging'] +
+                   _log_files(filename, _SHARD_INFIX) +
+                   [f for f in _log_files(filename, _WAL_INFIX) if f.endswith('.merging')] +
+                   _side_logs(filename) + _orphan_wals(filename) + list(side_logs or []))
+        # read the leftovers first, renaming a file to <file>.merging replaces its leftover
+        sources = sorted(set(f for f in sources if _os.path.exists(f)),
+                         key = lambda f: (not f.endswith('.merging'), sources.index(f)))
+        rows = []
+        merged = []
+        for source in sources:
+            path = source
+            if remove and not source.endswith('.merging'):
+                path = source + '.merging'
+                _os.rename(source, path)
+            name = _os.path.basename(source)
+            if name.endswith('.merging'):
+                name = name[:-len('.merging')]
+            if name.endswith('.journal') or _SHARD_INFIX in name or _WAL_INFIX in name:
+                rows += _read_rows(path)
+            else:
+                rows += _read_table_rows(path)
+            if path not in merged:
+                merged.append(path)
+        _module_logger.info('Merging %d entries of %d files into %s' % (len(rows), len(merged), filename))
+
+        if _os.path.exists(filename):
+            df = pd.read_csv(filename, index_col = 0, dtype = str)
+        else:
+            df = create_log()
+        df = _apply_rows(df, rows)
+        df.to_csv(filename + '.tmp', index = True)
+        _os.rename(filename + '.tmp', filename)
+        if remove:
+            for path in merged:
+                _os.remove(path)
+    return df
+
+def _log_entry(nifti_path = None, msg = None):
+    ''' Return the entry to log for a nifti_path or a msg, see :func:`log_conversion`. '''
+    if not (nifti_path or msg):
+        raise 'Both nifti_path and msg are not specified. At least one needs to be specified.'
+    elif nifti_path:
+        if not _os.path.exists(nifti_path):
+            raise IOError('Input argument nifti_path: ' + nifti_path + ' does not exist.')
+        return nifti_path
+    return msg
         
     
         
@@ -110,15 +618,7 @@ def log_conversion( df, subject_id, sequence, nifti_path = None, msg = None, inp
     '''
     _module_logger.debug('received a call to log_conversion')
     
-    if not (nifti_path or msg):
-        raise 'Both nifti_path and msg are not specified. At least one needs to be specified.'
-    elif nifti_path:
-        if not _os.path.exists(nifti_path):
-            raise IOError('Input argument nifti_path: ' + nifti_path + ' does not exist.')
-        else:
-            entry = nifti_path
-    elif msg and not nifti_path:
-        entry = msg
+    entry = _log_entry(nifti_path = nifti_path, msg = msg)
         
     if inplace:
         df.at[subject_id, sequence] = entry
@@ -156,44 +656,26 @@ def create_log():
     return df
     
 
-def _combine_cells(cell_x, cell_y):
-    ''' Return a combined cell value from two cells depending on whether the cell is empty or NaN.
-        If cell_x is empty/NaN, return cell_y. If both cells are not empty/NaN, combine them delimited
-        with a space. Otherwise, return cell_x.
-        
-        :param cell_x: A cell value from a pandas.DataFrame object.
-        :type cell_x: str
-        :param cell_y: A cell value from a pandas.DataFrame object.
-        :type cell_y: str
-        :returns: A combined cell value.
+def _file_counts(values, stat_cache):
+    ''' Return (counts, lengths) arrays of the number of existing files and of files in each cell of values,
+        a cell being a string of space separated filepaths. Cells that are not strings have no files.
     '''
-    
-#    if not pd.isnull(cell_x) and not pd.isnull(cell_y):
-#        if _os.path.exists(cell_x) and _os.path.exists(cell_y):
-#            return cell_x + ' ' + cell_y
-#    elif pd.isnull(cell_y) or not _os.path.exists(cell_y):
-#        return cell_x
-#    elif pd.isnull(cell_x) or not _os.path.exists(cell_x):
-#        return cell_y
-    #_module_logger.debug("cell_x is " + str(cell_x))
-    #_module_logger.debug("cell_y is " + str(cell_y))
-        
-    if all(map(_os.path.exists, str(cell_x).split(' '))) and all(map(_os.path.exists, str(cell_y).split(' '))):
-        return cell_x + ' ' + cell_y
-    elif all(map(_os.path.exists, str(cell_x).split(' '))) and not all(map(_os.path.exists, str(cell_y).split(' '))):
-        return cell_x
-    elif all(map(_os.path.exists, str(cell_y).split(' '))) and not all(map(_os.path.exists, str(cell_x).split(' '))):
-        return cell_y
-    else:
-        return pd.np.nan
-#    if not (pd.isnull(cell_x) or pd.isnull(cell_y)):
-#        return cell_x + ' ' + cell_y
-#    elif pd.isnull(cell_x):
-#        return cell_y
-#    elif pd.isnull(cell_y):
-#        return cell_x
-    
-def merge_log_by_modality(df, modalities = {'T1': ['T1'], 'T2': ['T2'], 'FLAIR': ['FLAIR'], 'DTI': ['DTI', 'DWI'], 'PCASL': ['PCASL'], 'RESTING': ['REST', 'RSFMRI'], 'BOLD_BREATHHOLD':['BREATH', 'HOLD', 'HELD']}):
+    cells = [value.split(' ') if isinstance(value, str) else [] for value in values]
+    lengths = _np.array([len(cell) for cell in cells], dtype = int)
+    if not cells:
+        return lengths, lengths
+    paths = [path for cell in cells for path in cell]
+    exists = _np.array(stat_cache.exists_many(paths), dtype = float)
+    counts = _np.bincount(_np.repeat(_np.arange(len(cells)), lengths), weights = exists,
+                          minlength = len(cells)).astype(int)
+    return counts, lengths
+
+def _valid_mask(values, stat_cache):
+    ''' Return a boolean array, True for the cells of values whose files all exist. '''
+    counts, lengths = _file_counts(values, stat_cache)
+    return (counts == lengths) & (lengths > 0)
+
+def merge_log_by_modality(df, modalities = {'T1': ['T1'], 'T2': ['T2'], 'FLAIR': ['FLAIR'], 'DTI': ['DTI', 'DWI'], 'PCASL': ['PCASL'], 'RESTING': ['REST', 'RSFMRI'], 'BOLD_BREATHHOLD':['BREATH', 'HOLD', 'HELD']}, stat_cache = None):
     ''' Merge multiple columns of similar series in a :class:`pandas.DataFrame` into one column. 
         
         :param df: A dataframe created by dicom2nifti.logger.create_log() that
@@ -201,9 +683,16 @@ def merge_log_by_modality(df, modalities = {'T1': ['T1'], 'T2': ['T2'], 'FLAIR':
         :type df: pandas.DataFrame
         :param modalities: A dict of modality (series) as key and a list of keywords as value to group log columns.
         :type modalities: dict
+        :param stat_cache: A cache of the file existence checks, shared with e.g. :func:`count_files_frame`.
+                           Default is a new one.
+        :type stat_cache: dicom2nifti.stat_cache.StatCache
         :returns: A merged :class:`pandas.DataFrame`.
     '''
+    if stat_cache is None:
+        stat_cache = _StatCache()
     df_merged = create_log()
+    # check all the files of the log at once
+    stat_cache.prefetch([path for value in df.values.ravel() if isinstance(value, str) for path in value.split(' ')])
     
     # find columns that contains specific keyword.
     for modality, keywords in modalities.iteritems():
@@ -235,22 +724,44 @@ def merge_log_by_modality(df, modalities = {'T1': ['T1'], 'T2': ['T2'], 'FLAIR':
         tmp = df[cols[0]].astype(str)  # TODO 20160830 If the first column returns all NaN, dtype will be float and will be imcompatible to any strings that follow.
         #_module_logger.debug(tmp)
         
-        # And put the selected columns together.
-        #import pdb; pdb.set_trace()
-        for i in range(1, len(cols)):
-            #try:
-                #df_exist = df[cols[i]].applymap(_os.path.exists)
-            #_module_logger.debug(df[cols[i]])
-            
-            tmp = tmp.combine(df[cols[i]], _combine_cells)
-            #except:
-            #    _module_logger.warning(str(cols[i]) + ' somehow failed.')
+        # And put the selected columns together: the cells whose files all exist are joined with a space,
+        # the others dropped.
+        if len(cols) > 1:
+            x = tmp.values.astype(object)
+            valid_x = _valid_mask(x, stat_cache)
+            for i in range(1, len(cols)):
+                y = df[cols[i]].values.astype(object)
+                valid_y = _valid_mask(y, stat_cache)
+                combined = _np.empty(len(x), dtype = object)
+                combined[:] = _np.nan
+                combined[valid_x] = x[valid_x]
+                combined[valid_y & ~valid_x] = y[valid_y & ~valid_x]
+                both = valid_x & valid_y
+                combined[both] = x[both] + ' ' + y[both]
+                x = combined
+                valid_x = valid_x | valid_y
+            tmp = pd.Series(x, index = df.index)
         df_merged[modality] = tmp
     
     df_merged.ix[:, 'Time_Last_Update'] = _dt.now().strftime('%Y/%m/%d-%H:%M:%S')
     
     return df_merged
     
+def count_files_frame(df, stat_cache = None):
+    ''' Count the number of valid files in each cell of a dataframe, like df.applymap(count_files), with
+        the distinct files checked once and concurrently.
+
+        :param df: A dataframe of space separated filepaths, e.g. created by :func:`merge_log_by_modality`.
+        :type df: pandas.DataFrame
+        :param stat_cache: A cache of the file existence checks. Default is a new one.
+        :type stat_cache: dicom2nifti.stat_cache.StatCache
+        :returns: A :class:`pandas.DataFrame` of counts.
+    '''
+    if stat_cache is None:
+        stat_cache = _StatCache()
+    counts = _file_counts(df.values.ravel(), stat_cache)[0]
+    return pd.DataFrame(counts.reshape(df.shape), index = df.index, columns = df.columns)
+
 def count_files(s):
     ''' Count number of valid file in a string. Typical use is to apply the function on the cells in a dataframe. 
         Ex. df.applymap(count_files)
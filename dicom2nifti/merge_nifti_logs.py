@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+__EXEC__ = __file__
+
+# Import modules here
+import sys
+
+def create_parser():
+    import argparse
+    ''' Create an argparse.ArgumentParser object
+
+        :returns: An argparse.ArgumentParser parser.
+    '''
+    parser = argparse.ArgumentParser(prog = __EXEC__,
+                                     description = 'Consolidate the shards (--log_backend shard and lock timeouts), the journal, the <log>_<unique name> files of lock timeouts of earlier versions and the entries of killed jobs (--log_batch) of nifti logs into their CSV. The last entry of a sequence wins according to Time_Last_Update.')
+    # Required
+    parser.add_argument('-l', '--log',
+                        required = True,
+                        dest = 'log',
+                        action = 'store',
+                        nargs = '+',
+                        type = str,
+                        help = 'The nifti log(s) given to sortAndRenameDicoms.')
+
+    # Optional
+    parser.add_argument('-s', '--side_logs',
+                        dest = 'side_logs',
+                        action = 'store',
+                        nargs = '+',
+                        default = None,
+                        type = str,
+                        help = 'Other CSV (or .journal) logs to merge into the log, e.g. renamed <log>_<unique name> files. Requires a single log.')
+    parser.add_argument('-k', '--keep',
+                        dest = 'keep',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Keep the merged files. By default they are removed once their entries are in the CSV.')
+    return parser
+
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # parse input from command line
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    if args.side_logs and len(args.log) > 1:
+        parser.error('--side_logs requires a single log.')
+
+    import logger
+
+    for log in args.log:
+        print "Merging", log
+        df = logger.merge_logs(log, remove = not args.keep, side_logs = args.side_logs)
+        print "%d subjects in %s" % (len(df), log)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -30,17 +30,21 @@ def reorient_nifti_and_bvec( nii, orientation = 'LPS', bvec = None):
     if not _is_valid_orientation(orientation):
         pass
 
-    nii_affine = nii.get_affine()
-    nii_data = nii.get_data()
-    new_orient_code = tuple(orientation.upper())
-    orig_orient_code = _nib.aff2axcodes(nii_affine)
-    new_orient_ornt = _nib.orientations.axcodes2ornt(new_orient_code)
-    orig_orient_ornt = _nib.orientations.axcodes2ornt(orig_orient_code)
-    trans_ornt = _nib.orientations.ornt_transform(orig_orient_ornt,
-                                                  new_orient_ornt)
-    nii_data_reoriented = _nib.apply_orientation(nii_data, trans_ornt)
-    trans_affine = _nib.orientations.inv_ornt_aff(trans_ornt, nii.shape)
-    nii_affine_reoriented = _np.dot(nii_affine, trans_affine)
+    trans_ornt, trans_affine = get_orientation_transform(nii, orientation)
+    if _is_identity_ornt(trans_ornt):
+        # already in the requested orientation: do not load (or copy) the data at all, only the
+        # header is updated as for a reoriented image
+        _module_logger.debug('image is already in %s orientation' % orientation)
+        nii_same = _nib.Nifti1Image(nii.dataobj, nii.get_affine(), header = nii.get_header())
+        nii_same.set_qform(nii_same.get_sform())
+        if bvec is not None:
+            return (nii_same, _np.array(bvec))
+        return nii_same
+
+    # flips and permutations are applied as views of the data array, which is memory-mapped
+    # from uncompressed unscaled images, so nothing is copied until the image is written
+    nii_data_reoriented = _nib.apply_orientation(_np.asanyarray(nii.dataobj), trans_ornt)
+    nii_affine_reoriented = _np.dot(nii.get_affine(), trans_affine)
     nii_reoriented = _nib.Nifti1Image(nii_data_reoriented,
                                       nii_affine_reoriented,
                                       header = nii.get_header())
@@ -55,6 +59,100 @@ def reorient_nifti_and_bvec( nii, orientation = 'LPS', bvec = None):
 
     return nii_reoriented
 
+def reorient_nifti_file( in_filename, out_filename, orientation = 'LPS', bvec = None,
+                         gzip_level = 6, gzip_threads = None, gzip_index = False ):
+    ''' Reorient a nifti file to a given orientation one 3D volume at a time, so that the memory used
+        is bounded by a few volumes whatever the length of a 4D series. The stored (unscaled) values
+        are copied as they are, with the scaling of the original header. A .gz out_filename is
+        compressed with :class:`dicom2nifti.parallel_gzip.ParallelGzipWriter`.
+
+        :param in_filename: A nifti filepath to be reoriented.
+        :type in_filename: str
+        :param out_filename: The reoriented nifti filepath. It must differ from in_filename.
+        :type out_filename: str
+        :param orientation: A nifti image orientation in a string using CBICA "to" convention.
+        :type orientation: str
+        :param bvec: A 3 x N array of gradient vectors.
+        :type bvec: numpy.array
+        :param gzip_level: zlib compression level (1-9) of a .gz out_filename. Default is 6.
+        :type gzip_level: int
+        :param gzip_threads: Number of compression threads. Default is the number of CPUs.
+        :type gzip_threads: int
+        :param gzip_index: If True, write a block index <out_filename>.gzi.
+        :type gzip_index: boolean
+        :returns: bvec_oriented if bvec is supplied, None otherwise.
+    '''
+    _module_logger.debug('received a call to reorient_nifti_file')
+    from nibabel.openers import Opener
+    from parallel_gzip import ParallelGzipWriter
+
+    nii = _nib.load(in_filename)
+    trans_ornt, trans_affine = get_orientation_transform(nii, orientation)
+    nii_affine_reoriented = _np.dot(nii.get_affine(), trans_affine)
+
+    # the header of the image has no data offset nor scaling anymore, those of the file are needed
+    with Opener(in_filename, 'rb') as fin:
+        disk_hdr = _nib.Nifti1Header.from_fileobj(fin)
+    in_offset = disk_hdr.get_data_offset()
+    hdr = disk_hdr.copy()
+    hdr.set_data_offset(max(in_offset, hdr.single_vox_offset + hdr.extensions.get_sizeondisk()))
+    dtype = hdr.get_data_dtype()
+    shape = nii.shape
+    volume_shape = shape[:3]
+    nvolumes = int(_np.prod(shape[3:]))
+    volume_bytes = int(_np.prod(volume_shape)) * dtype.itemsize
+    hdr.set_data_shape(tuple(volume_shape[i] for i in _np.argsort(trans_ornt[:,0])) + tuple(shape[3:]))
+    hdr.set_sform(nii_affine_reoriented)
+    hdr.set_qform(nii_affine_reoriented)
+
+    if out_filename.endswith('.gz'):
+        fout = ParallelGzipWriter(out_filename, level = gzip_level, threads = gzip_threads, index = gzip_index)
+    else:
+        fout = open(out_filename, 'wb')
+    try:
+        hdr.write_to(fout)
+        fout.write(b'\x00' * (hdr.get_data_offset() - fout.tell()))
+        with Opener(in_filename, 'rb') as fin:
+            fin.seek(in_offset)
+            # volumes are contiguous in the (fortran ordered) data block
+            for i in xrange(nvolumes):
+                volume = _np.frombuffer(fin.read(volume_bytes), dtype = dtype).reshape(volume_shape, order = 'F')
+                volume = _nib.apply_orientation(volume, trans_ornt)
+                fout.write(volume.tostring(order = 'F'))
+    finally:
+        fout.close()
+
+    if bvec is not None:
+        bvec = _np.array(bvec).T
+        bvec_out = _np.dot(bvec, trans_affine[0:3,0:3])
+        return bvec_out.T
+    return None
+
+def get_orientation_transform( nii, orientation = 'LPS' ):
+    ''' Compute the transform from the orientation of an image to a given orientation.
+
+        :param nii: A nifti image.
+        :type nii: nibabel.nifti1.Nifti1Image
+        :param orientation: A nifti image orientation in a string using CBICA "to" convention.
+        :type orientation: str
+        :returns: (trans_ornt, trans_affine), the orientation transform to apply to the data array
+                  (see :func:`nibabel.orientations.apply_orientation`) and the affine to post-multiply
+                  the image affine and the gradient vectors by.
+    '''
+    new_orient_code = tuple(orientation.upper())
+    orig_orient_code = _nib.aff2axcodes(nii.get_affine())
+    new_orient_ornt = _nib.orientations.axcodes2ornt(new_orient_code)
+    orig_orient_ornt = _nib.orientations.axcodes2ornt(orig_orient_code)
+    trans_ornt = _nib.orientations.ornt_transform(orig_orient_ornt,
+                                                  new_orient_ornt)
+    trans_affine = _nib.orientations.inv_ornt_aff(trans_ornt, nii.shape)
+    return (trans_ornt, trans_affine)
+
+def _is_identity_ornt(ornt):
+    ''' Check if an orientation transform keeps every axis in place and direction. '''
+    return (_np.array_equal(ornt[:,0], _np.arange(len(ornt))) and
+            _np.all(ornt[:,1] == 1))
+
 def _is_valid_orientation(orientation):
     ''' Check if a nifti orientation is valid. The orientation has to have three unique letters
         for three dimensional data, one for each dimension: left-right, anterior-posterior and
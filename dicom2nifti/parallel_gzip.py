@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+
+import zlib as _zlib
+import struct as _struct
+import logging as _log
+import multiprocessing as _mp
+from collections import deque as _deque
+from multiprocessing.pool import ThreadPool as _ThreadPool
+
+_module_logger = _log.getLogger(__name__)
+_ch = _log.StreamHandler()
+_formatter = _log.Formatter(fmt = '%(asctime)s %(name)s %(levelname)s: %(message)s',
+                            datefmt = '%Y%m%d-%H:%M:%S')
+_ch.setFormatter(_formatter)
+_module_logger.addHandler(_ch)
+
+# gzip member header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+_GZIP_HEADER = _struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, 0, 255)
+
+class ParallelGzipWriter(object):
+    ''' A write-only file object that compresses its input in independent blocks on a pool of
+        threads, like pigz or bgzip. Each block is written as a complete gzip member, and
+        concatenated members are a valid gzip file for any reader (gzip, zlib, nibabel...).
+        zlib releases the GIL while compressing, so the blocks are compressed in parallel.
+
+        Optionally, a bgzip style index (<filename>.gzi) is written on close: a little endian
+        uint64 count followed by (compressed offset, uncompressed offset) uint64 pairs for the
+        start of every block but the first. A reader can then seek to any uncompressed offset,
+        e.g. one volume of a 4D image, by decompressing from the start of its block only.
+
+        :param filename: The output filepath.
+        :type filename: str
+        :param level: zlib compression level from 1 (fastest) to 9 (smallest). Default is 6.
+        :type level: int
+        :param threads: Number of compression threads. Default is the number of CPUs.
+        :type threads: int
+        :param block_size: Number of uncompressed bytes per block. Default is 4 MiB.
+        :type block_size: int
+        :param index: If True, write the block index to <filename>.gzi.
+        :type index: boolean
+    '''
+
+    def __init__(self, filename, level = 6, threads = None, block_size = 4 * 1024 * 1024, index = False):
+        if threads is None:
+            threads = _mp.cpu_count()
+        self.name = filename
+        self.level = level
+        self.block_size = block_size
+        self.closed = False
+        self._fileobj = open(filename, 'wb')
+        self._pool = _ThreadPool(threads)
+        self._max_pending = 2 * threads
+        self._pending = _deque()
+        self._buffer = []
+        self._buffered = 0
+        self._offset = 0
+        self._block_start = 0
+        self._compressed_offset = 0
+        self._index = [] if index else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if not isinstance(data, bytes):
+            data = memoryview(data).tobytes()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._offset += len(data)
+        if self._buffered >= self.block_size:
+            data = b''.join(self._buffer)
+            nblocks = len(data) // self.block_size
+            for i in xrange(nblocks):
+                self._submit(data[i * self.block_size:(i + 1) * self.block_size])
+            rest = data[nblocks * self.block_size:]
+            self._buffer = [rest] if rest else []
+            self._buffered = len(rest)
+
+    def read(self, size = -1):
+        # nibabel only takes objects with both read and write methods as file objects
+        raise IOError('File not open for reading')
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset, whence = 0):
+        # only "seeking" to the current position is possible in a compressed stream
+        if whence == 1:
+            offset += self._offset
+        elif whence == 2:
+            raise IOError('Cannot seek from the end of a compressed stream.')
+        if offset != self._offset:
+            raise IOError('Cannot seek in a compressed stream.')
+        return self._offset
+
+    def flush(self):
+        # blocks are only compressed once full so that the block size is constant
+        self._fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffered or self._block_start == 0:
+                # always write at least one (possibly empty) member
+                self._submit(b''.join(self._buffer))
+                self._buffer = []
+                self._buffered = 0
+            while self._pending:
+                self._write_next()
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._fileobj.close()
+            self.closed = True
+        if self._index is not None:
+            with open(self.name + '.gzi', 'wb') as fp:
+                fp.write(_struct.pack('<Q', len(self._index)))
+                for compressed_offset, offset in self._index:
+                    fp.write(_struct.pack('<QQ', compressed_offset, offset))
+
+    def _submit(self, block):
+        self._pending.append((self._block_start, self._pool.apply_async(_compress_block, (block, self.level))))
+        self._block_start += len(block)
+        while len(self._pending) > self._max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        block_start, result = self._pending.popleft()
+        member = result.get()
+        if self._index is not None and block_start > 0:
+            self._index.append((self._compressed_offset, block_start))
+        self._fileobj.write(member)
+        self._compressed_offset += len(member)
+
+def _compress_block(block, level):
+    ''' Return a complete gzip member of a block of data. '''
+    compressor = _zlib.compressobj(level, _zlib.DEFLATED, -_zlib.MAX_WBITS)
+    body = compressor.compress(block) + compressor.flush()
+    trailer = _struct.pack('<II', _zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+    return _GZIP_HEADER + body + trailer
+
+def save_nifti(nii, filename, level = 6, threads = None, index = False):
+    ''' Save a nifti image. A .gz filename is compressed in parallel with :class:`ParallelGzipWriter`,
+        other filenames are saved with :meth:`nibabel.nifti1.Nifti1Image.to_filename`.
+
+        :param nii: A nifti image.
+        :type nii: nibabel.nifti1.Nifti1Image
+        :param filename: The output filepath.
+        :type filename: str
+        :param level: zlib compression level from 1 (fastest) to 9 (smallest). Default is 6.
+        :type level: int
+        :param threads: Number of compression threads. Default is the number of CPUs.
+        :type threads: int
+        :param index: If True, write a bgzip style block index to <filename>.gzi.
+        :type index: boolean
+    '''
+    _module_logger.debug('received a call to save_nifti')
+    if not filename.endswith('.gz'):
+        nii.to_filename(filename)
+        return
+    from nibabel.fileholders import FileHolder
+    with ParallelGzipWriter(filename, level = level, threads = threads, index = index) as fobj:
+        nii.to_file_map({'image': FileHolder(filename = filename, fileobj = fobj)})
@@ -45,6 +45,11 @@ def create_parser():
                         action = 'store',
                         default = None,
                         help = 'Input a column name within the master CSV')
+    parser.add_argument('--merge',
+                        dest = 'merge',
+                        action = 'store_true',
+                        default = False,
+                        help = 'The input CSV is a conversion log with a column per sequence: merge the sequences of each modality (--modality, or T1, T2, FLAIR, DTI, PCASL, RESTING and BOLD_BREATHHOLD) into a column first.')
     parser.add_argument('--execute',
                         dest = 'is_dry_run',
                         action = 'store_false',
@@ -72,10 +77,21 @@ def main(argv = None):
     print "Executing in", exe_folder
     
     # Start your program
+    import logger
     import pandas as pd
     from datetime import datetime as dt
+    from stat_cache import StatCache
     
-    df = pd.read_csv(args.inputcsv, index_col = 0)
+    # apply the journal of the log, if any
+    df = logger.read_log(args.inputcsv)
+    # the files of the log are checked once, for the merge and for the master sheet
+    stat_cache = StatCache()
+    if args.merge:
+        kwargs = {}
+        if args.modality is not None:
+            kwargs['modalities'] = dict((m.upper(), [m]) for m in args.modality)
+            args.modality = [m.upper() for m in args.modality]
+        df = logger.merge_log_by_modality(df, stat_cache = stat_cache, **kwargs)
     
     if args.modality is None:
         modality = df.columns.tolist()
@@ -87,7 +103,7 @@ def main(argv = None):
     if args.master is not None:
         print "Working on Master sheet"
         no_master = True
-        df_master_new = create_master(df, cols = modality)
+        df_master_new = create_master(df, cols = modality, stat_cache = stat_cache)
         if os.path.isfile(args.master):
             no_master = False
             data_types = {i: int for i in modality}
@@ -224,12 +240,13 @@ def rename_nifti(df, basedir, dry_run = True,
         print 
         print
 
-def create_master(df, cols = ['T1', 'T2', 'FLAIR', 'DTI', 'PCASL', 'RESTING', 'BOLD_BREATHHOLD']):
+def create_master(df, cols = ['T1', 'T2', 'FLAIR', 'DTI', 'PCASL', 'RESTING', 'BOLD_BREATHHOLD'], stat_cache = None):
     import logger
     import pandas as pd
     from datetime import datetime as dt
 
-    df_filecount = df.applymap(logger.count_files)
+    # the distinct files are checked once, concurrently
+    df_filecount = logger.count_files_frame(df, stat_cache = stat_cache)
     full_id = df.index.tolist()
     subj_id_list = ['-'.join(i.split('-')[:-1]) for i in full_id]
     scan_date_list = [i.split('-')[-1] for i in full_id]
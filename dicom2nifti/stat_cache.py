@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+
+import os as _os
+import logging as _log
+import threading as _threading
+
+_module_logger = _log.getLogger(__name__)
+_ch = _log.StreamHandler()
+_formatter = _log.Formatter(fmt = '%(asctime)s %(name)s %(levelname)s: %(message)s',
+                            datefmt = '%Y%m%d-%H:%M:%S')
+_ch.setFormatter(_formatter)
+_module_logger.addHandler(_ch)
+
+class StatCache(object):
+    ''' A cache of file existence checks. Each path is stat'ed once, and the paths of a batch that are not
+        cached yet are stat'ed concurrently on a pool of threads, which hides the latency of network file
+        systems. The cache does not see the files created or removed after a path was checked, use
+        :meth:`clear` to forget the results. The cache can be shared between threads.
+
+        :param threads: Number of threads checking a batch of paths.
+        :type threads: int
+    '''
+
+    def __init__(self, threads = 16):
+        self.threads = threads
+        self._exists = {}
+        self._lock = _threading.Lock()
+
+    def __len__(self):
+        return len(self._exists)
+
+    def exists(self, path):
+        ''' Return True if path exists, like :func:`os.path.exists`.
+
+            :param path: A filepath.
+            :type path: str
+            :rtype: boolean
+        '''
+        return self.exists_many([path])[0]
+
+    def exists_many(self, paths):
+        ''' Return whether each of paths exists, checking every distinct path not cached yet once.
+
+            :param paths: A list of filepaths, possibly repeated.
+            :type paths: list
+            :returns: A list of booleans.
+        '''
+        self.prefetch(paths)
+        with self._lock:
+            return [self._exists[path] for path in paths]
+
+    def prefetch(self, paths):
+        ''' Check the existence of the distinct paths that are not cached yet.
+
+            :param paths: A list of filepaths, possibly repeated.
+            :type paths: list
+        '''
+        with self._lock:
+            missing = list(set(path for path in paths if path not in self._exists))
+        if not missing:
+            return
+        if len(missing) == 1 or self.threads < 2:
+            results = map(_exists, missing)
+        else:
+            from multiprocessing.pool import ThreadPool as _ThreadPool
+            pool = _ThreadPool(min(self.threads, len(missing)))
+            try:
+                results = pool.map(_exists, missing, chunksize = 64)
+            finally:
+                pool.close()
+                pool.join()
+        _module_logger.debug('stat cache: %d paths checked' % len(missing))
+        with self._lock:
+            self._exists.update(zip(missing, results))
+
+    def clear(self):
+        ''' Forget all the checked paths. '''
+        with self._lock:
+            self._exists.clear()
+
+def _exists(path):
+    try:
+        return _os.path.exists(path)
+    except (TypeError, ValueError):
+        # e.g. a path with a null byte
+        return False
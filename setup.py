@@ -86,10 +86,10 @@ setup(
     install_requires=['dcmstack>=0.6.2', 
                       'nibabel>=2.0.1', 
                       'pydicom==0.9.9', 
-                      'nipype==0.10.0', 
                       'numpy>=1.9.2', 
                       'pandas>=0.16.2',
-                      'lockfile',],
+                      'lockfile',
+                      'scandir',],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
@@ -119,7 +119,8 @@ setup(
     entry_points={
         'console_scripts': [
             'sortAndRenameDicoms=dicom2nifti.command_line:main',
-            'rename_nifti=dicom2nifti.rename_nifti:main'
+            'rename_nifti=dicom2nifti.rename_nifti:main',
+            'merge_nifti_logs=dicom2nifti.merge_nifti_logs:main'
         ],
     },
     
@@ -0,0 +1,137 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from dicom2nifti import dcm2nii
+
+# stdout of dcm2nii (4AUGUST2014 output format) converting a T1 series with -g y, output directory {out}
+T1_STDOUT = '''Chris Rorden's dcm2nii :: 4AUGUST2014 64bit BSD License
+reading preferences file {ini}
+Data will be exported to {out}
+Validating 176 potential DICOM images.
+Found 176 DICOM images.
+Converting 176/176 volumes: 1
+IM-0003-0001.dcm-->20160101_120000T1MPRAGEs003a1001.nii
+GZip...20160101_120000T1MPRAGEs003a1001.nii.gz
+'''
+
+# a diffusion series with -g n: the extra (derived) direction is removed
+DTI_STDOUT = '''Chris Rorden's dcm2nii :: 4AUGUST2014 64bit BSD License
+reading preferences file {ini}
+Data will be exported to {out}
+Validating 66 potential DICOM images.
+Found 66 DICOM images.
+Converting 66/66 volumes: 1
+IM-0005-0001.dcm-->20160101_120000DTIs005a001.nii
+Number of diffusion directions 66
+Removed DWI from DTI scan {out}/x20160101_120000DTIs005a001.nii
+Saving {out}/x20160101_120000DTIs005a001.nii
+'''
+
+# a reoriented (-r y) or cropped (-x y) copy is reported after the conversion
+REORIENT_STDOUT = '''Converting 176/176 volumes: 1
+IM-0003-0001.dcm-->20160101_120000T1MPRAGEs003a1001.nii
+Reorienting as {out}/o20160101_120000T1MPRAGEs003a1001.nii
+Saving {out}/o20160101_120000T1MPRAGEs003a1001.nii
+'''
+CROP_STDOUT = '''Converting 176/176 volumes: 1
+IM-0003-0001.dcm-->20160101_120000T1MPRAGEs003a1001.nii
+Cropping NIfTI/Analyze image {out}/20160101_120000T1MPRAGEs003a1001.nii
+Saving {out}/c20160101_120000T1MPRAGEs003a1001.nii
+'''
+
+class TestBuildCmdline(unittest.TestCase):
+
+    def test_cmdline(self):
+        cmdline = dcm2nii.build_dcm2nii_cmdline(['/data/IM-0001.dcm', '/data/IM-0002.dcm'], '/out',
+                                                gzip_output = True, convert_all_pars = False,
+                                                config_file = '/tmp/d.ini', cmd = '/bin/dcm2nii')
+        self.assertEqual(cmdline[:3], ['/bin/dcm2nii', '-b', '/tmp/d.ini'])
+        self.assertEqual(cmdline[-3:], ['-o', '/out', '/data/IM-0001.dcm'])
+        options = dict(zip(cmdline[3:-3:2], cmdline[4:-3:2]))
+        self.assertEqual(options, {'-a': 'n', '-c': 'y', '-d': 'n', '-e': 'y', '-f': 'n', '-g': 'y',
+                                   '-i': 'n', '-n': 'y', '-p': 'y', '-r': 'n', '-v': 'n', '-x': 'n'})
+
+    def test_relative_source(self):
+        cmdline = dcm2nii.build_dcm2nii_cmdline(['IM-0001.dcm'], '/out', config_file = 'd.ini')
+        self.assertEqual(cmdline[-1], os.path.abspath('IM-0001.dcm'))
+
+    def test_config_is_required(self):
+        self.assertRaises(ValueError, dcm2nii.build_dcm2nii_cmdline, ['IM-0001.dcm'], '/out')
+
+class TestParseStdout(unittest.TestCase):
+
+    def setUp(self):
+        self.out = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out)
+
+    def _stdout(self, template, *outputs):
+        for name in outputs:
+            open(os.path.join(self.out, name), 'w').close()
+        return template.format(out = self.out, ini = '/tmp/dcm2nii_x.ini')
+
+    def test_gzip(self):
+        stdout = self._stdout(T1_STDOUT, '20160101_120000T1MPRAGEs003a1001.nii.gz')
+        self.assertEqual(dcm2nii._parse_stdout(stdout, self.out),
+                         ([os.path.join(self.out, '20160101_120000T1MPRAGEs003a1001.nii.gz')], [], []))
+
+    def test_diffusion(self):
+        stdout = self._stdout(DTI_STDOUT, '20160101_120000DTIs005a001.nii', 'x20160101_120000DTIs005a001.nii')
+        output_files, bvals, bvecs = dcm2nii._parse_stdout(stdout, self.out)
+        base = os.path.join(self.out, '20160101_120000DTIs005a001')
+        self.assertEqual(output_files, [base + '.nii', os.path.join(self.out, 'x20160101_120000DTIs005a001.nii')])
+        self.assertEqual(bvals, [base + '.bval'])
+        self.assertEqual(bvecs, [base + '.bvec'])
+
+    def test_reoriented_and_cropped_copies_are_skipped(self):
+        for template, prefix in [(REORIENT_STDOUT, 'o'), (CROP_STDOUT, 'c')]:
+            stdout = self._stdout(template, '20160101_120000T1MPRAGEs003a1001.nii',
+                                  prefix + '20160101_120000T1MPRAGEs003a1001.nii')
+            self.assertEqual(dcm2nii._parse_stdout(stdout, self.out)[0],
+                             [os.path.join(self.out, '20160101_120000T1MPRAGEs003a1001.nii')])
+
+    def test_other_arrows_are_ignored(self):
+        open(os.path.join(self.out, 'b'), 'w').close()
+        stdout = 'Warning: slice order a->b\nunsupported transfer syntax 1.2.840.10008.1.2.4.90 -> skipped\n'
+        self.assertEqual(dcm2nii._parse_stdout(stdout, self.out), ([], [], []))
+
+class TestRunDcm2nii(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.out = os.path.join(self.tmp_dir, 'out')
+        os.mkdir(self.out)
+        # a stand-in dcm2nii: records its arguments and config, writes one output and reports it
+        self.cmd = os.path.join(self.tmp_dir, 'dcm2nii')
+        with open(self.cmd, 'w') as fp:
+            fp.write('#!/bin/sh\n'
+                     'echo "$@" > %(tmp)s/args\n'
+                     'cp "$2" %(tmp)s/config\n'
+                     'touch %(out)s/a.nii\n'
+                     'echo "IM-0001.dcm-->a.nii"\n' % {'tmp': self.tmp_dir, 'out': self.out})
+        os.chmod(self.cmd, stat.S_IRWXU)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_temporary_config(self):
+        result = dcm2nii.run_dcm2nii([os.path.join(self.tmp_dir, 'IM-0001.dcm')], self.out, cmd = self.cmd)
+        self.assertEqual(result.output_files, [os.path.join(self.out, 'a.nii')])
+        args = open(os.path.join(self.tmp_dir, 'args')).read().split()
+        self.assertEqual(args[0], '-b')
+        self.assertFalse(os.path.exists(args[1]))
+        self.assertEqual(open(os.path.join(self.tmp_dir, 'config')).read(), '[BOOL]\nManualNIfTIConv=0\n')
+
+    def test_given_config(self):
+        config = dcm2nii.write_dcm2nii_config(os.path.join(self.tmp_dir, 'dcm2nii.ini'))
+        dcm2nii.run_dcm2nii([os.path.join(self.tmp_dir, 'IM-0001.dcm')], self.out, config_file = config,
+                            cmd = self.cmd)
+        self.assertEqual(open(os.path.join(self.tmp_dir, 'args')).read().split()[:2], ['-b', config])
+        self.assertTrue(os.path.exists(config))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,616 @@
+import errno
+import fcntl
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nib
+import dicom
+import dcmstack
+from dicom.dataset import Dataset, FileDataset
+
+from dicom2nifti import dicom2nifti as d2n
+from dicom2nifti.header_index import HeaderIndex
+
+ROWS = 4
+COLUMNS = 5
+NFRAMES = 3
+
+def write_enhanced_mr(filename, series_uid = '1.2.826.0.1.3680043.2.1125.1.1'):
+    ''' Write a small uncompressed Enhanced MR Image Storage dicom of NFRAMES axial slices. '''
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = d2n.ENHANCED_MR_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = series_uid + '.1'
+    file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    file_meta.ImplementationClassUID = '1.2.826.0.1.3680043.2.1125.2'
+    ds = FileDataset(filename, {}, file_meta = file_meta, preamble = b'\x00' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.SOPClassUID = d2n.ENHANCED_MR_IMAGE_STORAGE
+    ds.SOPInstanceUID = series_uid + '.1'
+    ds.StudyInstanceUID = series_uid + '.0'
+    ds.SeriesInstanceUID = series_uid
+    ds.Modality = 'MR'
+    ds.PatientID = 'SUBJ01'
+    ds.PatientName = 'SUBJ01'
+    ds.StudyDate = '20160101'
+    ds.SeriesDate = '20160101'
+    ds.AcquisitionDateTime = '20160101120000'
+    ds.SeriesNumber = 3
+    ds.SeriesDescription = 'T1_ENHANCED'
+    ds.ProtocolName = 'T1_ENHANCED'
+    ds.InstanceNumber = 1
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'NONE']
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = ROWS
+    ds.Columns = COLUMNS
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.NumberOfFrames = NFRAMES
+
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = [1.0, 1.0]
+    pixel_measures.SliceThickness = 2.0
+    plane_orientation = Dataset()
+    plane_orientation.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    shared = Dataset()
+    shared.PixelMeasuresSequence = [pixel_measures]
+    shared.PlaneOrientationSequence = [plane_orientation]
+    ds.SharedFunctionalGroupsSequence = [shared]
+
+    per_frame = []
+    for i in xrange(NFRAMES):
+        plane_position = Dataset()
+        plane_position.ImagePositionPatient = [0.0, 0.0, 2.0 * i]
+        frame_content = Dataset()
+        frame_content.StackID = '1'
+        frame_content.InStackPositionNumber = i + 1
+        frame_content.TemporalPositionIndex = 1
+        group = Dataset()
+        group.PlanePositionSequence = [plane_position]
+        group.FrameContentSequence = [frame_content]
+        per_frame.append(group)
+    ds.PerFrameFunctionalGroupsSequence = per_frame
+
+    ds.PixelData = expected_pixels().astype('<u2').tostring()
+    ds[0x7fe0, 0x0010].VR = 'OW'
+    ds.save_as(filename)
+    return filename
+
+def write_classic_series(directory, series_number, description, nslices = NFRAMES, patient_id = 'SUBJ01',
+                         offset = 0):
+    ''' Write an uncompressed MR Image Storage series of nslices axial slices, one file per slice, and
+        return the filenames. The pixels of slice i are those of :func:`expected_pixels` plus offset.
+    '''
+    series_uid = '1.2.826.0.1.3680043.2.1125.2.%d' % series_number
+    filenames = []
+    for i in xrange(nslices):
+        filename = os.path.join(directory, 'IM-%04d-%04d.dcm' % (series_number, i + 1))
+        file_meta = Dataset()
+        file_meta.MediaStorageSOPClassUID = d2n.MR_IMAGE_STORAGE
+        file_meta.MediaStorageSOPInstanceUID = '%s.%d' % (series_uid, i + 1)
+        file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+        file_meta.ImplementationClassUID = '1.2.826.0.1.3680043.2.1125.2'
+        ds = FileDataset(filename, {}, file_meta = file_meta, preamble = b'\x00' * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+
+        ds.SOPClassUID = d2n.MR_IMAGE_STORAGE
+        ds.SOPInstanceUID = '%s.%d' % (series_uid, i + 1)
+        ds.StudyInstanceUID = '1.2.826.0.1.3680043.2.1125.2.0'
+        ds.SeriesInstanceUID = series_uid
+        ds.Modality = 'MR'
+        ds.PatientID = patient_id
+        ds.StudyDate = '20160101'
+        ds.AcquisitionDate = '20160101'
+        ds.SeriesNumber = series_number
+        ds.SeriesDescription = description
+        ds.InstanceNumber = i + 1
+        ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'NONE']
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.Rows = ROWS
+        ds.Columns = COLUMNS
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelSpacing = [1.0, 1.0]
+        ds.SliceThickness = 2.0
+        ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.ImagePositionPatient = [0.0, 0.0, 2.0 * i]
+        ds.PixelData = (expected_pixels()[i % NFRAMES] + offset).astype('<u2').tostring()
+        ds[0x7fe0, 0x0010].VR = 'OW'
+        ds.save_as(filename)
+        filenames.append(filename)
+    return filenames
+
+def expected_pixels():
+    ''' Return the (NFRAMES, ROWS, COLUMNS) pixel values of :func:`write_enhanced_mr`. '''
+    return np.arange(NFRAMES * ROWS * COLUMNS, dtype = np.uint16).reshape((NFRAMES, ROWS, COLUMNS))
+
+class TestDiscoverDicoms(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dicoms = write_classic_series(self.tmp_dir, 3, 'T1')
+        # a dataset without preamble, starting with an implicit VR (0008,0016) SOPClassUID element
+        raw = os.path.join(self.tmp_dir, 'raw')
+        with open(raw, 'wb') as fp:
+            fp.write(struct.pack('<HHI', 0x0008, 0x0016, 26) + d2n.MR_IMAGE_STORAGE + '\x00')
+        self.dicoms.append(raw)
+        sub_dir = os.path.join(self.tmp_dir, 'sub')
+        os.mkdir(sub_dir)
+        self.dicoms += write_classic_series(sub_dir, 4, 'FLAIR', nslices = 1)
+        self.not_dicoms = []
+        for name, data in [('report.pdf', '%PDF-1.4\n' + 'x' * 200), ('archive.zip', 'PK\x03\x04' + 'x' * 200),
+                           ('notes.txt', 'slice thickness 1 mm\n'), ('empty', ''),
+                           ('IM-0001.dcm', '\x00' * 128 + 'DICX'), ('short.dcm', '\x08\x00')]:
+            self.not_dicoms.append(os.path.join(self.tmp_dir, name))
+            with open(self.not_dicoms[-1], 'wb') as fp:
+                fp.write(data)
+        # hidden files and directories, and symbolic links to directories, are not followed
+        shutil.copy(self.dicoms[0], os.path.join(self.tmp_dir, '.hidden.dcm'))
+        os.mkdir(os.path.join(self.tmp_dir, '.hidden'))
+        shutil.copy(self.dicoms[0], os.path.join(self.tmp_dir, '.hidden', 'IM-0001.dcm'))
+        os.symlink(sub_dir, os.path.join(self.tmp_dir, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_is_dicom_file(self):
+        for filename in self.dicoms:
+            self.assertTrue(d2n.is_dicom_file(filename), filename)
+        for filename in self.not_dicoms + [os.path.join(self.tmp_dir, 'missing.dcm'), self.tmp_dir]:
+            self.assertFalse(d2n.is_dicom_file(filename), filename)
+
+    def test_discover_dicoms(self):
+        src_dcms, rejected = d2n.discover_dicoms(self.tmp_dir)
+        self.assertEqual(sorted(src_dcms), sorted(self.dicoms))
+        self.assertEqual(rejected, {'hidden': 2, 'not_dicom': len(self.not_dicoms)})
+
+    def test_discover_dicoms_not_recursive(self):
+        src_dcms, rejected = d2n.discover_dicoms(self.tmp_dir, recursive = False)
+        self.assertEqual(sorted(src_dcms), sorted(self.dicoms[:-1]))
+        self.assertEqual(d2n.discover_files(self.tmp_dir, sniff = True), src_dcms)
+
+class TestSopClasses(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = write_enhanced_mr(os.path.join(self.tmp_dir, 'enhanced.dcm'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _check_groups(self, dcm_groups):
+        self.assertEqual(len(dcm_groups), 1)
+        sop_classes = d2n.get_sop_classes(dcm_groups.values()[0])
+        self.assertEqual(sop_classes, set([d2n.ENHANCED_MR_IMAGE_STORAGE]))
+        self.assertTrue(d2n.ENHANCED_MR_IMAGE_STORAGE in sop_classes)
+
+    def test_read_sop_class(self):
+        self.assertEqual(d2n.read_sop_class(self.filename), d2n.ENHANCED_MR_IMAGE_STORAGE)
+
+    def test_header_fields_keep_dotted_uids(self):
+        header_fields = d2n.read_header_fields(self.filename)
+        self.assertEqual(header_fields['SOPClassUID'], d2n.ENHANCED_MR_IMAGE_STORAGE)
+
+    def test_default_grouping(self):
+        self._check_groups(d2n.get_all_dicom_groups([self.filename]))
+
+    def test_partial_grouping(self):
+        self._check_groups(d2n.get_all_dicom_groups([self.filename], partial = True))
+
+    def test_compact_grouping(self):
+        self._check_groups(d2n.get_all_dicom_groups([self.filename], compact = True))
+
+    def test_parallel_grouping(self):
+        second = write_enhanced_mr(os.path.join(self.tmp_dir, 'enhanced2.dcm'))
+        dcm_groups = d2n.get_all_dicom_groups([self.filename, second], jobs = 2)
+        self._check_groups(dcm_groups)
+        dcm_items = dcm_groups.values()[0]
+        self.assertEqual([dcm_item[2] for dcm_item in dcm_items], [self.filename, second])
+        # the workers send back the meta data only
+        self.assertEqual([dcm_item[0] for dcm_item in dcm_items], [None, None])
+        self.assertEqual(dcm_items[0][1]['SeriesDescription'], 'T1_ENHANCED')
+
+    def test_header_index_grouping(self):
+        index_filename = os.path.join(self.tmp_dir, 'index.sqlite')
+        for run in range(2):
+            # indexed on the first run, read from the index on the second one
+            with HeaderIndex(index_filename) as index:
+                self._check_groups(d2n.get_all_dicom_groups([self.filename], header_index = index))
+
+    def test_uid_names_are_ignored(self):
+        record = ({'SOPClassUID': 'Enhanced MR Image Storage'}, self.filename)
+        self.assertEqual(d2n.get_sop_classes([(None, record[0], record[1])]),
+                         set([d2n.ENHANCED_MR_IMAGE_STORAGE]))
+
+class TestFilterDicomsBySequence(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.t1 = write_classic_series(self.tmp_dir, 3, 'T1_MPRAGE')
+        self.flair = write_classic_series(self.tmp_dir, 4, 'FLAIR', nslices = 2)
+        self.t1_moco = write_classic_series(self.tmp_dir, 5, 't1_MoCoSeries', nslices = 1)
+        self.localizer = write_classic_series(self.tmp_dir, 6, 'localizer', nslices = 1)
+        self.not_dicom = os.path.join(self.tmp_dir, 'notes.txt')
+        with open(self.not_dicom, 'w') as fp:
+            fp.write('T1 FLAIR\n')
+        # interleave the series, the input order is kept
+        self.src_dcms = [self.not_dicom] + sorted(self.t1 + self.flair + self.t1_moco + self.localizer,
+                                                  key = lambda f: f[-8:])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def selected(self, *filenames):
+        return [f for f in self.src_dcms if f in filenames]
+
+    def test_keyword(self):
+        self.assertEqual(d2n.filter_dicoms_by_sequence(self.src_dcms, keyword = ['t1', 'FLAIR']),
+                         self.selected(*(self.t1 + self.flair + self.t1_moco)))
+        self.assertEqual(d2n.filter_dicoms_by_sequence(self.src_dcms, keyword = 'flair'), self.selected(*self.flair))
+
+    def test_exclude(self):
+        self.assertEqual(d2n.filter_dicoms_by_sequence(self.src_dcms, keyword = ['T1', 'FLAIR'],
+                                                       exclude = ['moco']),
+                         self.selected(*(self.t1 + self.flair)))
+        self.assertEqual(d2n.filter_dicoms_by_sequence(self.src_dcms, exclude = 'localizer'),
+                         self.selected(*(self.t1 + self.flair + self.t1_moco)))
+
+    def test_parallel(self):
+        self.assertEqual(d2n.filter_dicoms_by_sequence(self.src_dcms, keyword = 'T1', exclude = 'MoCo', jobs = 2),
+                         self.selected(*self.t1))
+
+    def test_same_selection_as_grouping(self):
+        dcm_groups = d2n.get_all_dicom_groups(self.src_dcms[1:])
+        selected_groups = d2n.get_all_dicoms_from_sequences(dcm_groups, keyword = ['T1'], exclude = ['MoCo'])
+        grouped = [dcm for group in selected_groups.itervalues() for dcm in group]
+        self.assertEqual(sorted(d2n.filter_dicoms_by_sequence(self.src_dcms, keyword = ['T1'], exclude = ['MoCo'])),
+                         sorted(grouped))
+
+class TestHeaderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = write_enhanced_mr(os.path.join(self.tmp_dir, 'enhanced.dcm'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        d2n._header_cache.clear()
+
+    def test_strip_pixel_data(self):
+        dcm_ds = dicom.read_file(self.filename)
+        header = d2n._strip_pixel_data(dcm_ds)
+        self.assertFalse(hasattr(header, 'PixelData'))
+        self.assertTrue(hasattr(dcm_ds, 'PixelData'))
+        self.assertEqual(header.SeriesInstanceUID, dcm_ds.SeriesInstanceUID)
+        self.assertTrue(d2n._strip_pixel_data(header) is header)
+
+    def test_cached_header_has_no_pixel_data(self):
+        d2n._header_cache.add(self.filename, d2n._strip_pixel_data(dicom.read_file(self.filename)))
+        self.assertFalse(hasattr(d2n.read_header(self.filename), 'PixelData'))
+        self.assertEqual(d2n._header_cache.hits, 1)
+
+class TestSplitEnhancedDicom(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = write_enhanced_mr(os.path.join(self.tmp_dir, 'enhanced.dcm'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_frames(self):
+        frames = d2n.split_enhanced_dicom(dicom.read_file(self.filename))
+        self.assertEqual(len(frames), NFRAMES)
+        for i, frame in enumerate(frames):
+            self.assertEqual(frame.SOPClassUID, d2n.MR_IMAGE_STORAGE)
+            self.assertEqual(frame.InstanceNumber, i + 1)
+            self.assertEqual([float(v) for v in frame.ImagePositionPatient], [0.0, 0.0, 2.0 * i])
+            self.assertEqual([float(v) for v in frame.PixelSpacing], [1.0, 1.0])
+            np.testing.assert_array_equal(frame.pixel_array, expected_pixels()[i])
+
+    def test_stack_frames(self):
+        stack = dcmstack.DicomStack(time_order = 'TemporalPositionIndex')
+        for frame in d2n.split_enhanced_dicom(dicom.read_file(self.filename)):
+            stack.add_dcm(frame)
+        nii = stack.to_nifti()
+        data = nii.get_data()
+        self.assertEqual(data.shape, (COLUMNS, ROWS, NFRAMES))
+        # map each voxel back to its frame, row and column through the patient (LPS) coordinates:
+        # 1 mm pixels along x and y, frames 2 mm apart along z, all from the origin
+        for index in np.ndindex(data.shape):
+            x, y, z = np.dot(nii.get_affine(), list(index) + [1])[:3] * [-1, -1, 1]
+            frame, row, column = int(round(z / 2.)), int(round(y)), int(round(x))
+            self.assertEqual(data[index], expected_pixels()[frame, row, column])
+
+    def test_dcmstack_engine(self):
+        # called directly: convert_one_sequence would fall back to dcm2nii on an error
+        output_dir = os.path.join(self.tmp_dir, 'Nifti')
+        result = d2n._convert_one_sequence_dcmstack([self.filename], output_dir, prefix = 'enhanced',
+                                                    gzip_threads = 2)
+        self.assertEqual(result.output_files, [os.path.join(output_dir, 'enhanced.nii.gz')])
+        nii = nib.load(result.output_files[0])
+        self.assertEqual(nii.shape, (COLUMNS, ROWS, NFRAMES))
+        self.assertEqual(sorted(np.unique(nii.get_data()).tolist()), range(NFRAMES * ROWS * COLUMNS))
+
+class TestOrganizeOneSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, 'input')
+        os.mkdir(self.input_dir)
+        self.sorted_dir = os.path.join(self.tmp_dir, 'dicoms', 'SUBJ01-20160101')
+        self.output_dir = os.path.join(self.sorted_dir, 'T1-3')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        d2n._header_cache.clear()
+
+    def assertSorted(self, new_dicom_files, src_dcms):
+        self.assertEqual(new_dicom_files, [os.path.join(self.output_dir, 'T1_%06d.dcm' % (i + 1))
+                                           for i in xrange(len(src_dcms))])
+        self.assertEqual(sorted(os.listdir(self.output_dir)), [os.path.basename(f) for f in new_dicom_files])
+        for src, dst in zip(src_dcms, new_dicom_files):
+            self.assertEqual(open(src, 'rb').read(), open(dst, 'rb').read())
+        # only the link and the build it points to are left
+        self.assertTrue(os.path.islink(self.output_dir))
+        self.assertEqual(sorted(os.listdir(self.sorted_dir)), sorted(['T1-3', os.readlink(self.output_dir)]))
+
+    def test_atomic_fresh_directory(self):
+        src_dcms = write_classic_series(self.input_dir, 3, 'T1')
+        new_dicom_files = d2n.organize_one_sequence(src_dcms, self.output_dir, prefix = 'T1', mode = 'copy',
+                                                    atomic = True)
+        self.assertSorted(new_dicom_files, src_dcms)
+
+    def test_atomic_replaces_a_sorted_series(self):
+        src_dcms = write_classic_series(self.input_dir, 3, 'T1', nslices = NFRAMES + 1)
+        d2n.organize_one_sequence(src_dcms, self.output_dir, prefix = 'T1', mode = 'copy', atomic = True)
+        previous_build = os.readlink(self.output_dir)
+        for dcm in src_dcms:
+            os.remove(dcm)
+        src_dcms = write_classic_series(self.input_dir, 3, 'T1', offset = 10)
+        new_dicom_files = d2n.organize_one_sequence(src_dcms, self.output_dir, prefix = 'T1', mode = 'copy',
+                                                    atomic = True)
+        self.assertSorted(new_dicom_files, src_dcms)
+        self.assertNotEqual(os.readlink(self.output_dir), previous_build)
+
+    def test_atomic_replaces_a_directory(self):
+        src_dcms = write_classic_series(self.input_dir, 3, 'T1')
+        d2n.organize_one_sequence(src_dcms[:1], self.output_dir, prefix = 'T0', mode = 'symbolic')
+        new_dicom_files = d2n.organize_one_sequence(src_dcms, self.output_dir, prefix = 'T1', mode = 'symbolic',
+                                                    atomic = True)
+        self.assertSorted(new_dicom_files, src_dcms)
+
+    def test_link_of_another_owner_is_kept(self):
+        other_dir = os.path.join(self.tmp_dir, 'other')
+        os.mkdir(other_dir)
+        os.makedirs(self.sorted_dir)
+        os.symlink(other_dir, self.output_dir)
+        src_dcms = write_classic_series(self.input_dir, 3, 'T1')
+        new_dicom_files = d2n.organize_one_sequence(src_dcms, self.output_dir, prefix = 'T1', mode = 'copy',
+                                                    atomic = True)
+        self.assertSorted(new_dicom_files, src_dcms)
+        self.assertTrue(os.path.isdir(other_dir))
+
+class TestTransferFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'src.dcm')
+        with open(self.src, 'wb') as fp:
+            fp.write('dicom data' * 1000)
+        self.dst = os.path.join(self.tmp_dir, 'dst.dcm')
+        self.link = os.link
+        self.ioctl = fcntl.ioctl
+
+    def tearDown(self):
+        os.link = self.link
+        fcntl.ioctl = self.ioctl
+        shutil.rmtree(self.tmp_dir)
+
+    def assertCopied(self):
+        self.assertEqual(open(self.dst, 'rb').read(), open(self.src, 'rb').read())
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+        self.assertFalse(os.path.islink(self.dst))
+
+    def test_link_file(self):
+        link = os.path.join(self.tmp_dir, 'link.dcm')
+        os.symlink(self.src, link)
+        # the file itself is linked, and the existing dst is replaced
+        os.symlink(self.src, self.dst)
+        d2n._link_file(link, self.dst)
+        self.assertFalse(os.path.islink(self.dst))
+        self.assertTrue(os.path.samefile(self.src, self.dst))
+        self.assertEqual(os.stat(self.src).st_nlink, 2)
+
+    def test_link_file_falls_back_to_a_copy(self):
+        def cross_device_link(src, dst):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        os.link = cross_device_link
+        d2n._link_file(self.src, self.dst)
+        self.assertCopied()
+
+    def test_link_file_errors(self):
+        def denied_link(src, dst):
+            raise OSError(errno.EACCES, 'Permission denied')
+        os.link = denied_link
+        self.assertRaises(OSError, d2n._link_file, self.src, self.dst)
+
+    def test_reflink_file(self):
+        clones = []
+        def clone(fd, request, src_fd):
+            clones.append(request)
+            os.write(fd, os.read(src_fd, 1 << 20))
+        fcntl.ioctl = clone
+        d2n._reflink_file(self.src, self.dst)
+        self.assertEqual(clones, [d2n._FICLONE])
+        self.assertCopied()
+
+    def test_reflink_file_falls_back_to_a_copy(self):
+        def no_clone(fd, request, src_fd):
+            raise IOError(errno.EOPNOTSUPP, 'Operation not supported')
+        fcntl.ioctl = no_clone
+        os.symlink(self.src, self.dst)
+        d2n._reflink_file(self.src, self.dst)
+        self.assertCopied()
+
+    def test_copy_file_does_not_write_through_links(self):
+        os.symlink(self.src, self.dst)
+        d2n._copy_file(self.src, self.dst)
+        self.assertCopied()
+        self.assertEqual(open(self.src, 'rb').read(), 'dicom data' * 1000)
+
+    def test_organize_with_hardlinks(self):
+        src_dcms = write_classic_series(self.tmp_dir, 3, 'T1')
+        new_dicom_files = d2n.organize_one_sequence(src_dcms, os.path.join(self.tmp_dir, 'sorted'), prefix = 'T1',
+                                                    mode = 'hardlink', threads = 2)
+        for src, dst in zip(src_dcms, new_dicom_files):
+            self.assertTrue(os.path.samefile(src, dst))
+
+class TestConvertOneSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.convert_dcmstack = d2n._convert_one_sequence_dcmstack
+        self.find_executable = d2n._find_executable
+
+    def tearDown(self):
+        d2n._convert_one_sequence_dcmstack = self.convert_dcmstack
+        d2n._find_executable = self.find_executable
+        shutil.rmtree(self.tmp_dir)
+        d2n._header_cache.clear()
+
+    def test_dcmstack(self):
+        src_dcms = write_classic_series(self.tmp_dir, 3, 'T1')
+        result = d2n.convert_one_sequence(src_dcms, os.path.join(self.tmp_dir, 'out'), engine = 'dcmstack')
+        self.assertEqual(result.output_files, [os.path.join(self.tmp_dir, 'out', 'SUBJ01-20160101_T1-3.nii.gz')])
+
+    def test_diffusion_goes_to_dcm2nii(self):
+        def no_dcmstack(*args, **kwargs):
+            raise AssertionError('diffusion dicoms were converted with dcmstack')
+        d2n._convert_one_sequence_dcmstack = no_dcmstack
+        d2n._find_executable = lambda name: None
+        src_dcms = write_classic_series(self.tmp_dir, 5, 'DTI')
+        self.assertRaises(OSError, d2n.convert_one_sequence, src_dcms, os.path.join(self.tmp_dir, 'out'),
+                          tmp_dir = self.tmp_dir, engine = 'dcmstack')
+
+class TestConvertOneGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, 'input')
+        os.mkdir(self.input_dir)
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        self.work_dir = os.path.join(self.tmp_dir, 'tmp')
+        os.mkdir(self.work_dir)
+        self.log = os.path.join(self.tmp_dir, 'log.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        d2n._header_cache.clear()
+
+    def test_lock_timeout_logs_to_the_shard(self):
+        import lockfile
+        from dicom2nifti import logger
+        class LockedState(object):
+            def refresh(self):
+                raise lockfile.LockTimeout('the log is locked')
+            def is_converted(self, subject_id, sequence):
+                return False
+            def record(self, subject_id, sequence, entry, timestamp, signatures = None):
+                pass
+        src_dcms = write_classic_series(self.input_dir, 3, 'T1')
+        d2n._convert_one_group(src_dcms, self.output_dir, log = self.log, tmp_dir = self.work_dir,
+                               engine = 'dcmstack', conversion_state = LockedState())
+        nifti = os.path.join(self.output_dir, 'Nifti', 'SUBJ01-20160101', 'SUBJ01-20160101_T1-3.nii.gz')
+        self.assertTrue(os.path.exists(nifti))
+        self.assertFalse(os.path.exists(self.log))
+        self.assertEqual(len(logger._log_files(self.log, logger._SHARD_INFIX)), 1)
+        self.assertEqual(logger.merge_logs(self.log).at['SUBJ01-20160101', 'T1-3'], nifti)
+        self.assertEqual(os.listdir(os.path.join(self.output_dir, 'Nifti', 'SUBJ01-20160101')),
+                         ['SUBJ01-20160101_T1-3.nii.gz'])
+
+class TestConvertOneDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, 'input')
+        os.mkdir(self.input_dir)
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        self.work_dir = os.path.join(self.tmp_dir, 'tmp')
+        os.mkdir(self.work_dir)
+        self.log = os.path.join(self.tmp_dir, 'log.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        d2n._header_cache.clear()
+
+    def nifti(self, sequence):
+        return os.path.join(self.output_dir, 'Nifti', 'SUBJ01-20160101', 'SUBJ01-20160101_%s.nii.gz' % sequence)
+
+    def test_parallel_series(self):
+        import threading
+        from dicom2nifti import logger
+        write_classic_series(self.input_dir, 3, 'T1')
+        write_classic_series(self.input_dir, 4, 'FLAIR', offset = 100)
+        threads = []
+        convert_one_group = d2n._convert_one_group
+        def record_thread(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return convert_one_group(*args, **kwargs)
+        d2n._convert_one_group = record_thread
+        try:
+            d2n.convert_one_directory(self.input_dir, self.output_dir, log = self.log, tmp_dir = self.work_dir,
+                                      engine = 'dcmstack', jobs = 2)
+        finally:
+            d2n._convert_one_group = convert_one_group
+        self.assertEqual(len(threads), 2)
+        self.assertFalse(threading.current_thread() in threads)
+        df = logger.read_log(self.log)
+        for sequence, offset in [('T1-3', 0), ('FLAIR-4', 100)]:
+            self.assertEqual(df.at['SUBJ01-20160101', sequence], self.nifti(sequence))
+            data = nib.load(self.nifti(sequence)).get_data()
+            self.assertEqual(data.shape[2], NFRAMES)
+            self.assertEqual(data.max(), expected_pixels().max() + offset)
+
+    def test_fingerprint_rerun(self):
+        write_classic_series(self.input_dir, 3, 'T1')
+        write_classic_series(self.input_dir, 4, 'FLAIR')
+        converted = []
+        convert_one_sequence = d2n.convert_one_sequence
+        def record_sequence(dicom_files, output_dir, **kwargs):
+            converted.append(kwargs['prefix'])
+            return convert_one_sequence(dicom_files, output_dir, **kwargs)
+        d2n.convert_one_sequence = record_sequence
+        def run():
+            del converted[:]
+            d2n.convert_one_directory(self.input_dir, self.output_dir, log = self.log, tmp_dir = self.work_dir,
+                                      engine = 'dcmstack', fingerprint = True)
+            return sorted(converted)
+        try:
+            self.assertEqual(run(), ['SUBJ01-20160101_FLAIR-4', 'SUBJ01-20160101_T1-3'])
+            self.assertTrue(os.path.exists(self.nifti('T1-3')[:-len('.nii.gz')] + '.fingerprint'))
+            # unchanged series are skipped
+            self.assertEqual(run(), [])
+            # a slice added to a series reconverts it only
+            write_classic_series(self.input_dir, 4, 'FLAIR', nslices = NFRAMES + 1)
+            self.assertEqual(run(), ['SUBJ01-20160101_FLAIR-4'])
+            self.assertEqual(run(), [])
+        finally:
+            d2n.convert_one_sequence = convert_one_sequence
+        self.assertEqual(nib.load(self.nifti('FLAIR-4')).shape[2], NFRAMES + 1)
+        self.assertEqual(nib.load(self.nifti('T1-3')).shape[2], NFRAMES)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+HEAVY_MODULES = ['dcmstack', 'dicom', 'nibabel', 'numpy', 'pandas']
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# wall time budget (seconds) of a console script startup, interpreter included. Importing the heavy
+# modules alone takes about 0.7 s, the lazy package about 4 ms.
+STARTUP_BUDGET = 0.35
+
+def imported_modules(code):
+    ''' Run code in a fresh interpreter and return the heavy modules it imported. '''
+    code += '\nimport sys\nprint("imported: " + " ".join(m for m in %r if m in sys.modules))' % (HEAVY_MODULES,)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd = ROOT)
+    return output.splitlines()[-1].split()[1:]
+
+def script_help(module):
+    ''' Return the code running the main function of a console script module with --help. '''
+    return ('from dicom2nifti import %s\n'
+            'try:\n'
+            '    %s.main(["--help"])\n'
+            'except SystemExit:\n'
+            '    pass' % (module, module))
+
+def startup_time(module, repeat = 3):
+    ''' Return the best wall time of a console script run with --help in a fresh interpreter. '''
+    with open(os.devnull, 'w') as devnull:
+        timings = []
+        for i in xrange(repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', script_help(module)], cwd = ROOT, stdout = devnull)
+            timings.append(time.time() - start)
+    return min(timings)
+
+class TestLazyImport(unittest.TestCase):
+
+    def test_import_package(self):
+        self.assertEqual(imported_modules('import dicom2nifti'), [])
+
+    def test_command_line_help(self):
+        self.assertEqual(imported_modules(script_help('command_line')), [])
+
+    def test_rename_nifti_help(self):
+        self.assertEqual(imported_modules(script_help('rename_nifti')), [])
+
+    def test_names_resolve_on_access(self):
+        self.assertEqual(imported_modules('import dicom2nifti\n'
+                                          'assert dicom2nifti.StatCache is dicom2nifti.stat_cache.StatCache'), [])
+
+    def test_unknown_name(self):
+        import dicom2nifti
+        self.assertRaises(AttributeError, getattr, dicom2nifti, '_no_such_name')
+        self.assertTrue('convert_one_directory' in dir(dicom2nifti))
+
+class TestStartupTime(unittest.TestCase):
+
+    def test_sort_and_rename_dicoms(self):
+        elapsed = startup_time('command_line')
+        self.assertTrue(elapsed < STARTUP_BUDGET, 'sortAndRenameDicoms --help took %.3f s' % elapsed)
+
+    def test_rename_nifti(self):
+        elapsed = startup_time('rename_nifti')
+        self.assertTrue(elapsed < STARTUP_BUDGET, 'rename_nifti --help took %.3f s' % elapsed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,360 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import unittest
+
+import pandas as pd
+
+from dicom2nifti import logger
+
+OLD = '2016/01/01-00:00:00'
+NEW = '2016/06/01-00:00:00'
+
+def write_log(filename, rows):
+    ''' Write a log CSV of (ID, sequence, entry, time) rows. '''
+    df = logger.create_log()
+    for subject_id, sequence, entry, timestamp in rows:
+        df.at[subject_id, sequence] = entry
+        df.at[subject_id, 'Time_Last_Update'] = timestamp
+    df.to_csv(filename, index = True)
+
+def write_journal(filename, rows):
+    with open(filename, 'w') as fp:
+        for row in rows:
+            fp.write(','.join(row) + '\n')
+
+def dead_pid():
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    return proc.pid
+
+def combine_cells(cell_x, cell_y):
+    ''' The cell merge of merge_log_by_modality before the stat cache, a file check per call. '''
+    if all(map(os.path.exists, str(cell_x).split(' '))) and all(map(os.path.exists, str(cell_y).split(' '))):
+        return cell_x + ' ' + cell_y
+    elif all(map(os.path.exists, str(cell_x).split(' '))):
+        return cell_x
+    elif all(map(os.path.exists, str(cell_y).split(' '))):
+        return cell_y
+    return pd.np.nan
+
+def merge_columns(df, cols):
+    ''' Merge the columns of a log like merge_log_by_modality before the stat cache. '''
+    merged = df[cols[0]].astype(str)
+    for col in cols[1:]:
+        merged = merged.combine(df[col], combine_cells)
+    return merged
+
+class TestLogBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp_dir, 'log.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _orphan_wal(self, rows):
+        wal = '%s.wal-%s-%d' % (self.log, socket.gethostname(), dead_pid())
+        write_journal(wal, rows)
+        return wal
+
+    def test_entries_wait_in_the_wal(self):
+        buf = logger.LogBuffer(self.log, batch_size = 10)
+        buf.log('S1', 'T1', msg = 'SORT_FAILED')
+        self.assertFalse(os.path.exists(self.log))
+        self.assertEqual(open(buf.wal).read().split(',')[:3], ['S1', 'T1', 'SORT_FAILED'])
+        buf.close()
+        self.assertFalse(os.path.exists(buf.wal))
+        self.assertEqual(logger.read_log(self.log).at['S1', 'T1'], 'SORT_FAILED')
+
+    def test_orphan_wal_recovery(self):
+        write_log(self.log, [('S1', 'T1', 'CONVERT_FAILED', NEW)])
+        wal = self._orphan_wal([('S1', 'T1', 'SORT_FAILED', OLD), ('S2', 'T1', 'SORT_FAILED', OLD)])
+        with logger.LogBuffer(self.log, batch_size = 1) as buf:
+            buf.log('S3', 'T1', msg = 'SORT_FAILED')
+        df = pd.read_csv(self.log, index_col = 0, dtype = str)
+        # the older recovered entry does not overwrite the newer one
+        self.assertEqual(df.at['S1', 'T1'], 'CONVERT_FAILED')
+        self.assertEqual(df.at['S1', 'Time_Last_Update'], NEW)
+        self.assertEqual(df.at['S2', 'T1'], 'SORT_FAILED')
+        self.assertEqual(df.at['S3', 'T1'], 'SORT_FAILED')
+        self.assertFalse(os.path.exists(wal))
+
+    def test_wal_of_a_live_process_is_kept(self):
+        wal = '%s.wal-%s-%d' % (self.log, socket.gethostname(), os.getppid())
+        write_journal(wal, [('S2', 'T1', 'SORT_FAILED', OLD)])
+        with logger.LogBuffer(self.log, batch_size = 1) as buf:
+            buf.log('S1', 'T1', msg = 'SORT_FAILED')
+        self.assertTrue(os.path.exists(wal))
+        self.assertFalse('S2' in logger.read_log(self.log).index)
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp_dir, 'log.csv')
+        self.nifti = os.path.join(self.tmp_dir, 'S1_T1.nii.gz')
+        open(self.nifti, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_append(self):
+        write_log(self.log, [('S1', 'T1', 'SORT_FAILED', OLD)])
+        csv = open(self.log).read()
+        logger.log_tofile(self.log, 'S1', 'T1', nifti_path = self.nifti, backend = 'journal')
+        logger.log_tofile(self.log, 'S2', 'FLAIR', msg = 'CONVERT_FAILED', backend = 'journal')
+        # the CSV is left as is, each entry is a row of the journal
+        self.assertEqual(open(self.log).read(), csv)
+        rows = logger._read_rows(self.log + '.journal')
+        self.assertEqual([row[:3] for row in rows], [['S1', 'T1', self.nifti], ['S2', 'FLAIR', 'CONVERT_FAILED']])
+
+    def test_read_log(self):
+        write_log(self.log, [('S1', 'T1', 'SORT_FAILED', OLD), ('S1', 'T2', 'SORT_FAILED', OLD)])
+        write_journal(self.log + '.journal', [('S1', 'T1', self.nifti, NEW), ('S2', 'FLAIR', 'CONVERT_FAILED', OLD)])
+        # a row still being written is ignored
+        with open(self.log + '.journal', 'a') as fp:
+            fp.write('S3,T1,SORT')
+        df = logger.read_log(self.log)
+        self.assertEqual(df.at['S1', 'T1'], self.nifti)
+        self.assertEqual(df.at['S1', 'T2'], 'SORT_FAILED')
+        self.assertEqual(df.at['S1', 'Time_Last_Update'], NEW)
+        self.assertEqual(df.at['S2', 'FLAIR'], 'CONVERT_FAILED')
+        self.assertFalse('S3' in df.index)
+        self.assertEqual(logger.read_log(self.log, backend = 'csv').at['S1', 'T1'], 'SORT_FAILED')
+        self.assertTrue(logger.read_log(os.path.join(self.tmp_dir, 'missing.csv')).empty)
+
+    def test_materialize_log(self):
+        logger.log_tofile(self.log, 'S1', 'T1', msg = 'SORT_FAILED', backend = 'journal')
+        logger.log_tofile(self.log, 'S1', 'T1', nifti_path = self.nifti, backend = 'journal')
+        logger.log_tofile(self.log, 'S2', 'T1', msg = 'CONVERT_FAILED', backend = 'journal')
+        self.assertFalse(os.path.exists(self.log))
+        df = logger.materialize_log(self.log)
+        self.assertFalse(os.path.exists(self.log + '.journal'))
+        for result in (df, logger.read_log(self.log, backend = 'csv')):
+            self.assertEqual(result.at['S1', 'T1'], self.nifti)
+            self.assertEqual(result.at['S2', 'T1'], 'CONVERT_FAILED')
+        self.assertTrue(logger.is_converted(logger.read_log(self.log), 'S1', 'T1'))
+
+class TestConversionState(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp_dir, 'log.csv')
+        self.niftis = []
+        for name in ['S1_T1.nii.gz', 'S2_T1.nii.gz', 'S3_T1.nii.gz']:
+            self.niftis.append(os.path.join(self.tmp_dir, name))
+            open(self.niftis[-1], 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def state(self, backend):
+        state = logger.ConversionState(self.log, backend = backend)
+        state.reloads = 0
+        reload_state = state._reload
+        def count_reload():
+            state.reloads += 1
+            reload_state()
+        state._reload = count_reload
+        return state
+
+    def test_csv(self):
+        write_log(self.log, [('S1', 'T1', self.niftis[0], OLD)])
+        state = self.state('csv')
+        state.refresh()
+        self.assertTrue(state.is_converted('S1', 'T1'))
+        self.assertFalse(state.is_converted('S2', 'T1'))
+        # the writes of the run update the state, they do not invalidate it
+        logger.log_tofile(self.log, 'S2', 'T1', nifti_path = self.niftis[1], state = state)
+        state.refresh()
+        self.assertTrue(state.is_converted('S2', 'T1'))
+        self.assertEqual(state.reloads, 1)
+        # the writes of other processes are reloaded
+        logger.log_tofile(self.log, 'S3', 'T1', nifti_path = self.niftis[2])
+        self.assertFalse(state.is_converted('S3', 'T1'))
+        state.refresh()
+        self.assertTrue(state.is_converted('S3', 'T1'))
+        self.assertEqual(state.reloads, 2)
+        state.refresh()
+        self.assertEqual(state.reloads, 2)
+
+    def test_journal(self):
+        write_log(self.log, [('S1', 'T1', self.niftis[0], OLD)])
+        state = self.state('journal')
+        state.refresh()
+        self.assertTrue(state.is_converted('S1', 'T1'))
+        # the journal is read from where the last refresh stopped
+        logger.log_tofile(self.log, 'S2', 'T1', nifti_path = self.niftis[1], backend = 'journal')
+        logger.log_tofile(self.log, 'S1', 'T1', msg = 'CONVERT_FAILED', backend = 'journal')
+        state.refresh()
+        self.assertTrue(state.is_converted('S2', 'T1'))
+        self.assertFalse(state.is_converted('S1', 'T1'))
+        self.assertEqual(state.reloads, 1)
+        # a materialized journal is reloaded from the CSV
+        logger.log_tofile(self.log, 'S3', 'T1', nifti_path = self.niftis[2], backend = 'journal')
+        logger.materialize_log(self.log)
+        state.refresh()
+        self.assertEqual(state.reloads, 2)
+        self.assertTrue(state.is_converted('S2', 'T1'))
+        self.assertTrue(state.is_converted('S3', 'T1'))
+        self.assertFalse(state.is_converted('S1', 'T1'))
+
+class TestShardsAndMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp_dir, 'log.csv')
+        self.nifti = os.path.join(self.tmp_dir, 'S1_T1.nii.gz')
+        open(self.nifti, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shard_backend(self):
+        logger.log_tofile(self.log, 'S1', 'T1', nifti_path = self.nifti, backend = 'shard')
+        self.assertFalse(os.path.exists(self.log))
+        self.assertEqual(len(logger._log_files(self.log, logger._SHARD_INFIX)), 1)
+        self.assertEqual(logger.read_log(self.log).at['S1', 'T1'], self.nifti)
+        self.assertTrue(logger.read_log(self.log, backend = 'csv').empty)
+
+    def test_conversion_state_of_shards_takes_no_lock(self):
+        import lockfile
+        write_log(self.log, [('S2', 'T1', 'SORT_FAILED', OLD)])
+        logger.log_tofile(self.log, 'S1', 'T1', nifti_path = self.nifti, backend = 'shard')
+        file_lock = lockfile.FileLock
+        def no_lock(*args, **kwargs):
+            raise AssertionError('the log was locked')
+        lockfile.FileLock = no_lock
+        try:
+            state = logger.ConversionState(self.log, backend = 'shard')
+            state.refresh()
+        finally:
+            lockfile.FileLock = file_lock
+        self.assertTrue(state.is_converted('S1', 'T1'))
+        self.assertFalse(state.is_converted('S2', 'T1'))
+
+    def test_merge_logs(self):
+        write_log(self.log, [('S1', 'T1', 'CONVERT_FAILED', OLD), ('S2', 'T1', 'SORT_FAILED', NEW)])
+        write_journal(self.log + '.journal', [('S3', 'T1', 'SORT_FAILED', OLD)])
+        write_journal(self.log + '.shard-host1-1', [('S1', 'T1', self.nifti, NEW)])
+        write_journal(self.log + '.shard-host2-2', [('S2', 'T1', 'CONVERT_FAILED', OLD),
+                                                    ('S4', 'FLAIR', 'SORT_FAILED', NEW)])
+        wal = '%s.wal-%s-%d' % (self.log, socket.gethostname(), dead_pid())
+        write_journal(wal, [('S5', 'T1', 'SORT_FAILED', OLD)])
+        backup = os.path.join(self.tmp_dir, 'log.csv_backup.csv')
+        shutil.copy(self.log, backup)
+
+        df = logger.merge_logs(self.log)
+        for result in (df, pd.read_csv(self.log, index_col = 0, dtype = str)):
+            self.assertEqual(result.at['S1', 'T1'], self.nifti)
+            self.assertEqual(result.at['S1', 'Time_Last_Update'], NEW)
+            # last writer wins: the older shard entry does not overwrite the CSV
+            self.assertEqual(result.at['S2', 'T1'], 'SORT_FAILED')
+            self.assertEqual(result.at['S3', 'T1'], 'SORT_FAILED')
+            self.assertEqual(result.at['S4', 'FLAIR'], 'SORT_FAILED')
+            self.assertEqual(result.at['S5', 'T1'], 'SORT_FAILED')
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['S1_T1.nii.gz', 'log.csv', 'log.csv_backup.csv'])
+
+    def test_merge_overlapping_shards(self):
+        middle = '2016/03/01-00:00:00'
+        write_log(self.log, [('S1', 'T2', 'CONVERT_FAILED', OLD), ('S2', 'T1', 'SORT_FAILED', NEW)])
+        write_journal(self.log + '.shard-host1-1', [('S1', 'T1', 'SORT_FAILED', OLD),
+                                                    ('S1', 'T2', self.nifti, middle),
+                                                    ('S2', 'FLAIR', 'SORT_FAILED', OLD)])
+        write_journal(self.log + '.shard-host2-2', [('S1', 'T1', 'CONVERT_FAILED', NEW),
+                                                    ('S1', 'T2', '', NEW),
+                                                    ('S2', 'T1', '', NEW)])
+        df = logger.merge_logs(self.log)
+        # newer non-empty entries win cell by cell
+        self.assertEqual(df.at['S1', 'T1'], 'CONVERT_FAILED')
+        self.assertEqual(df.at['S1', 'T2'], self.nifti)
+        self.assertEqual(df.at['S1', 'Time_Last_Update'], NEW)
+        self.assertEqual(df.at['S2', 'T1'], 'SORT_FAILED')
+        self.assertEqual(df.at['S2', 'FLAIR'], 'SORT_FAILED')
+        self.assertEqual(df.at['S2', 'Time_Last_Update'], NEW)
+
+    def test_merge_leftovers(self):
+        write_journal(self.log + '.journal.merging', [('S1', 'T1', 'SORT_FAILED', OLD),
+                                                      ('S2', 'T1', 'SORT_FAILED', OLD)])
+        write_journal(self.log + '.journal', [('S1', 'T1', 'CONVERT_FAILED', NEW)])
+        df = logger.merge_logs(self.log)
+        self.assertEqual(df.at['S1', 'T1'], 'CONVERT_FAILED')
+        self.assertEqual(df.at['S2', 'T1'], 'SORT_FAILED')
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['S1_T1.nii.gz', 'log.csv'])
+
+    def test_merge_side_logs(self):
+        write_log(self.log, [('S1', 'T1', 'SORT_FAILED', OLD)])
+        # lock timeout logs of earlier versions: <log>_<host>[-<thread id>].<pid><hash of the log path>
+        side_log = self.log + '_node-12.example.org-7f3a2b10.12345-4578123456789'
+        write_log(side_log, [('S1', 'T1', self.nifti, NEW), ('S2', 'T1', 'SORT_FAILED', OLD)])
+        write_log(self.log + '_node1.999123456', [('S3', 'T1', 'SORT_FAILED', OLD)])
+        renamed_log = os.path.join(self.tmp_dir, 'timeout.csv')
+        write_log(renamed_log, [('S4', 'T1', 'SORT_FAILED', OLD)])
+        backup = self.log + '_backup.csv'
+        write_log(backup, [('S1', 'T1', 'CONVERT_FAILED', NEW)])
+        df = logger.merge_logs(self.log, side_logs = [renamed_log])
+        self.assertEqual(df.at['S1', 'T1'], self.nifti)
+        self.assertEqual(df.at['S2', 'T1'], 'SORT_FAILED')
+        self.assertEqual(df.at['S3', 'T1'], 'SORT_FAILED')
+        self.assertEqual(df.at['S4', 'T1'], 'SORT_FAILED')
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['S1_T1.nii.gz', 'log.csv', 'log.csv_backup.csv'])
+
+    def test_merge_keeps_files(self):
+        write_journal(self.log + '.shard-host1-1', [('S1', 'T1', 'SORT_FAILED', NEW)])
+        logger.merge_logs(self.log, remove = False)
+        self.assertTrue(os.path.exists(self.log + '.shard-host1-1'))
+        self.assertEqual(logger.read_log(self.log, backend = 'csv').at['S1', 'T1'], 'SORT_FAILED')
+
+class TestFileChecks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        nifti = lambda name: os.path.join(self.tmp_dir, name + '.nii.gz')
+        for name in ['a', 'b', 'c', 'd', 'e']:
+            open(nifti(name), 'w').close()
+        missing = nifti('missing')
+        self.df = logger.create_log()
+        rows = {'S1': {'T1_MPRAGE-2': nifti('a'), 'T1_POST-5': nifti('b'), 't1_se-6': nifti('c')},
+                'S2': {'T1_MPRAGE-2': missing, 'T1_POST-5': nifti('b')},
+                'S3': {'T1_POST-5': nifti('a') + ' ' + nifti('b'), 't1_se-6': nifti('c') + ' ' + missing},
+                'S4': {'T1_MPRAGE-2': 'SORT_FAILED', 'T1_POST-5': 'CONVERT_FAILED'},
+                'S5': {'T1_MPRAGE-2': nifti('d'), 'DTI-7': nifti('e'), 'DTI_TRACEW-8': nifti('a'),
+                       'FLAIR-3': nifti('c'), 'T2_FLAIR-4': nifti('d')},
+                'S6': {'DTI-7': missing, 'DWI-9': nifti('e') + ' ' + nifti('d'), 'FLAIR-3': 'NA'}}
+        for subject_id, entries in sorted(rows.items()):
+            for sequence, entry in sorted(entries.items()):
+                self.df.at[subject_id, sequence] = entry
+            self.df.at[subject_id, 'Time_Last_Update'] = OLD
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_count_files_frame(self):
+        from dicom2nifti.stat_cache import StatCache
+        expected = self.df.applymap(logger.count_files)
+        self.assertEqual(expected.at['S3', 'T1_POST-5'], 2)
+        for stat_cache in (None, StatCache(threads = 1), StatCache(threads = 4)):
+            counts = logger.count_files_frame(self.df, stat_cache = stat_cache)
+            self.assertEqual(counts.index.tolist(), expected.index.tolist())
+            self.assertEqual(counts.columns.tolist(), expected.columns.tolist())
+            self.assertEqual(counts.values.tolist(), expected.values.tolist())
+
+    def test_merge_log_by_modality(self):
+        modalities = {'T1': ['T1'], 'DTI': ['DTI', 'DWI'], 'FLAIR': ['FLAIR']}
+        df_merged = logger.merge_log_by_modality(self.df, modalities = modalities)
+        # the same columns, in the same order, as merge_log_by_modality selects
+        columns = {'T1': list(set(['T1_MPRAGE-2', 'T1_POST-5', 't1_se-6'])),
+                   'DTI': list(set(['DTI-7', 'DWI-9'])),
+                   'FLAIR': list(set(['FLAIR-3', 'T2_FLAIR-4']))}
+        for modality, cols in columns.iteritems():
+            expected = merge_columns(self.df, cols)
+            self.assertEqual(df_merged[modality].fillna('<null>').to_dict(), expected.fillna('<null>').to_dict())
+        self.assertEqual(df_merged.at['S1', 'T1'].count(' '), 2)
+        self.assertEqual(df_merged.at['S6', 'DTI'], self.df.at['S6', 'DWI-9'])
+
+if __name__ == '__main__':
+    unittest.main()
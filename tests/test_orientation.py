@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nib
+
+from dicom2nifti.orientation import reorient_nifti_and_bvec, reorient_nifti_file
+
+ORIENTATIONS = ['LPS', 'RAS', 'LAS', 'LAI', 'PIR', 'SRA']
+
+class TestReorientNiftiFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data = (np.arange(4 * 5 * 6 * 3).reshape((4, 5, 6, 3)) * 7 % 251).astype(np.int16)
+        self.affine = np.diag([-1.5, 2., 2.5, 1.])  # LAS
+        self.affine[:3, 3] = [10., -20., 30.]
+        self.bvec = np.array([[1., 0., 0.], [0., 1., 0.], [0., 0., 1.]])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _save(self, filename, slope = None, inter = None):
+        nib.Nifti1Image(self.data, self.affine).to_filename(filename)
+        if slope is not None:
+            # nibabel recomputes the scaling when saving: set it in the file
+            with open(filename, 'r+b') as fp:
+                hdr = nib.Nifti1Header.from_fileobj(fp)
+                hdr.set_slope_inter(slope, inter)
+                fp.seek(0)
+                hdr.write_to(fp)
+        return filename
+
+    def _check(self, in_filename, extension):
+        for orientation in ORIENTATIONS:
+            out_filename = os.path.join(self.tmp_dir, orientation + extension)
+            bvec_out = reorient_nifti_file(in_filename, out_filename, orientation, bvec = self.bvec,
+                                           gzip_threads = 2)
+            expected, expected_bvec = reorient_nifti_and_bvec(nib.load(in_filename), orientation,
+                                                              bvec = self.bvec)
+            nii = nib.load(out_filename)
+            self.assertEqual(''.join(nib.aff2axcodes(nii.get_affine())), orientation)
+            np.testing.assert_array_almost_equal(nii.get_data(), expected.get_data())
+            np.testing.assert_array_almost_equal(nii.get_affine(), expected.get_affine())
+            np.testing.assert_array_almost_equal(nii.get_qform(), expected.get_affine())
+            np.testing.assert_array_almost_equal(bvec_out, expected_bvec)
+
+    def test_unscaled(self):
+        self._check(self._save(os.path.join(self.tmp_dir, 'in.nii')), '.nii')
+
+    def test_unscaled_compressed(self):
+        self._check(self._save(os.path.join(self.tmp_dir, 'in.nii.gz')), '.nii.gz')
+
+    def test_scaled(self):
+        in_filename = self._save(os.path.join(self.tmp_dir, 'in.nii'), slope = 0.5, inter = 10.)
+        self._check(in_filename, '.nii')
+        nii = nib.load(os.path.join(self.tmp_dir, 'LPS.nii'))
+        self.assertEqual(nii.dataobj.slope, 0.5)
+        self.assertEqual(nii.dataobj.inter, 10.)
+        self.assertEqual(nii.get_data_dtype(), np.int16)
+
+class TestReorientNiftiAndBvec(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'in.nii')
+        self.affine = np.diag([-1.5, 2., 2.5, 1.])  # LAS
+        nii = nib.Nifti1Image(np.zeros((4, 5, 6), dtype = np.int16), self.affine)
+        nii.set_qform(np.diag([1., 1., 1., 1.]), code = 1)
+        nii.to_filename(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_orientation(self):
+        nii = nib.load(self.filename)
+        nii_out, bvec_out = reorient_nifti_and_bvec(nii, 'LAS', bvec = np.eye(3))
+        np.testing.assert_array_almost_equal(nii_out.get_affine(), self.affine)
+        np.testing.assert_array_almost_equal(nii_out.get_qform(), self.affine)
+        np.testing.assert_array_almost_equal(bvec_out, np.eye(3))
+        # the data is not loaded and the input image is left as it is
+        self.assertFalse(nii_out.in_memory)
+        np.testing.assert_array_almost_equal(nii.get_qform(), np.eye(4))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import gzip
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nib
+
+from dicom2nifti.parallel_gzip import ParallelGzipWriter, save_nifti
+
+class TestParallelGzipWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_blocks_are_a_valid_gzip_file(self):
+        filename = os.path.join(self.tmp_dir, 'data.gz')
+        data = os.urandom(1000) * 100
+        with ParallelGzipWriter(filename, threads = 3, block_size = 4096, index = True) as fobj:
+            fobj.write(data[:5000])
+            fobj.write(data[5000:])
+            self.assertEqual(fobj.tell(), len(data))
+        with gzip.open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(), data)
+        with open(filename + '.gzi', 'rb') as fp:
+            count = struct.unpack('<Q', fp.read(8))[0]
+        self.assertEqual(count, (len(data) - 1) // 4096)
+
+    def test_empty_file(self):
+        filename = os.path.join(self.tmp_dir, 'empty.gz')
+        ParallelGzipWriter(filename).close()
+        with gzip.open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(), b'')
+
+class TestSaveNifti(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _round_trip(self, filename, **kwargs):
+        data = np.arange(4 * 5 * 6 * 3, dtype = np.int16).reshape((4, 5, 6, 3))
+        affine = np.diag([-1., -2., 3., 1.])
+        affine[:3, 3] = [10., 20., -30.]
+        save_nifti(nib.Nifti1Image(data, affine), filename, **kwargs)
+        nii = nib.load(filename)
+        np.testing.assert_array_equal(nii.get_data(), data)
+        np.testing.assert_array_almost_equal(nii.get_affine(), affine)
+
+    def test_gz_round_trip(self):
+        filename = os.path.join(self.tmp_dir, 'image.nii.gz')
+        self._round_trip(filename, level = 1, threads = 2, index = True)
+        self.assertTrue(os.path.exists(filename + '.gzi'))
+
+    def test_uncompressed_round_trip(self):
+        self._round_trip(os.path.join(self.tmp_dir, 'image.nii'))
+
+if __name__ == '__main__':
+    unittest.main()
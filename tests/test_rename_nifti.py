@@ -0,0 +1,55 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import pandas as pd
+
+from dicom2nifti import logger, rename_nifti, stat_cache
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp_dir, 'log.csv')
+        self.master = os.path.join(self.tmp_dir, 'master.csv')
+        df = logger.create_log()
+        for subject_id, sequence in [('SUBJ01-20160101', 'T1-3'), ('SUBJ01-20160101', 'T1-7'),
+                                     ('SUBJ01-20160101', 'FLAIR-4'), ('SUBJ02-20160102', 'T1-3')]:
+            nifti = os.path.join(self.tmp_dir, '%s_%s.nii.gz' % (subject_id, sequence))
+            open(nifti, 'w').close()
+            logger.log_conversion(df, subject_id, sequence, nifti_path = nifti, inplace = True)
+        logger.log_conversion(df, 'SUBJ02-20160102', 'FLAIR-4', msg = 'CONVERT_FAILED', inplace = True)
+        df.to_csv(self.log, index = True)
+        self.exists = stat_cache._exists
+        self.checked = []
+        def count_exists(path):
+            self.checked.append(path)
+            return self.exists(path)
+        stat_cache._exists = count_exists
+
+    def tearDown(self):
+        stat_cache._exists = self.exists
+        shutil.rmtree(self.tmp_dir)
+
+    def test_merge_and_master_share_the_stat_cache(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            rename_nifti.main(['-i', self.log, '--merge', '-m', 'T1', 'FLAIR', '-l', self.master, '--execute'])
+        finally:
+            sys.stdout = stdout
+        df_master = pd.read_csv(self.master, index_col = 0, dtype = str)
+        self.assertEqual(df_master.at['SUBJ01-20160101', 'T1'], '2')
+        self.assertEqual(df_master.at['SUBJ01-20160101', 'FLAIR'], '1')
+        self.assertEqual(df_master.at['SUBJ02-20160102', 'T1'], '1')
+        self.assertEqual(df_master.at['SUBJ02-20160102', 'FLAIR'], '0')
+        self.assertEqual(df_master.at['SUBJ02-20160102', 'subj_id'], 'SUBJ02')
+        # every file is checked once for both the merge and the counts
+        self.assertEqual(len(self.checked), len(set(self.checked)))
+        self.assertEqual(len([path for path in self.checked if path.endswith('.nii.gz')]), 4)
+
+if __name__ == '__main__':
+    unittest.main()
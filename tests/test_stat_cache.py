@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from dicom2nifti import stat_cache
+from dicom2nifti.stat_cache import StatCache
+
+class TestStatCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files = []
+        for i in xrange(100):
+            self.files.append(os.path.join(self.tmp_dir, '%03d.nii.gz' % i))
+            open(self.files[-1], 'w').close()
+        self.missing = [os.path.join(self.tmp_dir, 'missing%03d.nii.gz' % i) for i in xrange(100)]
+        self.exists = stat_cache._exists
+        self.checked = []
+        self.checked_lock = threading.Lock()
+        def count_exists(path):
+            with self.checked_lock:
+                self.checked.append(path)
+            return self.exists(path)
+        stat_cache._exists = count_exists
+
+    def tearDown(self):
+        stat_cache._exists = self.exists
+        shutil.rmtree(self.tmp_dir)
+
+    def test_exists_many(self):
+        cache = StatCache(threads = 4)
+        paths = self.files + self.missing + self.files[:10] + ['', 'null\x00byte']
+        self.assertEqual(cache.exists_many(paths), [os.path.exists(path) for path in paths[:-1]] + [False])
+        # every distinct path is checked once
+        self.assertEqual(sorted(self.checked), sorted(set(paths)))
+        self.assertEqual(len(cache), len(set(paths)))
+        self.assertTrue(cache.exists(self.files[0]))
+        self.assertFalse(cache.exists(self.missing[0]))
+        self.assertEqual(len(self.checked), len(set(paths)))
+
+    def test_cached_results(self):
+        cache = StatCache()
+        cache.prefetch(self.files[:1] + self.missing[:1])
+        os.remove(self.files[0])
+        open(self.missing[0], 'w').close()
+        self.assertEqual(cache.exists_many(self.files[:1] + self.missing[:1]), [True, False])
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.exists_many(self.files[:1] + self.missing[:1]), [False, True])
+
+    def test_shared_between_threads(self):
+        cache = StatCache(threads = 4)
+        results = []
+        def check():
+            results.append(cache.exists_many(self.files + self.missing))
+        threads = [threading.Thread(target = check) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[True] * 100 + [False] * 100] * 4)
+        self.assertEqual(len(cache), 200)
+
+if __name__ == '__main__':
+    unittest.main()